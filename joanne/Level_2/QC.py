@@ -15,6 +15,7 @@ from seaborn import distplot
 from tqdm import tqdm
 
 import joanne
+from joanne import config
 from joanne.Level_2 import fn_2 as f2
 
 reload(f2)
@@ -37,14 +38,12 @@ parser.add_argument(
     type=str,
 )
 
-args = parser.parse_args()
-
 # %%
 
-logs_directory = "/Users/geet/Documents/JOANNE/Data/Level_2/logs_and_stats/"
+logs_directory = config.get_directory("logs")
 # directory to store logs and stats
-data_directory = "/Users/geet/Documents/JOANNE/Data/"
-save_directory = "/Users/geet/Documents/JOANNE/Data/QC/"
+data_directory = config.settings["data_directory"]
+save_directory = config.get_directory("qc")
 # %%
 
 
@@ -126,6 +125,7 @@ def create_QC_summary_logs(
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     run_qc()
     if args.logs:
         create_QC_summary_logs()
@@ -17,6 +17,7 @@ import xarray as xr
 from tqdm import tqdm
 
 import joanne
+from joanne import config, instrument
 from joanne.Level_2 import dicts
 
 reload(dicts)
@@ -28,13 +29,13 @@ warnings.filterwarnings(
 # %%
 def get_all_sondes_list(Platform):
 
-    directory = "/Users/geet/Documents/JOANNE/Data/Level_1/" + Platform + "/"
+    directory = config.get_directory("level_1") + Platform + "/"
     # directory where all sonde files are present
 
-    a_dir = "/Users/geet/Documents/JOANNE/Data/Level_0/" + Platform + "/All_A_files/"
+    a_dir = config.get_directory("level_0") + Platform + "/All_A_files/"
     # directory where all the A files are present
 
-    logs_directory = "/Users/geet/Documents/JOANNE/Data/QC/"
+    logs_directory = config.get_directory("qc")
     # directory to store logs and stats
 
     sonde_paths = sorted(glob.glob(directory + "*QC.nc"))
@@ -856,4 +857,147 @@ def get_status_ds_for_platform(Platform, save_dir):
     return to_save_ds
 
 
+@instrument.instrumented()
+def write_level_2_sonde(
+    Platform,
+    sonde_path,
+    status_ds,
+    save_directory=None,
+    a_dir=None,
+):
+    """
+    Input :
+        Platform : string
+                   'HALO' or 'P3'
+        sonde_path : string
+                     path to the Level-1 (ASPEN-processed) file of the sonde
+        status_ds : xarray dataset
+                    QC status of all sondes of the platform, see get_status_ds_for_platform()
+        save_directory : string
+                         directory where the Level-2 file is written; default the
+                         Level-2 directory of joanne.config
+        a_dir : string
+                directory with the A files of the platform; default from joanne.config
+    Output :
+        file_path : string
+                    path of the written Level-2 file; None if the sonde is not GOOD, in which
+                    case no file is written
+    """
+
+    if save_directory is None:
+        save_directory = config.get_directory("level_2")
+    if a_dir is None:
+        a_dir = config.get_directory("level_0") + Platform + "/All_A_files/"
+
+    with xr.open_dataset(sonde_path) as sonde:
+        return _write_level_2_sonde(
+            Platform, sonde_path, sonde, status_ds, save_directory, a_dir
+        )
+
+
+def _write_level_2_sonde(Platform, sonde_path, sonde, status_ds, save_directory, a_dir):
+    varname_L1 = ["height", "time", "wspd", "wdir", "tdry", "pres", "rh", "lat", "lon"]
+    varname_L2 = ["alt", "time", "wspd", "wdir", "ta", "p", "rh", "lat", "lon"]
+
+    file_time_str = sonde_path[-20:-5]
+    file_time = np.datetime64(
+        pd.to_datetime(file_time_str, format="%Y%m%d_%H%M%S"), "s"
+    )
+
+    status = status_ds.swap_dims({"sonde_id": "launch_time"}).sel(
+        launch_time=sonde.launch_time.values,
+        # method="nearest",
+        # tolerance="1s",
+    )
+
+    if status.qc_flag != "GOOD":
+        return None
+
+    # only GOOD sondes need their A file; non-GOOD sondes may have none
+    a_filepath = sorted(glob.glob(a_dir + "A" + file_time_str + "*"))[0]
+
+    # ht_indices = ~np.isnan(sonde.alt)
+    ht_indices = ~np.isnan(sonde.alt) & ~np.isnan(sonde.lat) & ~np.isnan(sonde.lon)
+    # retrieving non-NaN indices of geopotential height (sonde.alt)
+    # only time values at these indices will be used in Level-2 trajectory data;
+    # this means that only alternate u,v values are included in the Level-2 data
+    # PTU has 2 Hz measurement frequency, while GPS has a 4 Hz measurement frequency
+
+    ###----- Dimensions -----###
+
+    obs = np.arange(1, ht_indices.sum() + 1, 1)
+    # creating the observations dimension of the NC file
+
+    ###----- Variables -----###
+
+    variables = {}
+
+    variables["time"] = sonde.time[ht_indices].values
+    variables["alt"] = np.float32(sonde.alt[ht_indices].values)
+
+    ###--------- Unit Conversions --------###
+
+    if Platform == "HALO":
+        variables["rh"] = np.float32(sonde["rh"][ht_indices].values * 1.06 / 100)
+    elif Platform == "P3":
+        variables["rh"] = np.float32(sonde["rh"][ht_indices].values / 100)
+    variables["lat"] = np.float32(sonde["lat"][ht_indices].values)
+    variables["lon"] = np.float32(sonde["lon"][ht_indices].values)
+    variables["p"] = np.float32(sonde["pres"][ht_indices].values * 100)
+    variables["ta"] = np.float32(sonde["tdry"][ht_indices].values + 273.15)
+
+    for var1, var2 in zip(varname_L1, varname_L2):
+        if var2 not in variables.keys():
+            variables[var2] = np.float32(sonde[var1][ht_indices].values)
+
+    ###--------- Creating and populating dataset --------###
+
+    to_save_ds = xr.Dataset(coords={"time": obs})
+
+    for var in dicts.nc_meta.keys():
+        create_variable(to_save_ds, var, variables[var])
+
+    ### ---------- adding the sonde_id var to the dataset --------- #####
+    sonde_id = status.sonde_id.values
+    attrs = {
+        "descripion": "unique sonde ID",
+        "long_name": "sonde identifier",
+        "cf_role": "trajectory_id",
+    }
+    to_save_ds["sonde_id"] = xr.Variable([], sonde_id, attrs=attrs)
+
+    file_name = (
+        "EUREC4A_JOANNE"
+        + "_Dropsonde-RD41_"
+        + str(sonde_id)
+        + "_Level_2"
+        + "_v"
+        + str(joanne.__version__)
+        + ".nc"
+    )
+
+    comp = dict(config.get_compression(), _FillValue=np.finfo("float32").max)
+
+    encoding = {var: comp for var in to_save_ds.data_vars if var != "sonde_id"}
+    encoding["time"] = {"units": "seconds since 2020-01-01", "dtype": "float"}
+
+    nc_global_attrs = dicts.get_global_attrs(Platform, file_time, sonde)
+
+    for key in nc_global_attrs.keys():
+        to_save_ds.attrs[key] = nc_global_attrs[key]
+
+    flight_attrs = dicts.get_flight_attrs(a_filepath)
+
+    for key in flight_attrs:
+        to_save_ds.attrs[key] = flight_attrs[key]
+
+    ###--------- Saving dataset to NetCDF file --------###
+
+    to_save_ds.to_netcdf(
+        save_directory + file_name, mode="w", format="NETCDF4", encoding=encoding,
+    )
+
+    return save_directory + file_name
+
+
 # %%
@@ -12,6 +12,7 @@ import xarray as xr
 from joanne.Level_3 import fn_3 as f3
 from joanne.Level_3 import dicts as dicts
 import joanne
+from joanne import config
 
 warnings.filterwarnings(
     "ignore", module="metpy.calc.thermo", message="invalid value encountered"
@@ -21,76 +22,42 @@ reload(dicts)
 reload(f3)
 reload(joanne)
 # %%
-lv2_data_directory = (
-    "/Users/geet/Documents/JOANNE/Data/Level_2/"  # Level_2/"  # code_testing_data/"
-)
+lv2_data_directory = config.get_directory("level_2")
 
-lv3_dataset = f3.lv3_structure_from_lv2(lv2_data_directory)
+lv2_files = f3.retrieve_all_files(lv2_data_directory, file_ext="*.nc")
 
-# %%
-nc_data = {}
+lv3_dataset, lv3_p_dataset = f3.lv3_structure_from_lv2(lv2_files, pressure_levels=True)
 
-for var in dicts.list_of_vars:
-    if lv3_dataset[var].values.dtype == "float64":
-        nc_data[var] = np.float32(lv3_dataset[var].values)
-    else:
-        nc_data[var] = lv3_dataset[var].values
 # %%
-
-obs = np.arange(0, len(lv3_dataset.alt) * 10, 10, dtype="short")
-sonde_id = lv3_dataset.sonde_id.values
-
-to_save_ds = xr.Dataset(coords={"alt": obs, "sonde_id": sonde_id})
-
-for dim in dicts.dim_attrs:
-    to_save_ds[dim] = to_save_ds[dim].assign_attrs(dicts.dim_attrs[dim])
-
-for var in dicts.list_of_vars:
-    f3.create_variable(
-        to_save_ds, var, data=nc_data, dims=dicts.nc_dims, attrs=dicts.nc_attrs
-    )
-
-to_save_ds["alt_bnds"] = (
-    ["alt", "nv"],
-    np.array([f3.interpolation_bins[:-1], f3.interpolation_bins[1:]]).T.astype("int32"),
-)
-to_save_ds["alt_bnds"] = to_save_ds["alt_bnds"].assign_attrs(
-    {
-        # "long_name": "cell altitude_bounds",
-        "description": "cell interval bounds for altitude",
-        "_FillValue": False,
-        "comment": "(lower bound, upper bound]",
-        "units": "m",
-    }
-)
+to_save_ds = f3.get_lv3_to_save_dataset(lv3_dataset)
 
 file_name = (
     "EUREC4A_JOANNE_Dropsonde-RD41_" + "Level_3_v" + str(joanne.__version__) + ".nc"
 )
 
-save_directory = "/Users/geet/Documents/JOANNE/Data/Level_3/"  # Test_data/" #Level_3/"
+save_directory = config.get_directory("level_3")
 
-comp = dict(zlib=True, complevel=4, fletcher32=True, _FillValue=np.finfo("float32").max)
-
-encoding = {
-    var: comp
-    for var in to_save_ds.data_vars
-    if var not in ["platform_id", "sonde_id", "alt_bnds"]
-}
-encoding["launch_time"] = {"units": "seconds since 2020-01-01", "dtype": "int32"}
-encoding["interpolated_time"] = {
-    "units": "seconds since 2020-01-01",
-    "dtype": "int32",
-    "_FillValue": np.iinfo("int32").max,
-}
+f3.write_lv3_file(
+    to_save_ds,
+    save_directory + file_name,
+    lv2_fingerprints=f3.get_lv2_fingerprints(lv2_files),
+)
+# %%
+# Level-3 on pressure levels, with the same sondes as above
 
-for key in dicts.nc_global_attrs.keys():
-    to_save_ds.attrs[key] = dicts.nc_global_attrs[key]
+to_save_p_ds = f3.get_lv3_p_to_save_dataset(lv3_p_dataset)
 
-to_save_ds.to_netcdf(
-    save_directory + file_name, mode="w", format="NETCDF4", encoding=encoding
+p_file_name = (
+    "EUREC4A_JOANNE_Dropsonde-RD41_"
+    + "Level_3_pressure_v"
+    + str(joanne.__version__)
+    + ".nc"
 )
-# %%
 
+f3.write_lv3_file(to_save_p_ds, save_directory + p_file_name)
+# %%
+# To add new or changed Level-2 sondes to the existing Level-3 file without
+# gridding all sondes again, use instead:
+# f3.append_to_level_3(save_directory + file_name, lv2_data_directory)
 
 # %%
@@ -295,3 +295,70 @@ nc_global_attrs = {
     "reference": joanne.reference_study,
     "creation_time": str(datetime.datetime.utcnow()) + " UTC",
 }
+
+### Level-3 product on pressure levels
+
+p_dim_attrs = {
+    "p": {
+        "standard_name": "air_pressure",
+        "long_name": "atmospheric pressure",
+        "description": "pressure levels on to which the Level-2 data are binned, with bins centred on the levels in log(p)",
+        "units": "Pa",
+        "axis": "Z",
+        "positive": "down",
+        "bounds": "p_bnds",
+    },
+    "sonde_id": dim_attrs["sonde_id"],
+}
+
+list_of_p_vars = [
+    "launch_time",
+    "interpolated_time",
+    "alt",
+    "lat",
+    "lon",
+    "ta",
+    "rh",
+    "wspd",
+    "wdir",
+    "u",
+    "v",
+    "theta",
+    "q",
+    "low_height_flag",
+    "platform_id",
+    "flight_altitude",
+    "flight_lat",
+    "flight_lon",
+    "sonde_id",
+]
+
+nc_p_attrs = {
+    var: (
+        dict(
+            nc_attrs[var],
+            coordinates=nc_attrs[var]["coordinates"].replace(" alt ", " p "),
+        )
+        if "coordinates" in nc_attrs[var]
+        else nc_attrs[var].copy()
+    )
+    for var in list_of_p_vars
+}
+nc_p_attrs["alt"] = {
+    key: value for key, value in nc_p_attrs["alt"].items() if key != "axis"
+}
+nc_p_attrs["alt"]["coordinates"] = "launch_time sonde_id lon lat p interpolated_time"
+nc_p_attrs["interpolated_time"][
+    "description"
+] = "value of time (original independent dimension) averaged in pressure bins"
+
+nc_p_dims = {
+    var: [{"alt": "p"}.get(dim, dim) for dim in nc_dims[var]] for var in list_of_p_vars
+}
+nc_p_dims["alt"] = ["sonde_id", "p"]
+
+nc_p_global_attrs = dict(
+    nc_global_attrs,
+    title="EUREC4A JOANNE Level-3 on pressure levels",
+    product_id="Level-3 (pressure levels)",
+)
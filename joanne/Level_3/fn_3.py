@@ -1,8 +1,10 @@
 # %%
 import datetime
 import glob
+import hashlib
 import os.path
 import subprocess
+import tempfile
 import warnings
 from importlib import reload
 
@@ -10,11 +12,12 @@ import joanne
 import matplotlib.pyplot as plt
 import metpy.calc as mpcalc
 import metpy.interpolate as mpinterp
+import netCDF4
 import numpy as np
-import pandas as pd
 import requests
 import xarray as xr
 from eurec4a_snd.interpolate import postprocessing as pp
+from joanne import config, instrument, precision, reader
 from joanne.Level_3 import dicts
 from metpy import constants as mpconsts
 
@@ -38,6 +41,28 @@ max_gap_fill = (
     50  # Maximum data gap size that should be filled by interpolation (meters)
 )
 
+### Pressure levels for the Level-3 product on pressure coordinates
+
+pressure_grid = np.arange(25000, 102100, 100)  # Pa
+# Bins are centred on pressure_grid in log(p), i.e. edges are the geometric means of neighbouring levels
+_log_p = np.log(pressure_grid)
+pressure_bins = np.exp(
+    np.concatenate(
+        [
+            [_log_p[0] - (_log_p[1] - _log_p[0]) / 2],
+            (_log_p[:-1] + _log_p[1:]) / 2,
+            [_log_p[-1] + (_log_p[-1] - _log_p[-2]) / 2],
+        ]
+    )
+)  # Bins len(pressure_grid)+1; (a,b]; (Pa)
+max_gap_fill_pressure = (
+    500  # Maximum data gap size that should be filled by interpolation (Pa)
+)
+
+### Reference time; times are binned and gap-filled as seconds since time_epoch
+
+time_epoch = np.datetime64("2020-01-01", "ns")
+
 ### Defining functions
 
 
@@ -100,6 +125,184 @@ def strictly_increasing(L):
     return all(x < y for x, y in zip(L, L[1:]))
 
 
+def bin_time(time, coordinate, bins):
+    """
+    Input :
+
+        time : numpy datetime64 array with the times of the observations
+        coordinate : numpy array with the values of the binning coordinate
+                     (e.g. 'alt') at the observations
+        bins : bin edges, with bins as (a,b]
+
+    Output :
+
+        binned_time : float64 array of len(bins)-1 with the mean time of the
+        observations in each bin, as seconds since time_epoch; NaN for empty bins
+
+    Times are averaged as integer nanoseconds relative to the first observation,
+    so that no precision is lost in the sums
+    """
+    time = np.asarray(time).astype("datetime64[ns]")
+    n_bins = len(bins) - 1
+
+    bin_number = np.digitize(coordinate, bins, right=True) - 1
+    valid = (bin_number >= 0) & (bin_number < n_bins) & ~np.isnat(time)
+
+    if not valid.any():
+        return np.full(n_bins, np.nan)
+
+    reference = time[valid][0]
+    offset = (time[valid] - reference).astype("int64")
+
+    count = np.bincount(bin_number[valid], minlength=n_bins)
+    total = np.bincount(bin_number[valid], weights=offset, minlength=n_bins)
+
+    with np.errstate(invalid="ignore"):
+        mean_offset = total / count
+
+    return ((reference - time_epoch).astype("int64") + mean_offset) / 1e9
+
+
+def datetime_from_seconds(seconds):
+    """
+    Input :
+
+        seconds : float array of seconds since time_epoch; NaN for missing values
+
+    Output :
+
+        time : numpy datetime64[ns] array; NaT for missing values
+    """
+    seconds = np.asarray(seconds, dtype="float64")
+    time = np.full(seconds.shape, np.datetime64("NaT"), dtype="datetime64[ns]")
+
+    finite = np.isfinite(seconds)
+    time[finite] = time_epoch + np.round(seconds[finite] * 1e9).astype(
+        "int64"
+    ).astype("timedelta64[ns]")
+
+    return time
+
+
+def fill_gaps(values, coordinate, max_gap):
+    """
+    Input :
+
+        values : numpy array with the grid along the last axis; all other axes
+                 (e.g. variables, sondes) are filled independently
+        coordinate : monotonically increasing grid of the last axis,
+                     e.g. interpolation_grid
+        max_gap : no interpolation if gap between two datapoints is > max_gap
+
+    Output :
+
+        filled : values with NaNs linearly interpolated between the neighbouring
+        datapoints, wherever the gap between them is <= max_gap
+
+    Gives the same result as xarray's interpolate_na(max_gap=max_gap, use_coordinate=True),
+    but the gap lengths are computed only once for every pattern of NaNs, and all
+    profiles sharing that pattern are then filled together.
+    """
+    values = np.asarray(values)
+    x = np.asarray(coordinate, dtype="float64")
+
+    profiles = values.reshape(-1, values.shape[-1])
+    filled = profiles.copy()
+
+    patterns, pattern_of_profile = np.unique(
+        np.isnan(profiles), axis=0, return_inverse=True
+    )
+    pattern_of_profile = pattern_of_profile.ravel()
+
+    for pattern_id, nans in enumerate(patterns):
+
+        valid = np.flatnonzero(~nans)
+        if len(valid) < 2:
+            continue
+
+        # only NaNs between the first and last datapoint can be interpolated
+        missing = np.flatnonzero(nans[valid[0] : valid[-1]]) + valid[0]
+        nxt = valid[np.searchsorted(valid, missing)]
+        prev = valid[np.searchsorted(valid, missing) - 1]
+
+        to_fill = (x[nxt] - x[prev]) <= max_gap
+        if not to_fill.any():
+            continue
+        missing, prev, nxt = missing[to_fill], prev[to_fill], nxt[to_fill]
+
+        rows = np.flatnonzero(pattern_of_profile == pattern_id)[:, np.newaxis]
+        y_prev = profiles[rows, prev].astype("float64")
+        y_nxt = profiles[rows, nxt].astype("float64")
+
+        # same arithmetic as np.interp
+        slope = (y_nxt - y_prev) / (x[nxt] - x[prev])
+        interpolated = slope * (x[missing] - x[prev]) + y_prev
+        redo = np.isnan(interpolated)
+        if redo.any():
+            interpolated = np.where(
+                redo, slope * (x[missing] - x[nxt]) + y_nxt, interpolated
+            )
+            interpolated = np.where(
+                np.isnan(interpolated) & (y_prev == y_nxt), y_prev, interpolated
+            )
+
+        filled[rows, missing] = interpolated
+
+    return filled.reshape(values.shape)
+
+
+def fill_gaps_in_dataset(dataset, dim, max_gap):
+    """
+    Input :
+
+        dataset : Dataset with variables along dim, with dim as coordinate
+        dim : dimension along which gaps are to be filled, e.g. 'alt'
+        max_gap : no interpolation if gap between two datapoints is > max_gap
+
+    Output :
+
+        filled_dataset : copy of dataset with gaps in all floating-point variables
+        along dim filled with fill_gaps()
+
+    All variables are filled in a single call of fill_gaps()
+    """
+    filled_dataset = dataset.copy()
+
+    list_of_vars = [
+        var
+        for var in dataset.data_vars
+        if dim in dataset[var].dims and dataset[var].dtype.kind == "f"
+    ]
+    if len(list_of_vars) == 0:
+        return filled_dataset
+
+    n = len(dataset[dim])
+    arrays = [
+        np.moveaxis(dataset[var].values, dataset[var].get_axis_num(dim), -1)
+        for var in list_of_vars
+    ]
+    filled = fill_gaps(
+        np.concatenate([a.reshape(-1, n).astype("float64") for a in arrays]),
+        dataset[dim].values,
+        max_gap,
+    )
+
+    start = 0
+    for var, a in zip(list_of_vars, arrays):
+        stop = start + a.size // n
+        filled_dataset[var] = dataset[var].copy(
+            data=np.moveaxis(
+                filled[start:stop].reshape(a.shape).astype(a.dtype),
+                -1,
+                dataset[var].get_axis_num(dim),
+            )
+        )
+        start = stop
+
+    return filled_dataset
+
+
+@instrument.instrumented()
 def interp_along_height(
     dataset, height_limit=10000, vertical_spacing=10, max_gap=50, method="bin"
 ):
@@ -135,19 +338,16 @@ def interp_along_height(
         # )
     elif method == "bin":
 
+        # the means of the bins are accumulated in float64, and kept in working dtype
         new_interpolated_ds = dataset.groupby_bins(
             "alt",
             interpolation_bins,
             labels=interpolation_grid,
             restore_coord_dims=True,
-        ).mean()
+        ).mean(dtype="float64")
         # for some reason, the groupby does not bin lat,lon and time since they are coordinates
-        dataset["time"] = (
-            ["alt"],
-            dataset.time.values.astype(float),
-        )
         # adding them as extra variables
-        for coords in ["lat", "lon", "time"]:
+        for coords in ["lat", "lon"]:
             new_interpolated_ds[coords] = (
                 dataset[coords]
                 .groupby_bins(
@@ -156,29 +356,82 @@ def interp_along_height(
                     labels=interpolation_grid,
                     restore_coord_dims=False,
                 )
-                .mean()
+                .mean(dtype="float64")
             )
+        new_interpolated_ds = precision.as_working_dtype(new_interpolated_ds)
+        # time is binned as seconds since time_epoch, and converted back after filling gaps
+        new_interpolated_ds["time"] = (
+            ["alt_bins"],
+            bin_time(dataset.time.values, dataset.alt.values, interpolation_bins),
+        )
         new_interpolated_ds = new_interpolated_ds.transpose()
         new_interpolated_ds = new_interpolated_ds.rename({"alt_bins": "alt"})
 
-        new_interpolated_ds = new_interpolated_ds.interpolate_na(
-            "alt", max_gap=max_gap_fill, use_coordinate=True
+        new_interpolated_ds = fill_gaps_in_dataset(
+            new_interpolated_ds, "alt", max_gap=max_gap_fill
         )
 
         new_interpolated_ds["time"] = (
             ["alt"],
-            pd.DatetimeIndex(new_interpolated_ds.time.values),
+            datetime_from_seconds(new_interpolated_ds.time.values),
         )
-        new_interpolated_ds.encoding["time"] = {
-            "units": "seconds since 2020-01-01",
-            "dtype": "int32",
-            "_FillValue": np.iinfo("int32").max,
-        }
         new_interpolated_ds = new_interpolated_ds.rename({"time": "interpolated_time"})
 
     return new_interpolated_ds
 
 
+@instrument.instrumented()
+def interp_along_pressure(dataset, max_gap=max_gap_fill_pressure):
+    """
+    Input :
+
+        dataset : Dataset with variables along 'alt' dimension, 
+                  from ready_to_interpolate()
+        max_gap : no interpolation if gap between two datapoints is > max_gap; 
+        default = 500 Pa
+
+    Output :
+
+        new_interpolated_ds : New dataset with given dataset's variables 
+        binned on the pressure levels of pressure_grid, with 'p' as dimension 
+        and geopotential height 'alt' as a variable
+
+    Function to bin all values of a Level-2 sounding on to the fixed pressure levels
+    of pressure_grid, with bins centred on the levels in log(p). This uses the same
+    dataset as interp_along_height(), so q, theta, u and v need not be computed again.
+    The given dataset is not modified.
+    """
+
+    obs_dataset = (
+        dataset.reset_coords()
+        .drop_vars(["sonde_id", "time"], errors="ignore")
+        .rename({"alt": "obs"})
+    )
+    obs_dataset["alt"] = (["obs"], dataset.alt.values)
+
+    new_interpolated_ds = (
+        obs_dataset.drop_vars("p")
+        .groupby_bins(obs_dataset.p, pressure_bins, labels=pressure_grid)
+        .mean(dtype="float64")
+        .rename({"p_bins": "p"})
+    )
+    new_interpolated_ds = precision.as_working_dtype(new_interpolated_ds)
+    new_interpolated_ds["time"] = (
+        ["p"],
+        bin_time(dataset.time.values, dataset.p.values, pressure_bins),
+    )
+
+    new_interpolated_ds = fill_gaps_in_dataset(new_interpolated_ds, "p", max_gap=max_gap)
+
+    new_interpolated_ds["time"] = (
+        ["p"],
+        datetime_from_seconds(new_interpolated_ds.time.values),
+    )
+    new_interpolated_ds = new_interpolated_ds.rename({"time": "interpolated_time"})
+
+    return new_interpolated_ds
+
+
 def calc_q_from_rh(ds):
     """
     Input :
@@ -502,6 +755,7 @@ def add_cloud_flag(dataset):
     return dataset
 
 
+@instrument.instrumented()
 def pressure_interpolation(
     pressures, altitudes, output_altitudes, convergence_error=0.05
 ):
@@ -675,7 +929,8 @@ def ready_to_interpolate(file_path):
     # dataset_to_interpolate
     # )
 
-    return dataset_to_interpolate
+    # derived variables are float64 from the MetPy constants
+    return precision.as_working_dtype(dataset_to_interpolate)
 
 
 def get_N_and_m_values(interp_dataset, original_dataset, bin_length=10):
@@ -783,11 +1038,13 @@ def get_N_and_m_values(interp_dataset, original_dataset, bin_length=10):
     return interp_dataset
 
 
+@instrument.instrumented()
 def interpolate_for_level_3(
     file_path_OR_dataset,
     height_limit=10000,
     vertical_spacing=10,
     pressure_log_interp=True,
+    pressure_levels=False,
 ):
 
     """
@@ -797,14 +1054,20 @@ def interpolate_for_level_3(
                                if file path to Level-2 NC file is provided as string, 
                                dataset will be created using the ready_to_interpolate() function,
                                if dataset is provided, it will be used directly
+        pressure_levels : bool
+                          if True, the sounding is also binned on to the pressure levels
+                          of pressure_grid, using interp_along_pressure()
 
     Output :
 
         interpolated_dataset : xarray dataset
                                interpolated dataset
+        pressure_dataset : xarray dataset
+                           dataset on pressure levels; only returned if pressure_levels is True
 
     Function to interpolate a dataset with Level-2 data, in the format 
-    for Level-3 gridding
+    for Level-3 gridding. Floating point variables are returned in
+    the working dtype of joanne.precision
     """
 
     if type(file_path_OR_dataset) is str:
@@ -812,6 +1075,9 @@ def interpolate_for_level_3(
     else:
         dataset = file_path_OR_dataset
 
+    if pressure_levels is True:
+        pressure_dataset = interp_along_pressure(dataset)
+
     interpolated_dataset = interp_along_height(
         dataset, height_limit=height_limit, vertical_spacing=vertical_spacing
     )
@@ -849,7 +1115,91 @@ def interpolate_for_level_3(
     # interpolated_dataset = add_cloud_flag(interpolated_dataset)
     # interpolated_dataset = adding_static_stability_to_dataset(interpolated_dataset)
 
-    return interpolated_dataset
+    if pressure_levels is True:
+        pressure_dataset = substitute_T_and_RH_for_interpolated_dataset(
+            pressure_dataset
+        )
+        pressure_dataset = substitute_wdir_for_interpolated_dataset(pressure_dataset)
+
+        for var in [
+            "platform_id",
+            "flight_altitude",
+            "flight_lat",
+            "flight_lon",
+            "launch_time",
+            "low_height_flag",
+            "sonde_id",
+        ]:
+            pressure_dataset[var] = dataset[var]
+
+        return (
+            precision.as_working_dtype(interpolated_dataset),
+            precision.as_working_dtype(pressure_dataset),
+        )
+
+    return precision.as_working_dtype(interpolated_dataset)
+
+
+def get_interim_file_names(file_path):
+    """
+    Input :
+        file_path : string
+                    path of a Level-2 NC file
+    Output :
+        file_name, p_file_name : strings
+                                 names of the interim files of the gridded sonde, on
+                                 height and on pressure levels
+    """
+    file_name = (
+        "EUREC4A_JOANNE_Dropsonde-RD41_"
+        + str(file_path[file_path.find("RD41_") + 3 : file_path.find("RD41_") + 19])
+        + "Level_3_v"
+        + str(joanne.__version__)
+        + ".nc"
+    )
+    p_file_name = file_name.replace("Level_3_v", "Level_3_p_v")
+
+    return file_name, p_file_name
+
+
+def grid_to_interim_files(
+    file_path, save_directory=None, pressure_levels=False, **kwargs
+):
+    """
+    Input :
+        file_path : string
+                    path of a Level-2 NC file
+        save_directory : string
+                         directory of the interim files; default the Level-3 interim
+                         directory of joanne.config
+        pressure_levels : bool
+                          if True, the sonde is also gridded on pressure levels
+        **kwargs : passed on to interpolate_for_level_3()
+    Output :
+        interim_paths : list
+                        paths of the written interim files, on height (and pressure) levels
+
+    Function to grid a single sonde for Level-3; lv3_structure_from_lv2() reads these
+    interim files instead of gridding the sonde again
+    """
+    if save_directory is None:
+        save_directory = config.get_directory("level_3_interim")
+    os.makedirs(save_directory, exist_ok=True)
+
+    file_name, p_file_name = get_interim_file_names(file_path)
+
+    if pressure_levels is True:
+        interp_ds, p_interp_ds = interpolate_for_level_3(
+            file_path, pressure_levels=True, **kwargs
+        )
+        interp_ds.to_netcdf(save_directory + file_name)
+        p_interp_ds.to_netcdf(save_directory + p_file_name)
+
+        return [save_directory + file_name, save_directory + p_file_name]
+
+    interpolate_for_level_3(file_path, **kwargs).to_netcdf(save_directory + file_name)
+
+    return [save_directory + file_name]
 
 
 def concatenate_soundings(list_of_interpolated_dataset):
@@ -878,6 +1228,8 @@ def lv3_structure_from_lv2(
     height_limit=10000,
     vertical_spacing=10,
     pressure_log_interp=True,
+    use_interim_files=True,
+    pressure_levels=False,
 ):
     """
     Input :
@@ -886,9 +1238,18 @@ def lv3_structure_from_lv2(
                                      a list of file paths for all NC files in the directory is created,
                                      otherwise a list of file paths needed to be gridded can also be 
                                      provided directly
+        use_interim_files : bool
+                            if True, gridded sondes already stored as interim files are read
+                            instead of being gridded again
+        pressure_levels : bool
+                          if True, the Level-3 dataset on pressure levels is also created
+                          in the same gridding pass, see interpolate_for_level_3()
     Output :
         dataset : xarray dataset
-                  dataset with Level-3 structure
+                  dataset with Level-3 structure, sorted by launch_time
+        p_dataset : xarray dataset
+                    dataset with Level-3 structure on pressure levels, with the same
+                    sondes in the same order as dataset; only returned if pressure_levels is True
                   
     Function to create Level-3 gridded dataset from Level-2 files
     """
@@ -899,41 +1260,55 @@ def lv3_structure_from_lv2(
         list_of_files = directory_OR_list_of_files
 
     interp_list = [None] * len(list_of_files)
+    p_interp_list = [None] * len(list_of_files)
 
-    save_directory = "/Users/geet/Documents/JOANNE/Data/Level_3/Interim_files/"
+    save_directory = config.get_directory("level_3_interim")
 
     for id_, file_path in enumerate(tqdm(list_of_files)):
 
-        file_name = (
-            "EUREC4A_JOANNE_Dropsonde-RD41_"
-            + str(file_path[file_path.find("RD41_") + 3 : file_path.find("RD41_") + 19])
-            + "Level_3_v"
-            + str(joanne.__version__)
-            + ".nc"
-        )
-
-        if os.path.exists(save_directory + file_name):
-
-            interp_list[id_] = xr.open_dataset(save_directory + file_name)
+        file_name, p_file_name = get_interim_file_names(file_path)
 
+        if (
+            use_interim_files
+            and os.path.exists(save_directory + file_name)
+            and (
+                pressure_levels is False
+                or os.path.exists(save_directory + p_file_name)
+            )
+        ):
+            interim_paths = [save_directory + file_name]
+            if pressure_levels is True:
+                interim_paths.append(save_directory + p_file_name)
         else:
-
-            interp_list[id_] = interpolate_for_level_3(
+            interim_paths = grid_to_interim_files(
                 file_path,
+                save_directory=save_directory,
                 height_limit=height_limit,
                 vertical_spacing=vertical_spacing,
                 pressure_log_interp=pressure_log_interp,
+                pressure_levels=pressure_levels,
             )
 
-            interp_list[id_].to_netcdf(save_directory + file_name)
+        interp_list[id_] = xr.open_dataset(interim_paths[0])
+
+        if pressure_levels is True:
+            p_interp_list[id_] = xr.open_dataset(interim_paths[1])
 
     concat_list = []
-    for i in interp_list:
+    p_concat_list = []
+    for id_, i in enumerate(interp_list):
 
         if "ta" in i.var():
             concat_list.append(i)
+            if pressure_levels is True:
+                p_concat_list.append(p_interp_list[id_])
+
+    dataset = concatenate_soundings(concat_list).sortby("launch_time")
+
+    if pressure_levels is True:
+        p_dataset = concatenate_soundings(p_concat_list).sortby("launch_time")
 
-    dataset = concatenate_soundings(concat_list)
+        return dataset, p_dataset
 
     return dataset
 
@@ -950,4 +1325,417 @@ def create_variable(ds, var, data, dims=dicts.nc_dims, attrs=dicts.nc_attrs, **k
     return var
 
 
+def get_lv3_to_save_dataset(lv3_dataset):
+    """
+    Input :
+        lv3_dataset : xarray dataset
+                      dataset with Level-3 structure, from lv3_structure_from_lv2()
+    Output :
+        to_save_ds : xarray dataset
+                     dataset with Level-3 variables, attributes and global attributes,
+                     ready to be written to file with the encoding from get_lv3_encoding()
+    """
+    nc_data = {}
+
+    for var in dicts.list_of_vars:
+        if lv3_dataset[var].values.dtype == "float64":
+            nc_data[var] = np.float32(lv3_dataset[var].values)
+        else:
+            nc_data[var] = lv3_dataset[var].values
+
+    obs = np.arange(0, len(lv3_dataset.alt) * 10, 10, dtype="short")
+    sonde_id = lv3_dataset.sonde_id.values
+
+    to_save_ds = xr.Dataset(coords={"alt": obs, "sonde_id": sonde_id})
+
+    for dim in dicts.dim_attrs:
+        to_save_ds[dim] = to_save_ds[dim].assign_attrs(dicts.dim_attrs[dim])
+
+    for var in dicts.list_of_vars:
+        create_variable(
+            to_save_ds, var, data=nc_data, dims=dicts.nc_dims, attrs=dicts.nc_attrs
+        )
+
+    to_save_ds["alt_bnds"] = (
+        ["alt", "nv"],
+        np.array([interpolation_bins[:-1], interpolation_bins[1:]]).T.astype("int32"),
+    )
+    to_save_ds["alt_bnds"] = to_save_ds["alt_bnds"].assign_attrs(
+        {
+            # "long_name": "cell altitude_bounds",
+            "description": "cell interval bounds for altitude",
+            "_FillValue": False,
+            "comment": "(lower bound, upper bound]",
+            "units": "m",
+        }
+    )
+
+    for key in dicts.nc_global_attrs.keys():
+        to_save_ds.attrs[key] = dicts.nc_global_attrs[key]
+
+    return to_save_ds
+
+
+def get_lv3_p_to_save_dataset(p_dataset):
+    """
+    Input :
+        p_dataset : xarray dataset
+                    dataset with Level-3 structure on pressure levels,
+                    from lv3_structure_from_lv2(..., pressure_levels=True)
+    Output :
+        to_save_ds : xarray dataset
+                     dataset with Level-3 variables on pressure levels, attributes and
+                     global attributes, ready to be written to file with write_lv3_file()
+    """
+    nc_data = {}
+
+    for var in dicts.list_of_p_vars:
+        if p_dataset[var].values.dtype == "float64":
+            nc_data[var] = np.float32(p_dataset[var].values)
+        else:
+            nc_data[var] = p_dataset[var].values
+
+    levels = pressure_grid.astype("int32")
+    sonde_id = p_dataset.sonde_id.values
+
+    to_save_ds = xr.Dataset(coords={"p": levels, "sonde_id": sonde_id})
+
+    for dim in dicts.p_dim_attrs:
+        to_save_ds[dim] = to_save_ds[dim].assign_attrs(dicts.p_dim_attrs[dim])
+
+    for var in dicts.list_of_p_vars:
+        create_variable(
+            to_save_ds, var, data=nc_data, dims=dicts.nc_p_dims, attrs=dicts.nc_p_attrs
+        )
+
+    to_save_ds["p_bnds"] = (
+        ["p", "nv"],
+        np.array([pressure_bins[:-1], pressure_bins[1:]]).T.astype("float32"),
+    )
+    to_save_ds["p_bnds"] = to_save_ds["p_bnds"].assign_attrs(
+        {
+            "description": "cell interval bounds for pressure",
+            "_FillValue": False,
+            "comment": "(lower bound, upper bound]",
+            "units": "Pa",
+        }
+    )
+
+    for key in dicts.nc_p_global_attrs.keys():
+        to_save_ds.attrs[key] = dicts.nc_p_global_attrs[key]
+
+    return to_save_ds
+
+
+def get_lv3_encoding(to_save_ds):
+    """
+    Input :
+        to_save_ds : xarray dataset
+                     dataset from get_lv3_to_save_dataset() or get_lv3_p_to_save_dataset()
+    Output :
+        encoding : dict
+                   encoding of all variables for writing the Level-3 file
+    """
+    comp = dict(config.get_compression(), _FillValue=np.finfo("float32").max)
+
+    encoding = {
+        var: comp
+        for var in to_save_ds.data_vars
+        if var not in ["platform_id", "sonde_id", "alt_bnds", "p_bnds"]
+    }
+    # one chunk per sonde profile, so that single sondes can be read without decompressing others
+    for var in encoding:
+        if to_save_ds[var].ndim == 2 and to_save_ds[var].dims[0] == "sonde_id":
+            encoding[var] = dict(comp, chunksizes=(1, to_save_ds[var].shape[1]))
+
+    encoding["launch_time"] = {"units": "seconds since 2020-01-01", "dtype": "int32"}
+    # as for time in Level-2, without rounding to whole seconds
+    encoding["interpolated_time"] = dict(
+        encoding["interpolated_time"],
+        units="seconds since 2020-01-01",
+        dtype="float64",
+    )
+
+    return encoding
+
+
+@instrument.instrumented(count=instrument.count_along("sonde_id"))
+def write_lv3_file(to_save_ds, file_path, lv2_fingerprints=None):
+    """
+    Input :
+        to_save_ds : xarray dataset
+                     dataset from get_lv3_to_save_dataset() or get_lv3_p_to_save_dataset()
+        file_path : string
+                    path of the Level-3 NC file to be written
+        lv2_fingerprints : dict
+                           fingerprints of the Level-2 files, keyed by sonde_id,
+                           see get_lv2_fingerprints()
+    Output :
+        file_path : string
+                    path of the written Level-3 NC file
+
+    The file is written with 'sonde_id' as an unlimited dimension, so that sondes can
+    later be added with append_to_level_3(). The sidecar sonde index is written too.
+    """
+    to_save_ds.to_netcdf(
+        file_path,
+        mode="w",
+        format="NETCDF4",
+        encoding=get_lv3_encoding(to_save_ds),
+        unlimited_dims=["sonde_id"],
+    )
+
+    reader.write_sonde_index(to_save_ds, file_path, lv2_fingerprints=lv2_fingerprints)
+
+    return file_path
+
+
+def get_lv2_sonde_id(file_path):
+    """
+    Input :
+        file_path : string
+                    file path of a Level-2 NC file
+    Output :
+        sonde_id : string
+                   sonde_id of the sonde in the file
+    """
+    with xr.open_dataset(file_path) as lv2:
+        return str(lv2.sonde_id.values)
+
+
+def get_lv2_fingerprint(file_path):
+    """
+    Input :
+        file_path : string
+                    file path of a Level-2 NC file
+    Output :
+        fingerprint : string
+                      SHA-1 hash of the file's contents
+    """
+    with open(file_path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_lv2_fingerprints(list_of_files):
+    """
+    Input :
+        list_of_files : list
+                        file paths of Level-2 NC files
+    Output :
+        fingerprints : dict
+                       SHA-1 hash of each file's contents, keyed by the sonde_id
+                       in the file
+    """
+    return {
+        get_lv2_sonde_id(file_path): get_lv2_fingerprint(file_path)
+        for file_path in list_of_files
+    }
+
+
+def get_lv3_p_file_path(lv3_file_path):
+    """
+    Input :
+        lv3_file_path : string
+                        path to a Level-3 NC file
+    Output :
+        p_file_path : string
+                      path of the Level-3 NC file on pressure levels that is written
+                      with it, as by pipeline.assemble_level_3() and Level_3.py
+    """
+    return lv3_file_path.replace("Level_3_v", "Level_3_pressure_v")
+
+
+def insert_into_lv3_file(lv3_file_path, new_to_save_ds, lv2_fingerprints=None):
+    """
+    Input :
+        lv3_file_path : string
+                        path to an existing Level-3 NC file written by write_lv3_file()
+        new_to_save_ds : xarray dataset
+                         sondes to be inserted, from get_lv3_to_save_dataset() or
+                         get_lv3_p_to_save_dataset(); sondes already in the file are
+                         replaced
+        lv2_fingerprints : dict
+                           fingerprints of the Level-2 files of all sondes in the file
+                           after the insertion, see get_lv2_fingerprints()
+    Output :
+        lv3_file_path : string
+                        path of the updated Level-3 NC file
+
+    The sondes are inserted along the unlimited 'sonde_id' dimension, keeping the file
+    sorted by launch_time. Rows before the first inserted sonde are not rewritten, so for
+    sondes launched after all sondes already in the file, only the new rows are written.
+    """
+    index = reader.get_sonde_index(lv3_file_path)
+    new_sondes = list(new_to_save_ds.sonde_id.values)
+
+    with netCDF4.Dataset(lv3_file_path) as nc:
+        unlimited = nc.dimensions["sonde_id"].isunlimited()
+
+    if not unlimited:
+        # files written before append mode existed are rewritten once with an unlimited dimension
+        with xr.open_dataset(lv3_file_path, decode_coords=False) as old_ds:
+            old_ds = old_ds.drop_sel(
+                sonde_id=[s for s in new_sondes if s in old_ds.sonde_id.values]
+            ).load()
+
+        to_save_ds = xr.concat(
+            [new_to_save_ds, old_ds], dim="sonde_id", data_vars="minimal"
+        ).sortby("launch_time")
+
+        for var in to_save_ds.variables:
+            # masked integer flags are decoded as float, so dtypes are restored
+            to_save_ds[var] = to_save_ds[var].astype(new_to_save_ds[var].dtype)
+            to_save_ds[var].encoding = {}
+
+        write_lv3_file(to_save_ds, lv3_file_path, lv2_fingerprints=lv2_fingerprints)
+
+        return lv3_file_path
+
+    # merged order of the kept old rows and the new sondes by launch_time (old rows first on ties)
+    replaced = np.isin(index.sonde_id.values, new_sondes)
+    n_old, n_new = len(index.sonde_id), len(new_sondes)
+
+    launch_time = np.concatenate(
+        [
+            index.launch_time.values[~replaced],
+            new_to_save_ds.launch_time.values.astype("datetime64[ns]"),
+        ]
+    )
+    is_new = np.concatenate(
+        [np.zeros((~replaced).sum(), dtype=bool), np.ones(n_new, dtype=bool)]
+    )
+    source_row = np.concatenate([index.row.values[~replaced], np.arange(n_new)])
+
+    order = np.argsort(launch_time, kind="stable")
+    is_new, source_row = is_new[order], source_row[order]
+
+    # all rows before first_change stay where they are, everything after is (re)written
+    unchanged = (~is_new) & (source_row == np.arange(len(order)))
+    first_change = len(order) if unchanged.all() else int(np.argmin(unchanged))
+
+    # position of each row after first_change in [old rows after first_change, new rows]
+    take = np.where(
+        is_new[first_change:],
+        n_old - first_change + source_row[first_change:],
+        source_row[first_change:] - first_change,
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        new_file_path = os.path.join(tmp_dir, "new_sondes.nc")
+        new_to_save_ds.to_netcdf(
+            new_file_path,
+            mode="w",
+            format="NETCDF4",
+            encoding=get_lv3_encoding(new_to_save_ds),
+        )
+
+        # values are copied as stored (already encoded), as both files share the encoding
+        with netCDF4.Dataset(lv3_file_path, "a") as target, netCDF4.Dataset(
+            new_file_path
+        ) as source:
+            target.set_auto_maskandscale(False)
+            source.set_auto_maskandscale(False)
+
+            for var in target.variables:
+                if "sonde_id" not in target.variables[var].dimensions:
+                    continue
+
+                # the unlimited dimension grows with the first written variable,
+                # so old rows are read up to n_old explicitly
+                tail = np.concatenate(
+                    [
+                        target.variables[var][first_change:n_old],
+                        source.variables[var][:],
+                    ]
+                )
+                target.variables[var][first_change : len(order)] = tail[take]
+
+            target.setncattr("creation_time", new_to_save_ds.attrs["creation_time"])
+
+    with xr.open_dataset(lv3_file_path) as lv3_dataset:
+        reader.write_sonde_index(
+            lv3_dataset, lv3_file_path, lv2_fingerprints=lv2_fingerprints
+        )
+
+    return lv3_file_path
+
+
+def append_to_level_3(
+    lv3_file_path, directory_OR_list_of_files, p_file_path=None, **kwargs
+):
+    """
+    Input :
+        lv3_file_path : string
+                        path to an existing Level-3 NC file written by write_lv3_file()
+        directory_OR_list_of_files : string or list
+                                     directory of Level-2 NC files or list of their file paths
+        p_file_path : string
+                      path to the existing Level-3 NC file on pressure levels; default
+                      the one of lv3_file_path, see get_lv3_p_file_path(), if it exists
+        **kwargs : passed on to lv3_structure_from_lv2()
+    Output :
+        new_sondes : list
+                     sonde_ids that were gridded and inserted into the Level-3 files
+
+    Function to add new or changed Level-2 sondes to an existing Level-3 file, and to
+    the Level-3 file on pressure levels, without gridding the sondes already in them. A
+    sonde is gridded if it is not in the sonde index of the Level-3 file or if the
+    fingerprint of its Level-2 file has changed. The sondes are inserted with
+    insert_into_lv3_file()
+    """
+    if type(directory_OR_list_of_files) is str:
+        list_of_files = retrieve_all_files(directory_OR_list_of_files, file_ext="*.nc")
+    else:
+        list_of_files = directory_OR_list_of_files
+
+    if p_file_path is None:
+        p_file_path = get_lv3_p_file_path(lv3_file_path)
+        if p_file_path == lv3_file_path or not os.path.exists(p_file_path):
+            p_file_path = None
+
+    index = reader.get_sonde_index(lv3_file_path)
+
+    if "lv2_fingerprint" in index:
+        old_fingerprints = dict(zip(index.sonde_id.values, index.lv2_fingerprint.values))
+    else:
+        old_fingerprints = {sonde_id: "" for sonde_id in index.sonde_id.values}
+
+    lv2_fingerprints = {}
+    new_files = []
+
+    for file_path in list_of_files:
+        sonde_id = get_lv2_sonde_id(file_path)
+        lv2_fingerprints[sonde_id] = get_lv2_fingerprint(file_path)
+
+        # sondes indexed without a fingerprint ("") are taken as unchanged
+        if old_fingerprints.get(sonde_id) not in ["", lv2_fingerprints[sonde_id]]:
+            new_files.append(file_path)
+
+    fingerprints = dict(old_fingerprints, **lv2_fingerprints)
+
+    if len(new_files) == 0:
+        return []
+
+    new_lv3 = lv3_structure_from_lv2(
+        new_files,
+        use_interim_files=False,
+        pressure_levels=p_file_path is not None,
+        **kwargs,
+    )
+    creation_time = str(datetime.datetime.utcnow()) + " UTC"
+
+    if p_file_path is not None:
+        new_lv3, new_lv3_p = new_lv3
+
+        new_to_save_p_ds = get_lv3_p_to_save_dataset(new_lv3_p)
+        new_to_save_p_ds.attrs["creation_time"] = creation_time
+        insert_into_lv3_file(p_file_path, new_to_save_p_ds)
+
+    new_to_save_ds = get_lv3_to_save_dataset(new_lv3)
+    new_to_save_ds.attrs["creation_time"] = creation_time
+    insert_into_lv3_file(lv3_file_path, new_to_save_ds, lv2_fingerprints=fingerprints)
+
+    return list(new_to_save_ds.sonde_id.values)
+
+
 # %%
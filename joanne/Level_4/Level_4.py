@@ -1,5 +1,6 @@
 # %%
 import glob
+import os
 import time
 from datetime import date
 from importlib import reload
@@ -9,106 +10,167 @@ import xarray as xr
 import yaml
 
 import joanne
+from joanne import config, instrument
 from tqdm import tqdm
 
 from joanne.Level_4 import rgr_fn as rf
 from joanne.Level_4 import ready_ds_for_regression as prep
 from joanne.Level_4 import dicts
+from joanne.Level_4 import incremental as inc
 
-reload(prep)
-reload(rf)
-reload(dicts)
+if __name__ == "__main__":
+    reload(prep)
+    reload(rf)
+    reload(dicts)
+    reload(inc)
 # %%
-circles = prep.get_circles()
-prep.get_xy_coords_for_circles(circles)
+list_of_parameters = ["u", "v", "q", "ta", "p"]
 
-# %%
+file_name = (
+    "EUREC4A_JOANNE_Dropsonde-RD41_" + "Level_4_v" + str(joanne.__version__) + ".nc"
+)
 
-all_cir = xr.concat(circles, dim="circle")
 
-# %%
-for par in tqdm(["u", "v", "q", "ta", "p"]):
+def make_level_4(
+    lv3_file_path=None,
+    save_directory=None,
+    list_of_parameters=list_of_parameters,
+    method="ols",
+    min_points=6,
+    **robust_kwargs,
+):
+    """
+    Input :
+        lv3_file_path : string
+                        Level-3 file; default the latest version in the Level-3
+                        directory, see ready_ds_for_regression.get_lv3_filename()
+        save_directory : string
+                         directory of the Level-4 file; default from joanne.config
+        list_of_parameters : list
+                             parameters on which regression is carried out
+        method, min_points, **robust_kwargs : regression settings, see
+                                              rgr_fn.fit2d_for_parameters()
+    Output :
+        file_path : string
+                    Level-4 file
+
+    Only circles whose fingerprint is not in the existing Level-4 file are recomputed,
+    see joanne.Level_4.incremental; if no circle changed, the file is left as it is
+    """
+    if save_directory is None:
+        save_directory = config.get_directory("level_4")
+
+    file_path = os.path.join(save_directory, file_name)
+
+    all_cir = prep.get_circles(lv3_filename=lv3_file_path)
+
+    # only circles whose fingerprint is not in the existing Level-4 file are recomputed
+    fingerprints = inc.get_circle_fingerprints(
+        all_cir, list_of_parameters, method, min_points, **robust_kwargs
+    )
 
-    mean_var_name = par
-    var_dx_name = "d" + par + "dx"
-    var_dy_name = "d" + par + "dy"
+    if os.path.exists(file_path):
+        with xr.open_dataset(file_path) as old_lv4:
+            old_lv4 = old_lv4.load()
+    else:
+        old_lv4 = None
 
-    (
-        all_cir[mean_var_name],
-        all_cir[var_dx_name],
-        all_cir[var_dy_name],
-        all_cir[par + "_sounding"],
-    ) = rf.fit2d_xr(all_cir.dx, all_cir.dy, all_cir[par], ["sounding"], ["sounding"],)
+    changed = inc.get_changed_circles(fingerprints, old_lv4)
 
-lv4_dataset = rf.get_circle_products(all_cir)
-# %%
+    up_to_date = old_lv4 is None or len(fingerprints) == len(old_lv4.circle)
 
-lv4_dataset = lv4_dataset.drop("sounding")
-# important to remove launch_time as dim and duplicate sounding variable
+    if not changed.any() and up_to_date:
+        print("Level-4 is up to date, no circles to recompute")
+        return file_path
 
-# %%
-# nc_data = {}
+    if changed.any():
+        print(f"Recomputing {changed.sum()}/{len(changed)} circles ...")
 
-# for var in dicts.list_of_vars:
-#     if var not in ["platform", "segment_id", "sonde_id", "circle_time"]:
-#         nc_data[var] = np.float32(lv4_dataset[var].values)
+        all_cir = all_cir.isel(circle=np.flatnonzero(changed))
+        all_cir["circle_fingerprint"] = (["circle"], fingerprints[changed])
 
-#     elif var in ["platform", "segment_id", "sonde_id"]:
-#         nc_data[var] = lv4_dataset[var].values
+        prep.get_xy_coords_for_circles(all_cir)
 
-#     elif var == "circle_time":
-#         nc_data[var] = lv4_dataset[var].values.astype(float) / 1e9
+        all_cir = rf.fit2d_for_parameters(
+            all_cir,
+            list_of_parameters,
+            method=method,
+            min_points=min_points,
+            **robust_kwargs,
+        )
 
-#     else:
-#         nc_data[var] = lv4_dataset[var].values
-nc_data = {}
+        lv4_dataset = rf.get_circle_products(all_cir)
 
-for var in dicts.list_of_vars:
-    if lv4_dataset[var].values.dtype == "float64":
-        nc_data[var] = np.float32(lv4_dataset[var].values)
-    else:
-        nc_data[var] = lv4_dataset[var].values
-# %%
+        lv4_dataset = lv4_dataset.drop("sounding")
+        # important to remove launch_time as dim and duplicate sounding variable
 
-alt = lv4_dataset.alt.values
-sounding = lv4_dataset.sounding.values
-circle = lv4_dataset.circle.values
+        # nc_data = {}
 
-to_save_ds = xr.Dataset(coords={"alt": alt, "sounding": sounding, "circle": circle})
+        # for var in dicts.list_of_vars:
+        #     if var not in ["platform", "segment_id", "sonde_id", "circle_time"]:
+        #         nc_data[var] = np.float32(lv4_dataset[var].values)
 
-for var in dicts.list_of_vars:
-    prep.create_variable(
-        to_save_ds, var, data=nc_data, dims=dicts.nc_dims, attrs=dicts.nc_attrs
-    )
+        #     elif var in ["platform", "segment_id", "sonde_id"]:
+        #         nc_data[var] = lv4_dataset[var].values
 
-file_name = (
-    "EUREC4A_JOANNE_Dropsonde-RD41_" + "Level_4_v" + str(joanne.__version__) + ".nc"
-)
+        #     elif var == "circle_time":
+        #         nc_data[var] = lv4_dataset[var].values.astype(float) / 1e9
 
-save_directory = "/Users/geet/Documents/JOANNE/Data/Level_4/"
+        #     else:
+        #         nc_data[var] = lv4_dataset[var].values
+        nc_data = {}
 
-comp = dict(zlib=True, complevel=4, fletcher32=True, _FillValue=np.finfo("float32").max)
+        for var in dicts.list_of_vars:
+            if lv4_dataset[var].values.dtype == "float64":
+                nc_data[var] = np.float32(lv4_dataset[var].values)
+            else:
+                nc_data[var] = lv4_dataset[var].values
 
-encoding = {}
+        alt = lv4_dataset.alt.values
+        sounding = lv4_dataset.sounding.values
+        circle = lv4_dataset.circle.values
 
-encoding = {
-    var: comp
-    for var in to_save_ds.data_vars
-    if var not in ["platform_id", "segment_id", "sonde_id"]
-}
+        to_save_ds = xr.Dataset(
+            coords={"alt": alt, "sounding": sounding, "circle": circle}
+        )
 
-encoding["circle_time"] = {"units": "seconds since 2020-01-01"}
+        for var in dicts.list_of_vars:
+            prep.create_variable(
+                to_save_ds, var, data=nc_data, dims=dicts.nc_dims, attrs=dicts.nc_attrs
+            )
 
-# to_save_ds.encoding["circle_time"] = {
-#     "units": "seconds since 2020-01-01",
-# "dtype" :'datetime64'
-# }
+        # the recomputed circles replace their old versions in the existing Level-4 file
+        to_save_ds = inc.splice_level_4(to_save_ds, old_lv4, fingerprints, changed)
+    else:
+        # circles were only removed, so the old circles are written without them
+        to_save_ds = inc.splice_level_4(None, old_lv4, fingerprints, changed)
 
-for key in dicts.nc_global_attrs.keys():
-    to_save_ds.attrs[key] = dicts.nc_global_attrs[key]
+    comp = dict(config.get_compression(), _FillValue=np.finfo("float32").max)
+
+    encoding = {}
+
+    encoding = {
+        var: comp
+        for var in to_save_ds.data_vars
+        if var not in ["platform_id", "segment_id", "sonde_id", "circle_fingerprint"]
+    }
+
+    encoding["circle_time"] = {"units": "seconds since 2020-01-01"}
+
+    # to_save_ds.encoding["circle_time"] = {
+    #     "units": "seconds since 2020-01-01",
+    # "dtype" :'datetime64'
+    # }
+
+    for key in dicts.nc_global_attrs.keys():
+        to_save_ds.attrs[key] = dicts.nc_global_attrs[key]
+
+    with instrument.timed("write_level_4", n_items=len(to_save_ds.circle)):
+        to_save_ds.to_netcdf(file_path, mode="w", format="NETCDF4", encoding=encoding)
+
+    return file_path
 
-to_save_ds.to_netcdf(
-    save_directory + file_name, mode="w", format="NETCDF4", encoding=encoding
-)
 
 # %%
+if __name__ == "__main__":
+    make_level_4()
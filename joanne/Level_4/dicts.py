@@ -36,6 +36,7 @@ list_of_vars = [
     "dudy",
     # "sondes_regressed",
     "segment_id",
+    "circle_fingerprint",
     "sonde_id",
     "v",
     "dvdx",
@@ -221,6 +222,11 @@ nc_attrs = {
         "cf_role": "trajectory_id",
         "units": "",
     },
+    "circle_fingerprint": {
+        "description": "SHA-1 hash of the circle's member sondes, their Level-3 data, segment bounds, regressed parameters and JOANNE version",
+        "long_name": "circle fingerprint",
+        "units": "",
+    },
     # "flight_lat": {
     #     "standard_name": "latitude",
     #     "long_name": "latitude of the aircraft when the dropsonde was launched",
@@ -498,6 +504,7 @@ nc_dims = {
     "sounding": ["sounding"],
     "circle": ["circle"],
     "segment_id": ["circle"],
+    "circle_fingerprint": ["circle"],
     "launch_time": ["circle", "sounding"],
     "sonde_id": ["circle", "sounding"],
     "alt": ["alt"],
@@ -0,0 +1,151 @@
+# %% Module to rebuild Level-4 incrementally, recomputing only circles that changed
+import hashlib
+
+import numpy as np
+import xarray as xr
+
+import joanne
+from joanne import precision
+
+# %%
+
+
+def get_circle_fingerprints(
+    circles,
+    list_of_parameters=["u", "v", "q", "ta", "p"],
+    method="ols",
+    min_points=6,
+    **robust_kwargs,
+):
+    """
+    Input :
+        circles : xarray dataset
+                  sondes of all circles gathered from Level-3, as from
+                  ready_ds_for_regression.get_circles(), i.e. before any Level-4
+                  variables are added
+        list_of_parameters : list
+                             parameters on which regression is carried out
+        method, min_points, **robust_kwargs : regression settings, see
+                                              rgr_fn.fit2d_for_parameters()
+    Output :
+        fingerprints : numpy array of strings
+                       SHA-1 hash for every circle of everything its Level-4 products
+                       depend on
+
+    The fingerprint of a circle covers the JOANNE version, the working dtype (see
+    joanne.precision), the regressed parameters and the regression settings, its
+    segment_id and segment bounds (if available), the sonde_ids of its member sondes
+    and the Level-3 values of these sondes (all numeric variables along 'sounding')
+    """
+    common = hashlib.sha1()
+    common.update(str(joanne.__version__).encode())
+    common.update(",".join(list_of_parameters).encode())
+    common.update(f"working_dtype={precision.get_working_dtype()};".encode())
+    common.update(f"method={method};min_points={min_points};".encode())
+    for key in sorted(robust_kwargs):
+        common.update(f"{key}={robust_kwargs[key]!r};".encode())
+
+    circles = circles.transpose("circle", "sounding", ...)
+
+    content_vars = [
+        var
+        for var in sorted(circles.data_vars)
+        if "sounding" in circles[var].dims and circles[var].dtype.kind in "biufmM"
+    ]
+    circle_vars = [
+        var
+        for var in ["segment_id", "segment_start", "segment_end"]
+        if var in circles.variables
+    ]
+
+    values = {
+        var: np.ascontiguousarray(circles[var].values)
+        for var in content_vars + circle_vars
+    }
+    sonde_ids = circles.sonde_id.values
+
+    fingerprints = []
+
+    for c in range(len(circles.circle)):
+        fingerprint = common.copy()
+
+        for var in circle_vars:
+            fingerprint.update(f"{var}={values[var][c]};".encode())
+
+        members = [str(s) for s in sonde_ids[c] if isinstance(s, str)]
+        fingerprint.update(("sonde_id=" + ",".join(members) + ";").encode())
+
+        for var in content_vars:
+            fingerprint.update(var.encode())
+            fingerprint.update(values[var][c].tobytes())
+
+        fingerprints.append(fingerprint.hexdigest())
+
+    return np.array(fingerprints)
+
+
+def get_changed_circles(fingerprints, old_lv4=None):
+    """
+    Input :
+        fingerprints : numpy array of strings
+                       fingerprints of all circles, see get_circle_fingerprints()
+        old_lv4 : xarray dataset
+                  existing Level-4 product with 'circle_fingerprint'; if None or
+                  without fingerprints, all circles are taken as changed
+    Output :
+        changed : numpy array of bool
+                  circles whose fingerprint is not in the existing Level-4 product
+    """
+    if old_lv4 is None or "circle_fingerprint" not in old_lv4:
+        return np.full(len(fingerprints), True)
+
+    return ~np.isin(fingerprints, old_lv4.circle_fingerprint.values)
+
+
+def splice_level_4(new_lv4, old_lv4, fingerprints, changed):
+    """
+    Input :
+        new_lv4 : xarray dataset
+                  Level-4 product (to be saved) of only the changed circles, in the
+                  order of the circles in fingerprints
+        old_lv4 : xarray dataset
+                  existing Level-4 product with 'circle_fingerprint', or None
+        fingerprints : numpy array of strings
+                       fingerprints of all circles
+        changed : numpy array of bool
+                  from get_changed_circles()
+    Output :
+        lv4 : xarray dataset
+              Level-4 product of all circles, in the order of fingerprints, with the
+              unchanged circles taken from old_lv4 and their 'circle_fingerprint'
+
+    Circles in old_lv4 that are no longer in fingerprints are dropped
+    """
+    if not changed.any() and old_lv4 is None:
+        raise ValueError("no circles to splice into a Level-4 product")
+
+    parts = []
+    if changed.any():
+        parts.append(
+            new_lv4.assign(circle_fingerprint=("circle", fingerprints[changed]))
+        )
+
+    if not changed.all():
+        old_row = {fp: row for row, fp in enumerate(old_lv4.circle_fingerprint.values)}
+        unchanged_rows = [old_row[fp] for fp in fingerprints[~changed]]
+        parts.append(old_lv4.isel(circle=unchanged_rows))
+
+    # position of every circle in the concatenation of [changed, unchanged] circles
+    take = np.empty(len(fingerprints), dtype="int64")
+    take[changed] = np.arange(changed.sum())
+    take[~changed] = changed.sum() + np.arange((~changed).sum())
+
+    lv4 = xr.concat(
+        [part.drop_vars("circle", errors="ignore") for part in parts],
+        dim="circle",
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+    ).isel(circle=take)
+
+    return lv4.assign_coords(circle=np.arange(len(fingerprints)))
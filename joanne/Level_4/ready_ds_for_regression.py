@@ -1,91 +1,107 @@
 # %%
-import yaml
 import glob
+import re
 import xarray as xr
 import numpy as np
 from packaging import version
 
-from datetime import date
 import datetime
 from pylab import cos
 import joanne
+from joanne import config, instrument, precision, reader, segments
 from joanne.Level_4 import dicts
-import circle_fit as cf
 
 # %%
 
-yaml_directory = "/Users/geet/Documents/JOANNE/joanne/flight_segments/"
-lv3_directory = "/Users/geet/Documents/JOANNE/Data/Level_3/"
 
-lv3_files = sorted(
-    glob.glob(lv3_directory + f"EUREC4A_JOANNE_Dropsonde-RD41_Level_3_v*.nc")
-)
 
-vers = [None] * len(lv3_files)
+def get_lv3_filename(lv3_directory=None):
+    """
+    Input :
+        lv3_directory : string
+                        directory of the Level-3 files; default from joanne.config
+    Output :
+        lv3_filename : string
+                       path of the Level-3 file with the latest version
+    """
+    if lv3_directory is None:
+        lv3_directory = config.get_directory("level_3")
 
-for n, i in enumerate(lv3_files):
-    vers[n] = version.parse(i)
+    lv3_files = sorted(
+        glob.glob(lv3_directory + f"EUREC4A_JOANNE_Dropsonde-RD41_Level_3_v*.nc")
+    )
+    # the sidecar sonde indices match the pattern too
+    lv3_files = [i for i in lv3_files if not i.endswith("_sonde_index.nc")]
+
+    if len(lv3_files) == 0:
+        raise FileNotFoundError(f"no Level-3 file in {lv3_directory}")
+
+    vers = [
+        version.parse(re.search(r"Level_3_v(.+)\.nc$", i).group(1)) for i in lv3_files
+    ]
 
-lv3_filename = str(max(vers))
+    return lv3_files[vers.index(max(vers))]
 
 
-def get_level3_dataset(lv3_directory=lv3_directory, lv3_filename=lv3_filename):
+def get_level3_dataset(lv3_directory=None, lv3_filename=None):
+    if lv3_filename is None:
+        lv3_filename = get_lv3_filename(lv3_directory)
+
     return xr.open_dataset(lv3_filename)
 
 
-def get_circle_times_from_yaml(yaml_directory=yaml_directory):
-    allyamlfiles = sorted(glob.glob(yaml_directory + "*.yaml"))
+def get_circle_times_from_yaml(yaml_directory=None):
+    """
+    Input :
+        yaml_directory : string
+                         directory of the YAML files; default from joanne.config
+    Output :
+        sonde_ids, circle_times, flight_date, platform_name, segment_id : lists
+            for every flight (YAML file), the GOOD sonde_ids, (start, end), and
+            segment_id of its circles with at least 6 GOOD sondes, and the flight's
+            date and platform
+
+    The YAML files are read through the cached segment catalogue, see
+    joanne.segments.get_segment_catalogue()
+    """
+    if yaml_directory is None:
+        yaml_directory = config.get_directory("yaml")
+
+    catalogue = segments.get_segment_catalogue(
+        yaml_directory,
+        cache_path=config.get_directory("cache") + "segment_catalogue.nc",
+    )
+
+    rows = segments.query_segments(catalogue, kind="circle", min_good_sondes=6)
+    good_sonde_ids = segments.get_good_sonde_ids(catalogue, rows)
+    flight_of_row = catalogue.flight_row.values[rows]
 
     circle_times = []
     sonde_ids = []
-    flight_date = []
-    platform_name = []
     segment_id = []
 
-    for i in allyamlfiles:
-        with open(i) as source:
-            flightinfo = yaml.load(source, Loader=yaml.SafeLoader)
+    for flight in range(len(catalogue.flight)):
+        in_flight = np.flatnonzero(flight_of_row == flight)
 
         circle_times.append(
             [
-                (c["start"], c["end"])
-                for c in flightinfo["segments"]
-                if "circle" in c["kinds"]
-                if len(c["dropsondes"]["GOOD"]) >= 6
+                (catalogue.start.values[rows[n]], catalogue.end.values[rows[n]])
+                for n in in_flight
             ]
         )
+        sonde_ids.append([good_sonde_ids[n] for n in in_flight])
+        segment_id.append([catalogue.segment_id.values[rows[n]] for n in in_flight])
 
-        sonde_ids.append(
-            [
-                c["dropsondes"]["GOOD"]
-                for c in flightinfo["segments"]
-                if "circle" in c["kinds"]
-                if len(c["dropsondes"]["GOOD"]) >= 6
-            ]
-        )
-
-        segment_id.append(
-            [
-                (c["segment_id"])
-                for c in flightinfo["segments"]
-                if "circle" in c["kinds"]
-                if len(c["dropsondes"]["GOOD"]) >= 6
-            ]
-        )
-
-        if "HALO" in i:
-            platform_name.append("HALO")
-        elif "P3" in i:
-            platform_name.append("P3")
-        else:
-            platform_name.append("")
-
-        flight_date.append(np.datetime64(date.strftime(flightinfo["date"], "%Y-%m-%d")))
+    flight_date = list(catalogue.flight_date.values.astype("datetime64[D]"))
+    platform_name = list(catalogue.flight_platform.values)
 
     return sonde_ids, circle_times, flight_date, platform_name, segment_id
 
 
-def dim_ready_ds(ds_lv3=get_level3_dataset()):
+def dim_ready_ds(ds_lv3=None):
+
+    if ds_lv3 is None:
+        ds_lv3 = get_level3_dataset()
 
     dims_to_drop = ["sounding"]
 
@@ -98,14 +114,89 @@ def dim_ready_ds(ds_lv3=get_level3_dataset()):
     return all_sondes
 
 
+def get_circle_gather_index(all_sonde_ids, circle_sonde_ids, n_sounding=13):
+    """
+    Input :
+        all_sonde_ids : array
+                        sonde_ids along the 'sonde_id' dimension of Level-3
+        circle_sonde_ids : list of lists
+                           sonde_ids of the sondes in every circle
+        n_sounding : int
+                     length of the padded 'sounding' dimension
+    Output :
+        gather_index : numpy array of int, shape (circle, n_sounding)
+                       row of every sonde of every circle along 'sonde_id' in Level-3;
+                       -1 where the circle is padded
+    """
+    row_of_sonde = {sonde_id: row for row, sonde_id in enumerate(all_sonde_ids)}
+
+    gather_index = np.full((len(circle_sonde_ids), n_sounding), -1)
+
+    for c, sonde_ids in enumerate(circle_sonde_ids):
+        gather_index[c, : len(sonde_ids)] = [row_of_sonde[s] for s in sonde_ids]
+
+    return gather_index
+
+
+def gather_circles(ds_lv3, gather_index):
+    """
+    Input :
+        ds_lv3 : xarray dataset
+                 Level-3 dataset with 'sonde_id' dimension
+        gather_index : numpy array of int, shape (circle, sounding)
+                       from get_circle_gather_index()
+    Output :
+        circles : xarray dataset
+                  all circles, with 'sonde_id' replaced by the 'circle' and 'sounding'
+                  dimensions; padded soundings are NaN (NaT for times)
+
+    All variables are gathered from Level-3 in a single indexing step
+    """
+    padded = gather_index < 0
+
+    circles = ds_lv3.isel(
+        sonde_id=xr.DataArray(
+            np.where(padded, 0, gather_index), dims=("circle", "sounding")
+        )
+    )
+
+    not_padded = xr.DataArray(~padded, dims=("circle", "sounding"))
+
+    for var in circles.data_vars:
+        if "sounding" in circles[var].dims:
+            circles[var] = circles[var].where(not_padded)
+
+    circles = circles.assign_coords(
+        sonde_id=circles.sonde_id.where(not_padded),
+        sounding=np.arange(0, gather_index.shape[1], 1, dtype="int"),
+    )
+
+    return circles
+
+
+@instrument.instrumented()
 def get_circles(
-    lv3_directory=lv3_directory,
-    lv3_filename=lv3_filename,
+    lv3_directory=None,
+    lv3_filename=None,
     # platform="HALO",
-    yaml_directory=yaml_directory,
+    yaml_directory=None,
 ):
-
-    ds_fn = get_level3_dataset(lv3_directory, lv3_filename)
+    """
+    Input :
+        lv3_directory, lv3_filename : strings
+                                      Level-3 file; default the latest version in the
+                                      Level-3 directory, see get_lv3_filename()
+        yaml_directory : string
+                         directory of the YAML files; default from joanne.config
+    Output :
+        circles : xarray dataset
+                  sondes of all circles from the flight segments, gathered from Level-3
+                  along the 'circle' and 'sounding' (padded to 13) dimensions, with the
+                  segment_id, segment_start and segment_end of every circle
+
+    Only the Level-3 rows of the sondes in these circles are read, see
+    joanne.reader.open_level_3()
+    """
 
     (
         sonde_ids,
@@ -115,26 +206,27 @@ def get_circles(
         segment_id,
     ) = get_circle_times_from_yaml(yaml_directory)
 
-    circles = []
-
-    for i in range(len(flight_date)):
-        for j in range(len(circle_times[i])):
-            if len(sonde_ids[i]) != 0:
-                circles.append(ds_fn.sel(sonde_id=sonde_ids[i][j]))
-                # .swap_dims(
-                # {"sonde_id": "sonde_id"}
-                # )
-                # )
+    circle_sonde_ids = [ids for flight_ids in sonde_ids for ids in flight_ids]
+    circle_segment_ids = [s for flight_ids in segment_id for s in flight_ids]
+    circle_bounds = np.array(
+        [bounds for flight_times in circle_times for bounds in flight_times],
+        dtype="datetime64[ns]",
+    ).reshape(-1, 2)
 
-            circles[-1]["segment_id"] = segment_id[i][j]
+    if lv3_filename is None:
+        lv3_filename = get_lv3_filename(lv3_directory)
 
-            circles[-1] = circles[-1].pad(
-                sonde_id=(0, 13 - int(len(circles[-1].sonde_id))), mode="constant"
-            )
+    ds_fn = reader.open_level_3(
+        lv3_filename,
+        sonde_ids=np.unique([s for ids in circle_sonde_ids for s in ids]),
+    )
 
-            circles[-1]["sounding"] = (["sonde_id"], np.arange(0, 13, 1, dtype="int"))
+    gather_index = get_circle_gather_index(ds_fn.sonde_id.values, circle_sonde_ids)
 
-            circles[-1] = circles[-1].swap_dims({"sonde_id": "sounding"})
+    circles = gather_circles(ds_fn, gather_index)
+    circles["segment_id"] = (["circle"], circle_segment_ids)
+    circles["segment_start"] = (["circle"], circle_bounds[:, 0])
+    circles["segment_end"] = (["circle"], circle_bounds[:, 1])
 
     return circles
 
@@ -156,57 +248,151 @@ def reswap_launchtime_sounding(circle):
 # %%
 
 
+def fit_circles(x, y, min_points=5, refine=True, max_iter=50, tol=1e-10):
+    """
+    Input :
+        x, y : numpy arrays
+               x and y coordinates (in m) of the points on the circles. shape: (...,M)
+               all points along the M dimension belong to the same circle, all other
+               dimensions are for different circles; NaNs are ignored
+        min_points : int
+                     circles with fewer valid points are NaN
+        refine : bool
+                 if True, the algebraic fit is refined with Gauss-Newton iterations
+                 to the geometric least-squares fit, as in circle_fit.least_squares_circle
+        max_iter, tol : int, float
+                        maximum number of refinement iterations, and relative change
+                        of the centre at which the iterations stop
+    Output :
+        xc, yc, r : numpy arrays
+                    centre and radius of the fitted circles. all shapes: (...)
+
+    The algebraic (Kasa) fit is solved from masked sums for all circles at once
+    """
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = valid.sum(axis=-1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = np.where(valid, x, 0).sum(axis=-1) / n
+        y_mean = np.where(valid, y, 0).sum(axis=-1) / n
+
+        u = np.where(valid, x - x_mean[..., np.newaxis], 0)
+        v = np.where(valid, y - y_mean[..., np.newaxis], 0)
+
+        suu = (u * u).sum(axis=-1)
+        svv = (v * v).sum(axis=-1)
+        suv = (u * v).sum(axis=-1)
+        rhs_u = ((u * u + v * v) * u).sum(axis=-1) / 2
+        rhs_v = ((u * u + v * v) * v).sum(axis=-1) / 2
+
+        det = suu * svv - suv * suv
+        det = np.where((n < min_points) | ~(det > 1e-10 * suu * svv), np.nan, det)
+
+        uc = (svv * rhs_u - suv * rhs_v) / det
+        vc = (suu * rhs_v - suv * rhs_u) / det
+
+        if refine:
+            n_ = n[..., np.newaxis]
+
+            # Gauss-Newton on the residuals of the distances from their mean
+            for _ in range(max_iter):
+                du = np.where(valid, u - uc[..., np.newaxis], 0)
+                dv = np.where(valid, v - vc[..., np.newaxis], 0)
+                ri = np.where(valid, np.hypot(du, dv), 1)
+
+                residual = ri - (ri * valid).sum(axis=-1, keepdims=True) / n_
+                ju = -du / ri
+                jv = -dv / ri
+                ju = ju - ju.sum(axis=-1, keepdims=True) / n_
+                jv = jv - jv.sum(axis=-1, keepdims=True) / n_
+                residual, ju, jv = [np.where(valid, a, 0) for a in [residual, ju, jv]]
+
+                a_uu = (ju * ju).sum(axis=-1)
+                a_vv = (jv * jv).sum(axis=-1)
+                a_uv = (ju * jv).sum(axis=-1)
+                g_u = (ju * residual).sum(axis=-1)
+                g_v = (jv * residual).sum(axis=-1)
+
+                jac_det = a_uu * a_vv - a_uv * a_uv
+                step_u = -(a_vv * g_u - a_uv * g_v) / jac_det
+                step_v = -(a_uu * g_v - a_uv * g_u) / jac_det
+
+                converged = ~(
+                    np.abs(step_u) + np.abs(step_v)
+                    > tol * (np.abs(uc) + np.abs(vc) + np.sqrt(suu + svv))
+                )
+                uc = np.where(converged, uc, uc + step_u)
+                vc = np.where(converged, vc, vc + step_v)
+
+                if converged.all():
+                    break
+
+            du = np.where(valid, u - uc[..., np.newaxis], 0)
+            dv = np.where(valid, v - vc[..., np.newaxis], 0)
+            r = (np.hypot(du, dv) * valid).sum(axis=-1) / n
+        else:
+            r = np.sqrt(uc * uc + vc * vc + (suu + svv) / n)
+
+    return x_mean + uc, y_mean + vc, r
+
+
+@instrument.instrumented(count=instrument.count_along("circle"))
 def get_xy_coords_for_circles(circles):
 
-    for i in range(len(circles)):
-
-        x_coor = circles[i]["lon"] * 111.320 * cos(np.radians(circles[i]["lat"])) * 1000
-        y_coor = circles[i]["lat"] * 110.54 * 1000
-        # converting from lat, lon to coordinates in metre from (0,0).
-
-        c_xc = np.full(np.size(x_coor, 1), np.nan)
-        c_yc = np.full(np.size(x_coor, 1), np.nan)
-        c_r = np.full(np.size(x_coor, 1), np.nan)
-
-        for j in range(np.size(x_coor, 1)):
-            a = ~np.isnan(x_coor.values[:, j])
-            if a.sum() > 4:
-                c_xc[j], c_yc[j], c_r[j], _ = cf.least_squares_circle(
-                    [
-                        (k, l)
-                        for k, l in zip(x_coor.values[:, j], y_coor.values[:, j])
-                        if ~np.isnan(k)
-                    ]
-                )
+    x_coor = circles["lon"] * 111.320 * cos(np.radians(circles["lat"])) * 1000
+    y_coor = circles["lat"] * 110.54 * 1000
+    # converting from lat, lon to coordinates in metre from (0,0).
 
-        circle_y = np.nanmean(c_yc) / (110.54 * 1000)
-        circle_x = np.nanmean(c_xc) / (111.320 * cos(np.radians(circle_y)) * 1000)
+    # circle fits for all circles and levels at once, with the sondes along the last axis
+    c_xc, c_yc, c_r = fit_circles(
+        x_coor.transpose("circle", "alt", "sounding").values,
+        y_coor.transpose("circle", "alt", "sounding").values,
+    )
 
-        circle_diameter = np.nanmean(c_r) * 2
+    circle_y = np.nanmean(c_yc, axis=1) / (110.54 * 1000)
+    circle_x = np.nanmean(c_xc, axis=1) / (111.320 * cos(np.radians(circle_y)) * 1000)
 
-        xc = [None] * len(x_coor.T)
-        yc = [None] * len(y_coor.T)
+    circle_diameter = np.nanmean(c_r, axis=1) * 2
 
-        xc = np.mean(x_coor, axis=0)
-        yc = np.mean(y_coor, axis=0)
+    xc = x_coor.mean(dim="sounding")
+    yc = y_coor.mean(dim="sounding")
 
-        delta_x = x_coor - xc  # *111*1000 # difference of sonde long from mean long
-        delta_y = y_coor - yc  # *111*1000 # difference of sonde lat from mean lat
+    delta_x = x_coor - xc  # *111*1000 # difference of sonde long from mean long
+    delta_y = y_coor - yc  # *111*1000 # difference of sonde lat from mean lat
 
-        circles[i]["platform_id"] = circles[i].platform_id.values[0]
-        circles[i]["flight_altitude"] = circles[i].flight_altitude.mean().values
-        circles[i]["circle_time"] = (
-            circles[i].launch_time.mean().values.astype("datetime64")
-        )
-        # circles[i].encoding["circle_time"] = {
-        #     "units": "seconds since 2020-01-01",
-        #     "dtype": "datetime64[ns]",
-        # }
-        circles[i]["circle_lon"] = circle_x
-        circles[i]["circle_lat"] = circle_y
-        circles[i]["circle_diameter"] = circle_diameter
-        circles[i]["dx"] = (["sounding", "alt"], delta_x)
-        circles[i]["dy"] = (["sounding", "alt"], delta_y)
+    circles["platform_id"] = (
+        ["circle"],
+        circles.platform_id.transpose("circle", "sounding").values[:, 0],
+    )
+    circles["flight_altitude"] = (
+        ["circle"],
+        circles.flight_altitude.mean(dim="sounding").values,
+    )
+    circles["circle_time"] = (
+        ["circle"],
+        circles.launch_time.mean(dim="sounding").values.astype("datetime64"),
+    )
+    # circles.encoding["circle_time"] = {
+    #     "units": "seconds since 2020-01-01",
+    #     "dtype": "datetime64[ns]",
+    # }
+    circles["circle_lon"] = (["circle"], circle_x)
+    circles["circle_lat"] = (["circle"], circle_y)
+    circles["circle_diameter"] = (["circle"], circle_diameter)
+    circles["dx"] = (
+        ["circle", "sounding", "alt"],
+        precision.as_working_dtype(
+            delta_x.transpose("circle", "sounding", "alt").values
+        ),
+    )
+    circles["dy"] = (
+        ["circle", "sounding", "alt"],
+        precision.as_working_dtype(
+            delta_y.transpose("circle", "sounding", "alt").values
+        ),
+    )
 
     return print("Circles ready for regression")
 
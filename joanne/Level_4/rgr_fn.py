@@ -1,17 +1,157 @@
 # %% Module to store functions for regression
 
-from sklearn import linear_model
 import numpy as np
 import xarray as xr
 import metpy.calc as mpcalc
 from metpy.units import units
 import os.path
+import warnings
 import joanne
-from tqdm import tqdm
+from joanne import config, instrument, precision
 
 # %% FIT2D function
 
 
+def fit2d_moments(x, y, valid, min_points=6, weights=None):
+    """
+    Input :
+        x, y : numpy arrays
+               x and y coordinates of data points. shape: (...,M)
+        valid : numpy array of bool
+                points to be used in the fit. shape: (...,M)
+        min_points : int
+                     fits with fewer valid points than this are set to NaN
+        weights : numpy array
+                  weights of the points for a weighted fit. shape: (...,M)
+                  points with zero weight are not counted as valid
+    Output :
+        moments : dict
+                  masked sums of the 2D linear model for every model along (...),
+                  i.e. the centred normal equations and their inverse
+
+    The moments only depend on the geometry (x, y), the validity mask and the weights,
+    so they can be reused for all variables that share them, see fit2d_solve(). The
+    arrays of the points are kept in the working dtype, the sums are taken in float64
+    """
+    dtype = precision.get_working_dtype()
+    x = np.asarray(x, dtype=dtype)
+    y = np.asarray(y, dtype=dtype)
+
+    if weights is None:
+        w = valid.astype(dtype)
+    else:
+        w = np.where(valid, weights, 0).astype(dtype, copy=False)
+        valid = valid & (w > 0)
+
+    n = valid.sum(axis=-1)
+    sw = w.sum(axis=-1, dtype="float64")
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = (w * np.where(valid, x, 0)).sum(axis=-1, dtype="float64") / sw
+        y_mean = (w * np.where(valid, y, 0)).sum(axis=-1, dtype="float64") / sw
+
+        x_anom = np.where(valid, x - x_mean[..., np.newaxis].astype(dtype), 0)
+        y_anom = np.where(valid, y - y_mean[..., np.newaxis].astype(dtype), 0)
+
+        wx_anom = w * x_anom
+        wy_anom = w * y_anom
+
+        sxx = (wx_anom * x_anom).sum(axis=-1, dtype="float64")
+        syy = (wy_anom * y_anom).sum(axis=-1, dtype="float64")
+        sxy = (wx_anom * y_anom).sum(axis=-1, dtype="float64")
+
+        det = sxx * syy - sxy * sxy
+
+        # singularity guard : too few points or (nearly) collinear points
+        singular = (n < min_points) | ~(det > 1e-10 * sxx * syy)
+        det = np.where(singular, np.nan, det)
+
+    return {
+        "valid": valid,
+        "w": w,
+        "n": n,
+        "sw": sw,
+        "x_mean": x_mean,
+        "y_mean": y_mean,
+        "x_anom": x_anom,
+        "y_anom": y_anom,
+        "wx_anom": wx_anom,
+        "wy_anom": wy_anom,
+        # inverse of the 2x2 centred normal matrix
+        "inv_xx": syy / det,
+        "inv_yy": sxx / det,
+        "inv_xy": -sxy / det,
+    }
+
+
+def fit2d_solve(moments, u, std_err=False):
+    """
+    Input :
+        moments : dict
+                  from fit2d_moments()
+        u : numpy array
+            data values, valid wherever moments["valid"] is True. shape: (...,M)
+        std_err : bool
+                  if True, the standard errors of the coefficients are returned too
+    Output :
+        intercept, dudx, dudy : numpy arrays. all shapes: (...)
+        se_intercept, se_dudx, se_dudy : numpy arrays, only if std_err is True
+                                         standard errors from the (weighted) residual
+                                         sum of squares with n-3 degrees of freedom and
+                                         the diagonal of the inverse normal matrix.
+                                         all shapes: (...)
+    """
+    dtype = precision.get_working_dtype()
+    u = np.asarray(u, dtype=dtype)
+    valid = moments["valid"]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        u_mean = (moments["w"] * np.where(valid, u, 0)).sum(
+            axis=-1, dtype="float64"
+        ) / moments["sw"]
+        u_anom = np.where(valid, u - u_mean[..., np.newaxis].astype(dtype), 0)
+
+        sxu = (moments["wx_anom"] * u_anom).sum(axis=-1, dtype="float64")
+        syu = (moments["wy_anom"] * u_anom).sum(axis=-1, dtype="float64")
+
+    dudx = moments["inv_xx"] * sxu + moments["inv_xy"] * syu
+    dudy = moments["inv_xy"] * sxu + moments["inv_yy"] * syu
+    intercept = u_mean - dudx * moments["x_mean"] - dudy * moments["y_mean"]
+
+    # NaN for singular fits is carried through inv_*, also for the intercept
+    intercept = np.where(np.isnan(dudx), np.nan, intercept)
+
+    if not std_err:
+        return intercept, dudx, dudy
+
+    x_mean, y_mean = moments["x_mean"], moments["y_mean"]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        residual = (
+            u_anom
+            - dudx[..., np.newaxis].astype(dtype) * moments["x_anom"]
+            - dudy[..., np.newaxis].astype(dtype) * moments["y_anom"]
+        )
+        variance = (moments["w"] * residual * residual).sum(
+            axis=-1, dtype="float64"
+        ) / (moments["n"] - 3)
+
+        se_dudx = np.sqrt(variance * moments["inv_xx"])
+        se_dudy = np.sqrt(variance * moments["inv_yy"])
+        se_intercept = np.sqrt(
+            variance
+            * (
+                1 / moments["sw"]
+                + x_mean * x_mean * moments["inv_xx"]
+                + 2 * x_mean * y_mean * moments["inv_xy"]
+                + y_mean * y_mean * moments["inv_yy"]
+            )
+        )
+
+    return intercept, dudx, dudy, se_intercept, se_dudx, se_dudy
+
+
+@instrument.instrumented(count=lambda x, *args: int(np.prod(x.shape[:-2])))
 def fit2d(x, y, u):
     """
     estimate a 2D linear model to calculate u-values from x-y coordinates
@@ -23,37 +163,316 @@ def fit2d(x, y, u):
     all points along the M dimension are expected to belong to the same model
     all other dimensions are for different models
 
+    the normal equations are solved analytically for all models at once;
+    models with fewer than 6 valid points or with collinear points are NaN
+
     :returns: intercept, dudx, dudy. all shapes: (...)
     """
-    u_ = u
-    # to fix nans, do a copy
-    u = np.array(u, copy=True)
-    # a does not need to be copied as this creates a copy already
-    a = np.stack([np.ones_like(x), x, y], axis=-1)
+    x, y, u = np.broadcast_arrays(x, y, u)
+    valid = ~(np.isnan(u) | np.isnan(x) | np.isnan(y))
+
+    return fit2d_solve(fit2d_moments(x, y, valid), u)
+
+
+def window_sum(values, starts, stops):
+    """
+    Input :
+        values : numpy array
+                 values along the sequence (last axis). shape: (...,S)
+        starts, stops : numpy arrays of int
+                        first and one-past-last index of every window. shape: (W,)
+    Output :
+        sums : numpy array
+               sum of values over every window. shape: (...,W)
+
+    The sums of all windows are differences of one prefix sum, so overlapping windows
+    share the work. The prefix sum is accumulated in float64
+    """
+    prefix = np.zeros(values.shape[:-1] + (values.shape[-1] + 1,))
+    np.cumsum(values, axis=-1, dtype="float64", out=prefix[..., 1:])
+
+    return prefix[..., stops] - prefix[..., starts]
+
+
+def window_moments(x, y, valid, starts, stops, min_points=6):
+    """
+    Input :
+        x, y : numpy arrays
+               x and y coordinates of data points along a sequence. shape: (...,S)
+        valid : numpy array of bool
+                points to be used in the fit. shape: (...,S)
+        starts, stops : numpy arrays of int
+                        first and one-past-last index along the sequence of every
+                        window to be fitted. shape: (W,)
+        min_points : int
+                     fits with fewer valid points than this are set to NaN
+    Output :
+        moments : dict
+                  centred normal equations of the 2D linear model of every window
+                  and their inverse, with the same keys as fit2d_moments() where
+                  applicable. shapes: (...,W)
+
+    The sums are taken from prefix sums over the sequence, see window_sum(). To limit
+    cancellation, coordinates are taken relative to their mean over the sequence. The
+    arrays along the sequence are kept in the working dtype
+    """
+    dtype = precision.get_working_dtype()
+    x = np.asarray(x, dtype=dtype)
+    y = np.asarray(y, dtype=dtype)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n_all = valid.sum(axis=-1, keepdims=True)
+        x_seq_mean = (
+            np.where(valid, x, 0).sum(axis=-1, keepdims=True, dtype="float64") / n_all
+        )
+        y_seq_mean = (
+            np.where(valid, y, 0).sum(axis=-1, keepdims=True, dtype="float64") / n_all
+        )
+
+        x_ref = np.where(valid, x - x_seq_mean.astype(dtype), 0)
+        y_ref = np.where(valid, y - y_seq_mean.astype(dtype), 0)
+
+        n = window_sum(valid, starts, stops)
+        x_mean = window_sum(x_ref, starts, stops) / n
+        y_mean = window_sum(y_ref, starts, stops) / n
+
+        sxx = window_sum(x_ref * x_ref, starts, stops) - n * x_mean * x_mean
+        syy = window_sum(y_ref * y_ref, starts, stops) - n * y_mean * y_mean
+        sxy = window_sum(x_ref * y_ref, starts, stops) - n * x_mean * y_mean
+
+        det = sxx * syy - sxy * sxy
+
+        # singularity guard : too few points or (nearly) collinear points
+        singular = (n < min_points) | ~(det > 1e-10 * sxx * syy)
+        det = np.where(singular, np.nan, det)
+
+    return {
+        "valid": valid,
+        "starts": starts,
+        "stops": stops,
+        "n": n,
+        "x_mean": x_mean,
+        "y_mean": y_mean,
+        "x_ref": x_ref,
+        "y_ref": y_ref,
+        # inverse of the 2x2 centred normal matrix
+        "inv_xx": syy / det,
+        "inv_yy": sxx / det,
+        "inv_xy": -sxy / det,
+    }
+
+
+def window_solve(moments, u):
+    """
+    Input :
+        moments : dict
+                  from window_moments()
+        u : numpy array
+            data values along the sequence, valid wherever moments["valid"] is True.
+            shape: (...,S)
+    Output :
+        u_centre, dudx, dudy : numpy arrays
+                               regressed value at the centroid of the valid points of
+                               every window, and the gradients. all shapes: (...,W)
+    """
+    dtype = precision.get_working_dtype()
+    u = np.asarray(u, dtype=dtype)
+    valid = moments["valid"]
+    starts, stops = moments["starts"], moments["stops"]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n_all = valid.sum(axis=-1, keepdims=True)
+        u_ref = (
+            np.where(valid, u, 0).sum(axis=-1, keepdims=True, dtype="float64") / n_all
+        )
+        u_anom = np.where(valid, u - u_ref.astype(dtype), 0)
 
-    # for handling missing values, both u and a are set to 0, that way
-    # these items don't influence the fit
-    invalid = np.isnan(u) | np.isnan(x) | np.isnan(y)
-    under_constraint = np.sum(~invalid, axis=-1) < 6
-    u[invalid] = 0
-    a[invalid] = 0
+        u_mean = window_sum(u_anom, starts, stops) / moments["n"]
 
-    a_inv = np.linalg.pinv(a)
+        sxu = window_sum(moments["x_ref"] * u_anom, starts, stops)
+        syu = window_sum(moments["y_ref"] * u_anom, starts, stops)
+        sxu = sxu - moments["n"] * moments["x_mean"] * u_mean
+        syu = syu - moments["n"] * moments["y_mean"] * u_mean
 
-    intercept, dudx, dudy = np.einsum("...rm,...m->r...", a_inv, u)
+    dudx = moments["inv_xx"] * sxu + moments["inv_xy"] * syu
+    dudy = moments["inv_xy"] * sxu + moments["inv_yy"] * syu
 
-    intercept[under_constraint] = np.nan
-    dudx[under_constraint] = np.nan
-    dudy[under_constraint] = np.nan
+    # for the mean of a linear fit, the fit passes through the centroid of the points
+    u_centre = np.where(np.isnan(dudx), np.nan, u_ref + u_mean)
 
-    return intercept, dudx, dudy, u_
+    return u_centre, dudx, dudy
 
 
-def fit2d_xr(x, y, u, input_core_dims, output_core_dims):
-    # input and output dims must be a list
+# tuning constants (in units of the robust residual scale) for 95% efficiency
+# of the robust fits when the residuals are normally distributed
+robust_tuning = {"huber": 1.345, "tukey": 4.685}
+
+
+def robust_scale(residual, valid, min_fraction=0.01):
+    """
+    Input :
+        residual : numpy array
+                   residuals of the fit. shape: (...,M)
+        valid : numpy array of bool
+                points used in the fit. shape: (...,M)
+        min_fraction : float
+                       lower limit of the scale, as a fraction of the RMS of the
+                       residuals
+    Output :
+        scale : numpy array
+                normalised median absolute deviation (MAD) of the residuals of
+                every model, at least min_fraction of their RMS; NaN without valid
+                points. shape: (...,1)
+
+    The lower limit matters when more than half of the residuals are zero (e.g. for
+    quantised data): the MAD is then 0, and every point off the fit would get a weight
+    of 0, however small its residual
+    """
+    abs_residual = np.sort(np.where(valid, np.abs(residual), np.inf), axis=-1)
+    n = valid.sum(axis=-1, keepdims=True)
+
+    # median of the n valid residuals of every model, which are sorted to the front
+    lower = np.take_along_axis(abs_residual, np.maximum((n - 1) // 2, 0), axis=-1)
+    upper = np.take_along_axis(
+        abs_residual, np.minimum(n // 2, residual.shape[-1] - 1), axis=-1
+    )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        squares = np.where(valid, residual ** 2, 0)
+        rms = np.sqrt(squares.sum(axis=-1, keepdims=True, dtype="float64") / n)
+        scale = np.maximum(1.4826 * (lower + upper) / 2, min_fraction * rms)
+        return np.where(n > 0, scale, np.nan)
+
+
+def robust_weights(residual, valid, scale, method="huber", tuning=None):
+    """
+    Input :
+        residual : numpy array
+                   residuals of the fit. shape: (...,M)
+        valid : numpy array of bool
+                points used in the fit. shape: (...,M)
+        scale : numpy array
+                residual scale of every model, e.g. from robust_scale(). shape: (...,1)
+        method : string
+                 'huber' or 'tukey' (bisquare)
+        tuning : float
+                 tuning constant; default from robust_tuning
+    Output :
+        weights : numpy array
+                  weights of the points for the next iteration, between 0 and 1;
+                  0 where not valid. shape: (...,M)
+
+    Models without a finite residual (e.g. singular fits) keep weights of 1
+    """
+    if method not in robust_tuning:
+        raise ValueError(f"unknown robust regression method '{method}'")
+    if tuning is None:
+        tuning = robust_tuning[method]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = np.abs(residual) / (tuning * scale)
+
+        if method == "huber":
+            weights = np.minimum(1, 1 / z)
+        else:
+            weights = np.where(z < 1, (1 - z ** 2) ** 2, 0)
+
+    weights = np.where(np.isnan(z), 1, weights)
+
+    return np.where(valid, weights, 0)
+
+
+def fit2d_robust(
+    x, y, u, method="huber", tuning=None, max_iter=10, tol=1e-3, min_points=6
+):
+    """
+    Input :
+        x, y, u : numpy arrays
+                  x and y coordinates and data values of data points. shape: (...,M)
+        method : string
+                 'huber' or 'tukey', see robust_weights()
+        tuning : float
+                 tuning constant of the weight function
+        max_iter : int
+                   maximum number of reweighting iterations
+        tol : float
+              iterations stop once no weight changes by more than this
+        min_points : int
+                     fits with fewer points of non-zero weight are set to NaN
+    Output :
+        intercept, dudx, dudy : numpy arrays. all shapes: (...)
+        weights : numpy array
+                  final weight of every point. shape: (...,M)
+
+    Iteratively reweighted least squares, starting from the OLS fit. The residual scale
+    is re-estimated in every iteration from the residuals of the current fit, see
+    robust_scale(). Every iteration solves the weighted normal equations of all models
+    at once, so a robust fit costs a few OLS fits
+    """
+    x, y, u = np.broadcast_arrays(x, y, u)
+    valid = ~(np.isnan(u) | np.isnan(x) | np.isnan(y))
+
+    dtype = precision.get_working_dtype()
+    x, y, u = [np.asarray(a, dtype=dtype) for a in (x, y, u)]
+
+    intercept, dudx, dudy = fit2d_solve(fit2d_moments(x, y, valid, min_points), u)
+    weights = valid.astype(dtype)
+
+    for _ in range(max_iter):
+        residual = u - (
+            intercept[..., np.newaxis].astype(dtype)
+            + dudx[..., np.newaxis].astype(dtype) * x
+            + dudy[..., np.newaxis].astype(dtype) * y
+        )
+        scale = robust_scale(residual, valid).astype(dtype)
+        new_weights = robust_weights(residual, valid, scale, method, tuning)
+
+        intercept, dudx, dudy = fit2d_solve(
+            fit2d_moments(x, y, valid, min_points, new_weights), u
+        )
+
+        converged = not (np.abs(new_weights - weights) > tol).any()
+        weights = new_weights
+
+        if converged:
+            break
+
+    return intercept, dudx, dudy, weights
+
+
+def fit2d_xr(x, y, u, input_core_dims, output_core_dims=None):
+    """
+    Input :
+        x, y, u : xarray DataArrays
+                  x and y coordinates and data values of data points
+        input_core_dims : list
+                          dimensions along which the points of one model lie
+        output_core_dims : list
+                           deprecated; if given, u is returned too, with these core
+                           dimensions, as fit2d() did before it returned a copy of u
+    Output :
+        intercept, dudx, dudy : xarray DataArrays
+        u : xarray DataArray, only if output_core_dims is given
+    """
+    if output_core_dims is None:
+        return xr.apply_ufunc(
+            fit2d,
+            x,
+            y,
+            u,
+            input_core_dims=[input_core_dims, input_core_dims, input_core_dims],
+            output_core_dims=[(), (), ()],
+        )
+
+    warnings.warn(
+        "the output_core_dims argument of fit2d_xr is deprecated, as fit2d no longer "
+        "returns u; call fit2d_xr(x, y, u, input_core_dims) instead",
+        DeprecationWarning,
+        stacklevel=2,
+    )
 
     return xr.apply_ufunc(
-        fit2d,
+        lambda x, y, u: (*fit2d(x, y, u), u),
         x,
         y,
         u,
@@ -62,6 +481,101 @@ def fit2d_xr(x, y, u, input_core_dims, output_core_dims):
     )
 
 
+@instrument.instrumented(count=instrument.count_along("circle"))
+def fit2d_for_parameters(
+    dataset,
+    list_of_parameters=["u", "v", "q", "ta", "p"],
+    core_dim="sounding",
+    method="ols",
+    min_points=6,
+    **robust_kwargs,
+):
+    """
+    Input :
+        dataset : xarray dataset
+                  dataset with sondes of all circles, with dx and dy calculated
+        list_of_parameters : list
+                             parameters on which regression is to be carried out
+        core_dim : string
+                   dimension along the sondes of a circle
+        method : string
+                 'ols' for ordinary least squares, or 'huber' or 'tukey' for
+                 robust regression, see fit2d_robust()
+        min_points : int
+                     minimum number of sondes with data for a regression at a level
+        **robust_kwargs : keyword arguments of fit2d_robust(), e.g. tuning, max_iter
+    Output :
+        dataset : xarray dataset
+                  dataset where each parameter is replaced by its regressed mean
+                  (intercept), with its gradients as 'd'+par+'dx' and 'd'+par+'dy'
+                  and their standard errors as 'se_'+par, 'se_d'+par+'dx' and
+                  'se_d'+par+'dy'; the sonde values are kept as par+'_sounding'. for
+                  robust regression, the final weights of the sondes are added as
+                  par+'_weight'
+
+    For OLS, the normal equations are set up once for every validity mask and reused
+    for all parameters that share it (e.g. u and v, or ta, p and q). Robust fits of all
+    parameters are iterated together, stacked along a leading parameter axis
+    """
+    x, y, *pars = xr.broadcast(
+        dataset.dx, dataset.dy, *[dataset[par] for par in list_of_parameters]
+    )
+    dims = [dim for dim in x.dims if dim != core_dim]
+    x, y, *pars = [da.transpose(*dims, core_dim) for da in [x, y, *pars]]
+
+    if method != "ols":
+        u = np.stack([u.values for u in pars])
+        _, _, _, weights = fit2d_robust(
+            x.values, y.values, u, method=method, min_points=min_points, **robust_kwargs
+        )
+
+        # one more solve with the final weights, for the standard errors
+        valid = ~(np.isnan(u) | np.isnan(x.values) | np.isnan(y.values))
+        moments = fit2d_moments(x.values, y.values, valid, min_points, weights)
+        results = zip(*fit2d_solve(moments, u, std_err=True))
+
+        for par, weight in zip(list_of_parameters, weights):
+            dataset[par + "_weight"] = (
+                dims + [core_dim],
+                precision.as_working_dtype(weight),
+            )
+
+    else:
+        xy_valid = ~(np.isnan(x.values) | np.isnan(y.values))
+        list_of_moments = []
+        results = []
+
+        for u in pars:
+            valid = xy_valid & ~np.isnan(u.values)
+
+            for moments in list_of_moments:
+                if np.array_equal(moments["valid"], valid):
+                    break
+            else:
+                moments = fit2d_moments(x.values, y.values, valid, min_points)
+                list_of_moments.append(moments)
+
+            results.append(fit2d_solve(moments, u.values, std_err=True))
+
+    for par, result in zip(list_of_parameters, results):
+        intercept, dudx, dudy, se_intercept, se_dudx, se_dudy = result
+
+        dataset[par + "_sounding"] = dataset[par]
+
+        # the regression is accumulated in float64, results are kept in working dtype
+        for name, values in [
+            (par, intercept),
+            ("d" + par + "dx", dudx),
+            ("d" + par + "dy", dudy),
+            ("se_" + par, se_intercept),
+            ("se_d" + par + "dx", se_dudx),
+            ("se_d" + par + "dy", se_dudy),
+        ]:
+            dataset[name] = (dims, precision.as_working_dtype(values))
+
+    return dataset
+
+
 # %%
 
 
@@ -81,43 +595,27 @@ def run_regression(circle, parameter):
         m_parameter, c_parameter    : coefficients of regression
 
     """
-    id_u = ~np.isnan(circle.u.values)
-    id_v = ~np.isnan(circle.v.values)
-    id_q = ~np.isnan(circle.q.values)
-    id_x = ~np.isnan(circle.dx.values)
-    id_y = ~np.isnan(circle.dy.values)
-    id_t = ~np.isnan(circle.ta.values)
-    id_p = ~np.isnan(circle.p.values)
-
-    id_quxv = np.logical_and(np.logical_and(id_q, id_u), np.logical_and(id_x, id_v))
-    id_ = np.logical_and(np.logical_and(id_t, id_p), id_quxv)
-
-    mean_parameter = np.full(len(circle.alt), np.nan)
-    m_parameter = np.full(len(circle.alt), np.nan)
-    c_parameter = np.full(len(circle.alt), np.nan)
-
-    Ns = np.full(len(circle.alt), np.nan)  # number of sondes available for regression
-
-    for k in range(len(circle.alt)):
-        Ns[k] = id_[:, k].sum()
-        if Ns[k] > 6:
-            X_dx = circle["dx"].isel(alt=k).isel(sounding=id_[:, k]).values
-            X_dy = circle["dy"].isel(alt=k).isel(sounding=id_[:, k]).values
-
-            X = list(zip(X_dx, X_dy))
-
-            Y_parameter = circle[parameter].isel(alt=k).isel(sounding=id_[:, k]).values
-
-            regr = linear_model.LinearRegression()
-            regr.fit(X, Y_parameter)
+    # sondes are regressed only at levels where all parameters and dx, dy are available
+    dims = ("alt", "sounding")
+
+    id_ = xr.DataArray(True)
+    for var in ["u", "v", "q", "ta", "p", "dx", "dy"]:
+        id_ = id_ & circle[var].notnull()
+    id_ = id_.transpose(*dims).values
+
+    moments = fit2d_moments(
+        circle["dx"].transpose(*dims).values,
+        circle["dy"].transpose(*dims).values,
+        id_,
+        min_points=7,
+    )
 
-            mean_parameter[k] = regr.intercept_
-            m_parameter[k], c_parameter[k] = regr.coef_
-        else:
-            Ns[k] = 0
+    mean_parameter, m_parameter, c_parameter = fit2d_solve(
+        moments, circle[parameter].transpose(*dims).values
+    )
 
-    # if "sondes_regressed" not in circle:
-    #     circle["sondes_regressed"] = (["alt"], Ns)
+    # number of sondes available for regression; 0 where there are too few
+    Ns = np.where(moments["n"] > 6, moments["n"], 0).astype(float)
 
     return (mean_parameter, m_parameter, c_parameter, Ns)
 
@@ -133,7 +631,7 @@ def run_regression(circle, parameter):
 
 def regress_for_all_parameters(circle, list_of_parameters):
 
-    save_directory = "/Users/geet/Documents/JOANNE/Data/Level_4/Interim_files/"
+    save_directory = config.get_directory("level_4_interim")
 
     file_name = (
         "EUREC4A_JOANNE_Dropsonde-RD41_"
@@ -198,109 +696,91 @@ def get_div_and_vor(circle):
     return print("Finished estimating divergence and vorticity for all circles....")
 
 
-# def get_vertical_velocity(circle):
-def get_density_vertical_velocity_and_omega(circle):
+def integrate_divergence(D, alt_step=10):
+    """
+    Input :
+        D : numpy array
+            divergence (in s-1) with altitude along the last axis. shape: (...,alt)
+        alt_step : float
+                   vertical spacing (in m) of the altitude grid
+    Output :
+        W : numpy array
+            vertical velocity (in m s-1). shape: (...,alt)
 
-    den_m = [None] * len(circle.sounding)
+    W is integrated upwards from 0 at the surface, over levels where D is available;
+    levels with missing D are NaN and the integration carries on from the last valid level
+    """
+    levels = np.arange(D.shape[-1])
+    valid = ~np.isnan(D)
+    valid[..., 0] = True
 
-    for n in range(len(circle.sounding)):
-        if len(circle.isel(sounding=n).sonde_id.values) > 1:
-            mr = mpcalc.mixing_ratio_from_specific_humidity(
-                circle.isel(sounding=n).q_sounding.values
-            )
-            den_m[n] = mpcalc.density(
-                circle.isel(sounding=n).p_sounding.values * units.Pa,
-                circle.isel(sounding=n).ta_sounding.values * units.kelvin,
-                mr,
-            ).magnitude
-        else:
-            den_m[n] = np.nan
+    last_valid = np.maximum.accumulate(np.where(valid, levels, 0), axis=-1)
+    gap = levels[1:] - last_valid[..., :-1]
 
-    circle["density"] = (["sounding", "circle", "alt"], den_m)
-    circle["mean_density"] = (["circle", "alt"], np.nanmean(den_m, axis=0))
+    w_increment = np.zeros(D.shape, dtype=D.dtype)
+    w_increment[..., 1:] = np.where(
+        valid[..., 1:], D[..., 1:] * alt_step * gap.astype(D.dtype), 0
+    )
 
-    D = circle.D.values
-    mean_den = circle.mean_density
+    w_vel = np.cumsum(w_increment, axis=-1, dtype="float64")
+    w_vel = np.where(valid, -w_vel, np.nan)
+    w_vel[..., 0] = 0
 
-    nan_ids = np.where(np.isnan(D) == True)  # [0]
+    return w_vel
 
-    w_vel = np.full([len(circle["circle"]), len(circle.alt)], np.nan)
-    p_vel = np.full([len(circle["circle"]), len(circle.alt)], np.nan)
 
-    w_vel[:, 0] = 0
-    # last = 0
+# def get_vertical_velocity(circle):
+def get_density_vertical_velocity_and_omega(circle):
+
+    dims = ("sounding", "circle", "alt")
 
-    for cir in range(len(circle["circle"])):
-        last = 0
-        for m in range(1, len(circle.alt)):
+    mr = mpcalc.mixing_ratio_from_specific_humidity(
+        circle.q_sounding.transpose(*dims).values
+    )
+    den_m = mpcalc.density(
+        circle.p_sounding.transpose(*dims).values * units.Pa,
+        circle.ta_sounding.transpose(*dims).values * units.kelvin,
+        mr,
+    ).magnitude
+
+    circle["density"] = (
+        ["sounding", "circle", "alt"],
+        precision.as_working_dtype(den_m),
+    )
+    circle["mean_density"] = (
+        ["circle", "alt"],
+        precision.as_working_dtype(np.nanmean(den_m, axis=0)),
+    )
 
-            if (
-                len(
-                    np.intersect1d(
-                        np.where(nan_ids[1] == m)[0], np.where(nan_ids[0] == cir)[0]
-                    )
-                )
-                > 0
-            ):
+    D = circle.D.transpose("circle", "alt").values
+    mean_den = circle.mean_density.values
 
-                ids_for_nan_ids = np.intersect1d(
-                    np.where(nan_ids[1] == m)[0], np.where(nan_ids[0] == cir)[0]
-                )
-                w_vel[nan_ids[0][ids_for_nan_ids], nan_ids[1][ids_for_nan_ids]] = np.nan
+    # W is integrated in float64
+    w_vel = integrate_divergence(D)
 
-            else:
-                w_vel[cir, m] = w_vel[cir, last] - circle.D.isel(circle=cir).isel(
-                    alt=m
-                ).values * 10 * (m - last)
-                last = m
-
-        for n in range(1, len(circle.alt)):
-
-            p_vel[cir, n] = (
-                -circle.mean_density.isel(circle=cir).isel(alt=n)
-                * 9.81
-                * w_vel[cir, n]
-                # * 60
-                # * 60
-                # / 100
-            )
+    p_vel = np.full([len(circle["circle"]), len(circle.alt)], np.nan)
+    p_vel[:, 1:] = -mean_den[:, 1:] * 9.81 * w_vel[:, 1:]
 
-    circle["W"] = (["circle", "alt"], w_vel)
-    circle["omega"] = (["circle", "alt"], p_vel)
+    circle["W"] = (["circle", "alt"], precision.as_working_dtype(w_vel))
+    circle["omega"] = (["circle", "alt"], precision.as_working_dtype(p_vel))
 
     return print("Finished estimating density, W and omega ...")
     # return print("Finished estimating W ...")
 
 
 def add_std_err_terms(all_cir):
+    """
+    Input :
+        all_cir : xarray dataset
+                  dataset of all circles with D, vor and the standard errors of the
+                  gradients of u and v, as from fit2d_for_parameters()
+    Output :
+        all_cir_with_std_err : xarray dataset
+                               all_cir with the standard errors se_D, se_vor and se_W
 
-    dx_mean = all_cir.dx.mean(dim="sounding")
-    dy_mean = all_cir.dy.mean(dim="sounding")
-
-    dx_denominator = np.sqrt(((all_cir.dx - dx_mean) ** 2).sum(dim="sounding"))
-    dy_denominator = np.sqrt(((all_cir.dy - dy_mean) ** 2).sum(dim="sounding"))
-
-    for par in tqdm(["u", "v", "p", "q", "ta"]):
-
-        par_err = all_cir[par + "_sounding"] - (
-            all_cir[par]
-            + (all_cir["d" + par + "dx"] * all_cir.dx)
-            + (all_cir["d" + par + "dy"] * all_cir.dy)
-        )
-
-        par_sq_sum = np.nansum((par_err ** 2), axis=2)
-        par_n = (~np.isnan(par_err)).sum(axis=2)
-
-        par_numerator = np.sqrt(par_sq_sum / (par_n - 3))
-
-        se_dpardx = par_numerator / dx_denominator
-        se_dpardy = par_numerator / dy_denominator
-
-        var_name_dx = "se_d" + par + "dx"
-        var_name_dy = "se_d" + par + "dy"
-
-        all_cir[var_name_dx] = (["circle", "alt"], se_dpardx)
-        all_cir[var_name_dy] = (["circle", "alt"], se_dpardy)
+    The standard errors of the gradients are computed during the regression, see
+    fit2d_solve(), so no residuals are computed here
+    """
 
     se_div = np.sqrt((all_cir.se_dudx) ** 2 + (all_cir.se_dvdy) ** 2)
     se_vor = np.sqrt((all_cir.se_dudy) ** 2 + (all_cir.se_dvdx) ** 2)
@@ -318,19 +798,201 @@ def add_std_err_terms(all_cir):
     return all_cir_with_std_err
 
 
+def get_resample_weights(present, n_resamples, method="bootstrap", rng=None):
+    """
+    Input :
+        present : numpy array of bool
+                  soundings (along the last axis) that belong to every circle.
+                  shape: (circle, sounding)
+        n_resamples : int
+                      number of resamples; for the jackknife, resamples beyond the
+                      number of soundings are not drawn
+        method : string
+                 'bootstrap' (drawing soundings with replacement) or 'jackknife'
+                 (leaving out one sounding at a time)
+        rng : numpy random Generator
+              source of the bootstrap draws
+    Output :
+        weights : numpy array
+                  number of times every sounding is in a resample; NaN for jackknife
+                  resamples that would leave out a sounding not in the circle.
+                  shape: (resample, circle, sounding)
+
+    Resamples are drawn as index arrays into the soundings of every circle, and
+    counted into weights for the weighted regression, see fit2d_moments()
+    """
+    n_circle, n_sounding = present.shape
+    n_present = present.sum(axis=-1)
+
+    if method == "jackknife":
+        n_resamples = min(n_resamples, n_sounding)
+        weights = np.where(present, 1.0, 0.0) * np.ones((n_resamples, 1, 1))
+        weights[np.arange(n_resamples), :, np.arange(n_resamples)] = 0
+        left_out = present[:, :n_resamples].T
+        return np.where(left_out[..., np.newaxis], weights, np.nan)
+
+    if method != "bootstrap":
+        raise ValueError(f"unknown resampling method '{method}'")
+
+    # present soundings first, so that draws can index them as 0 ... n_present-1
+    order = np.argsort(~present, axis=-1, kind="stable")
+
+    draws = rng.random((n_resamples, n_circle, n_sounding)) * n_present[:, None]
+    index = np.take_along_axis(order[np.newaxis], draws.astype("int64"), axis=-1)
+
+    # only the first n_present draws of every circle are used
+    drawn = np.arange(n_sounding) < n_present[:, None]
+    counted = (index[..., np.newaxis] == np.arange(n_sounding)) & drawn[..., None]
+
+    return counted.sum(axis=-2).astype("float64")
+
+
+@instrument.instrumented(count=instrument.count_along("circle"))
+def resample_circle_products(
+    circles,
+    n_resamples=200,
+    method="bootstrap",
+    chunk_size=None,
+    seed=0,
+    core_dim="sounding",
+):
+    """
+    Input :
+        circles : xarray dataset
+                  dataset of all circles with dx, dy and the sonde values as
+                  'u_sounding' and 'v_sounding', e.g. from fit2d_for_parameters()
+        n_resamples : int
+                      number of resamples (at most the number of soundings for
+                      the jackknife)
+        method : string
+                 'bootstrap' or 'jackknife', see get_resample_weights()
+        chunk_size : int
+                     number of resamples regressed at once, which bounds the memory
+                     to about 10 arrays of chunk_size x circle x alt x sounding floats;
+                     default from joanne.config, see config.get_chunk_size()
+        seed : int
+               seed of the bootstrap draws; results do not depend on chunk_size
+    Output :
+        samples : xarray dataset
+                  D, vor and W of every resample, dims ('resample', 'circle', 'alt')
+
+    All resamples x circles x levels x parameters of a chunk are regressed in one
+    batched weighted solve, and W is integrated for every resample. See
+    get_resample_std_err() for the standard errors from the samples
+    """
+    dims = ["circle", "alt", core_dim]
+    x, y, u, v = [
+        circles[var].transpose(*dims).values
+        for var in ["dx", "dy", "u_sounding", "v_sounding"]
+    ]
+    present = ~np.isnan(x).all(axis=1)
+
+    weights = get_resample_weights(
+        present, n_resamples, method=method, rng=np.random.default_rng(seed)
+    )
+
+    chunk_size = config.get_chunk_size(10 * x.size * 8, chunk_size)
+
+    D = np.full(weights.shape[:2] + (len(circles.alt),), np.nan, dtype="float32")
+    vor = np.full(D.shape, np.nan, dtype="float32")
+    W = np.full(D.shape, np.nan, dtype="float32")
+
+    for start in range(0, len(weights), chunk_size):
+        chunk = weights[start : start + chunk_size, :, np.newaxis, :]
+        resampled = np.isnan(chunk).any(axis=-1)
+
+        gradients = []
+        for par in [u, v]:
+            valid = ~(np.isnan(x) | np.isnan(y) | np.isnan(par))
+            moments = fit2d_moments(x, y, valid, weights=np.nan_to_num(chunk))
+            gradients.append(fit2d_solve(moments, par)[1:])
+
+        (dudx, dudy), (dvdx, dvdy) = gradients
+
+        chunk_D = np.where(resampled, np.nan, dudx + dvdy)
+        D[start : start + chunk_size] = chunk_D
+        vor[start : start + chunk_size] = np.where(resampled, np.nan, dvdx - dudy)
+        W[start : start + chunk_size] = np.where(
+            resampled, np.nan, integrate_divergence(chunk_D)
+        )
+
+    sample_dims = ["resample", "circle", "alt"]
+
+    samples = xr.Dataset(
+        {"D": (sample_dims, D), "vor": (sample_dims, vor), "W": (sample_dims, W)},
+        coords={"circle": circles.circle.values, "alt": circles.alt.values},
+    )
+    samples.attrs["method"] = method
+    samples.attrs["seed"] = seed
+
+    return samples
+
+
+def get_resample_std_err(samples):
+    """
+    Input :
+        samples : xarray dataset
+                  from resample_circle_products()
+    Output :
+        std_err : xarray dataset
+                  standard errors of D, vor and W along ('circle', 'alt')
+
+    For the bootstrap, the standard error is the standard deviation of the resamples;
+    for the jackknife, it is scaled by (n-1), with n the number of resamples per circle
+    """
+    n = samples.D.notnull().any(dim="alt").sum(dim="resample")
+
+    if samples.attrs["method"] == "jackknife":
+        return np.sqrt(
+            ((samples - samples.mean(dim="resample")) ** 2).sum(dim="resample")
+            * (n - 1)
+            / n
+        )
+
+    return samples.std(dim="resample", ddof=1)
+
+
 def get_advection(circles, list_of_parameters=["u", "v", "q", "ta", "p"]):
+    """
+    Input :
+        circles : xarray dataset
+                  dataset of all circles, with the regressed parameters and their
+                  gradients, e.g. from fit2d_for_parameters()
+        list_of_parameters : list
+                             parameters for which horizontal advection is estimated
+    Output :
+        prints when finished; 'h_adv_'+par is added to circles for every parameter
 
-    for id_, circle in enumerate(circles):
-        adv_dicts = {}
-        for var in list_of_parameters:
-            adv_dicts[f"h_adv_{var}"] = -(circle.u * eval(f"circle.d{var}dx")) - (
-                circle.v * eval(f"circle.d{var}dy")
-            )
-            circle[f"h_adv_{var}"] = (["alt"], adv_dicts[f"h_adv_{var}"])
+    Advection of all parameters is computed in one array operation over (circle, alt)
+    """
+    dims = ("circle", "alt")
+
+    u = circles.u.transpose(*dims).values
+    v = circles.v.transpose(*dims).values
+
+    dpardx = np.stack(
+        [
+            circles["d" + var + "dx"].transpose(*dims).values
+            for var in list_of_parameters
+        ]
+    )
+    dpardy = np.stack(
+        [
+            circles["d" + var + "dy"].transpose(*dims).values
+            for var in list_of_parameters
+        ]
+    )
+
+    h_adv = -(u * dpardx) - (v * dpardy)
+
+    circles.update(
+        {f"h_adv_{var}": (dims, h_adv[n]) for n, var in enumerate(list_of_parameters)}
+    )
 
     return print("Finished estimating advection terms ...")
 
 
+@instrument.instrumented(count=instrument.count_along("circle"))
 def get_circle_products(circles):
 
     # for id_,circle in enumerate(circles) :
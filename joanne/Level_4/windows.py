@@ -0,0 +1,260 @@
+# %% Module to regress over windows of consecutive sondes along the flight tracks, or
+# over any grouping of sondes, instead of only over the circles from the YAML files
+import numpy as np
+import xarray as xr
+
+from joanne.Level_4 import rgr_fn as rf
+
+# %%
+
+
+def get_xy_coords(lat, lon):
+    """
+    Input :
+        lat, lon : numpy arrays
+                   latitude and longitude (in degrees)
+    Output :
+        x, y : numpy arrays
+               coordinates in metre from (0,0), as for the circles in
+               ready_ds_for_regression.get_xy_coords_for_circles()
+    """
+    x = lon * 111.320 * np.cos(np.radians(lat)) * 1000
+    y = lat * 110.54 * 1000
+
+    return x, y
+
+
+def get_flight_sequence(ds_lv3):
+    """
+    Input :
+        ds_lv3 : xarray dataset
+                 Level-3 dataset with 'sonde_id' dimension
+    Output :
+        rows : numpy array
+               rows along 'sonde_id' of all sondes, ordered by platform and launch_time
+        flight : numpy array
+                 flight (platform and UTC date of launch) of every sonde in rows
+    """
+    platform = ds_lv3.platform_id.values.astype(str)
+    launch_time = ds_lv3.launch_time.values.astype("datetime64[ns]")
+
+    rows = np.lexsort((launch_time, platform))
+
+    flight = np.char.add(
+        platform[rows],
+        np.datetime_as_string(launch_time[rows], unit="D").astype(str),
+    )
+
+    return rows, flight
+
+
+def get_sliding_window_bounds(flight, n_sondes, launch_time=None, max_duration=None):
+    """
+    Input :
+        flight : numpy array
+                 flight of every sonde along the sequence, see get_flight_sequence()
+        n_sondes : int
+                   number of consecutive sondes in a window
+        launch_time : numpy array
+                      launch_time of every sonde along the sequence; only needed
+                      for max_duration
+        max_duration : np.timedelta64
+                       windows with a longer time between first and last launch are
+                       dropped, e.g. windows across a transit between circles
+    Output :
+        starts, stops : numpy arrays of int
+                        first and one-past-last index along the sequence of every
+                        window of n_sondes sondes within a single flight
+    """
+    starts = np.arange(0, len(flight) - n_sondes + 1)
+    stops = starts + n_sondes
+
+    keep = flight[starts] == flight[stops - 1]
+
+    if max_duration is not None:
+        keep &= launch_time[stops - 1] - launch_time[starts] <= max_duration
+
+    return starts[keep], stops[keep]
+
+
+def get_group_sequence(all_sonde_ids, groups):
+    """
+    Input :
+        all_sonde_ids : array
+                        sonde_ids along the 'sonde_id' dimension of Level-3
+        groups : list of lists
+                 sonde_ids of every group, e.g. sondes of a circle
+    Output :
+        rows : numpy array
+               rows along 'sonde_id' of the sondes of all groups, one group after the
+               other (sondes in several groups are repeated)
+        starts, stops : numpy arrays of int
+                        first and one-past-last index along rows of every group
+    """
+    row_of_sonde = {sonde_id: row for row, sonde_id in enumerate(all_sonde_ids)}
+
+    rows = np.array(
+        [row_of_sonde[s] for sonde_ids in groups for s in sonde_ids], dtype="int64"
+    )
+    stops = np.cumsum([len(sonde_ids) for sonde_ids in groups], dtype="int64")
+    starts = stops - np.array([len(sonde_ids) for sonde_ids in groups], dtype="int64")
+
+    return rows, starts, stops
+
+
+def window_mean(values, starts, stops):
+    """
+    Input :
+        values : numpy array
+                 values along the sequence, NaN where missing. shape: (S,)
+        starts, stops : numpy arrays of int
+                        first and one-past-last index of every window. shape: (W,)
+    Output :
+        means : numpy array
+                mean of the values that are not NaN over every window; NaN for
+                windows without any. shape: (W,)
+
+    A missing value only affects the windows that contain it, unlike in a plain
+    rgr_fn.window_sum(), where it is carried on along the prefix sum
+    """
+    valid = ~np.isnan(values)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return rf.window_sum(np.where(valid, values, 0), starts, stops) / rf.window_sum(
+            valid, starts, stops
+        )
+
+
+def regress_windows(
+    ds_lv3,
+    rows,
+    starts,
+    stops,
+    list_of_parameters=["u", "v", "q", "ta", "p"],
+    min_points=6,
+):
+    """
+    Input :
+        ds_lv3 : xarray dataset
+                 Level-3 dataset with 'sonde_id' dimension
+        rows : numpy array
+               rows along 'sonde_id' that make up the sequence of sondes
+        starts, stops : numpy arrays of int
+                        first and one-past-last index along rows of every window
+        list_of_parameters : list
+                             parameters on which regression is to be carried out
+        min_points : int
+                     minimum number of sondes with data for a regression at a level
+    Output :
+        windows : xarray dataset
+                  for every window and level, each parameter regressed to the centroid
+                  of the sondes, with its gradients as 'd'+par+'dx' and 'd'+par+'dy';
+                  also D and vor if u and v are regressed, and for every window its
+                  first and last sonde_id, mean launch time and mean launch position
+
+    The normal equations of all windows come from shared prefix sums along the
+    sequence, see rgr_fn.window_moments(), so the cost barely depends on the overlap
+    or length of the windows
+    """
+    sequence = ds_lv3.isel(sonde_id=rows)
+
+    dims = ("alt", "sonde_id")
+    x, y = get_xy_coords(
+        sequence.lat.transpose(*dims).values, sequence.lon.transpose(*dims).values
+    )
+    xy_valid = ~(np.isnan(x) | np.isnan(y))
+
+    windows = xr.Dataset(coords={"alt": ds_lv3.alt.values})
+    list_of_moments = []
+
+    for par in list_of_parameters:
+        u = sequence[par].transpose(*dims).values
+        valid = xy_valid & ~np.isnan(u)
+
+        for moments in list_of_moments:
+            if np.array_equal(moments["valid"], valid):
+                break
+        else:
+            moments = rf.window_moments(x, y, valid, starts, stops, min_points)
+            list_of_moments.append(moments)
+
+        u_centre, dudx, dudy = rf.window_solve(moments, u)
+
+        windows[par] = (["window", "alt"], u_centre.T)
+        windows["d" + par + "dx"] = (["window", "alt"], dudx.T)
+        windows["d" + par + "dy"] = (["window", "alt"], dudy.T)
+
+    if "u" in list_of_parameters and "v" in list_of_parameters:
+        windows["D"] = windows.dudx + windows.dvdy
+        windows["vor"] = windows.dvdx - windows.dudy
+
+    launch_time = sequence.launch_time.values.astype("datetime64[ns]")
+    launched = ~np.isnat(launch_time)
+    reference = launch_time[launched].min() if launched.any() else launch_time[0]
+    launch_seconds = (launch_time - reference) / np.timedelta64(1, "s")
+    mean_seconds = window_mean(launch_seconds, starts, stops)
+
+    windows["n_sondes"] = (["window"], stops - starts)
+    windows["first_sonde_id"] = (["window"], sequence.sonde_id.values[starts])
+    windows["last_sonde_id"] = (["window"], sequence.sonde_id.values[stops - 1])
+    windows["platform_id"] = (["window"], sequence.platform_id.values[starts])
+    windows["window_time"] = (
+        ["window"],
+        np.where(
+            np.isnan(mean_seconds),
+            np.datetime64("NaT", "ns"),
+            reference
+            + (np.nan_to_num(mean_seconds) * 1e9).astype("timedelta64[ns]"),
+        ),
+    )
+    for var in ["flight_lat", "flight_lon"]:
+        windows["window_" + var.split("_")[1]] = (
+            ["window"],
+            window_mean(sequence[var].values, starts, stops),
+        )
+
+    return windows
+
+
+def regress_sliding_windows(ds_lv3, n_sondes=10, max_duration=None, **kwargs):
+    """
+    Input :
+        ds_lv3 : xarray dataset
+                 Level-3 dataset with 'sonde_id' dimension
+        n_sondes : int
+                   number of consecutive sondes of a flight in every window
+        max_duration : np.timedelta64
+                       see get_sliding_window_bounds()
+        **kwargs : keyword arguments of regress_windows()
+    Output :
+        windows : xarray dataset
+                  see regress_windows(); there is a window starting at every sonde
+                  of a flight that is followed by at least n_sondes-1 sondes
+    """
+    rows, flight = get_flight_sequence(ds_lv3)
+
+    starts, stops = get_sliding_window_bounds(
+        flight,
+        n_sondes,
+        launch_time=ds_lv3.launch_time.values[rows],
+        max_duration=max_duration,
+    )
+
+    return regress_windows(ds_lv3, rows, starts, stops, **kwargs)
+
+
+def regress_sonde_groups(ds_lv3, groups, **kwargs):
+    """
+    Input :
+        ds_lv3 : xarray dataset
+                 Level-3 dataset with 'sonde_id' dimension
+        groups : list of lists
+                 sonde_ids of every group
+        **kwargs : keyword arguments of regress_windows()
+    Output :
+        windows : xarray dataset
+                  see regress_windows(); one window per group
+    """
+    rows, starts, stops = get_group_sequence(ds_lv3.sonde_id.values, groups)
+
+    return regress_windows(ds_lv3, rows, starts, stops, **kwargs)
@@ -0,0 +1,728 @@
+# %% Module to benchmark the hot paths of the processing on synthetic campaigns
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+import joanne
+from joanne import config, instrument, synthetic
+
+# sizes of the synthetic campaign (one HALO flight) of the benchmarks, as arguments of
+# synthetic.write_campaign(); circles have 12 sondes, plus 2 sondes on a straight leg
+sizes = {
+    "small": {"n_circles": 1},
+    "medium": {"n_circles": 4},
+    "large": {"n_circles": 16},
+}
+
+# parameters regressed in Level-4
+list_of_parameters = ["u", "v", "q", "ta", "p"]
+
+# %%
+
+
+def get_case(directory, size, size_kwargs=None, seed=0):
+    """
+    Input :
+        directory : string
+                    directory of the benchmark campaigns
+        size : string
+               one of sizes
+        size_kwargs : dict
+                      arguments of synthetic.write_campaign(); default sizes[size]
+        seed : int
+    Output :
+        case : dict
+               'size', 'config_file' of the campaign and 'inputs', the inputs of the
+               benchmarks, see get_input()
+
+    The campaign is written to <directory>/<size>/ if it does not exist yet
+    """
+    if size_kwargs is None:
+        size_kwargs = sizes[size]
+
+    campaign_directory = os.path.join(directory, size, "")
+    config_file = campaign_directory + "joanne_config.yaml"
+
+    if not os.path.exists(config_file):
+        synthetic.write_campaign(
+            campaign_directory,
+            platforms=["HALO"],
+            n_flights=1,
+            seed=seed,
+            **size_kwargs,
+        )
+
+    return {"size": size, "config_file": config_file, "inputs": {}}
+
+
+def get_sonde_paths(case):
+    return sorted(glob.glob(config.get_directory("level_1") + "HALO/*QC.nc"))
+
+
+def get_status_ds(case):
+    from joanne.Level_2 import fn_2 as f2
+
+    return f2.get_status_ds_for_platform("HALO", config.get_directory("qc"))
+
+
+def get_lv2_files(case):
+    return write_level_2_sondes(
+        get_input(case, "sonde_paths"), get_input(case, "status_ds")
+    )
+
+
+def get_lv2_datasets(case):
+    from joanne.Level_3 import fn_3 as f3
+
+    return [f3.ready_to_interpolate(f) for f in get_input(case, "lv2_files")]
+
+
+def get_interpolated(case):
+    return interpolate_sondes(get_input(case, "lv2_files"))
+
+
+def get_interim_files(case):
+    """
+    The gridded sondes written as interim files, which lv3_structure_from_lv2() reads
+    """
+    from joanne.Level_3 import fn_3 as f3
+
+    save_directory = config.get_directory("level_3_interim")
+    os.makedirs(save_directory, exist_ok=True)
+
+    interim_files = []
+    for file_path, (interp_ds, p_interp_ds) in zip(
+        get_input(case, "lv2_files"), get_input(case, "interpolated")
+    ):
+        file_name, p_file_name = f3.get_interim_file_names(file_path)
+        interp_ds.to_netcdf(save_directory + file_name)
+        p_interp_ds.to_netcdf(save_directory + p_file_name)
+        interim_files += [save_directory + file_name, save_directory + p_file_name]
+
+    return interim_files
+
+
+def get_circles(case):
+    """
+    The GOOD sondes of all circles of the flight segments, gathered from Level-3 as in
+    ready_ds_for_regression.get_circles()
+    """
+    from joanne.Level_3 import fn_3 as f3
+    from joanne.Level_4 import ready_ds_for_regression as prep
+
+    get_input(case, "interim_files")
+    lv3_dataset = f3.get_lv3_to_save_dataset(
+        f3.lv3_structure_from_lv2(get_input(case, "lv2_files"))
+    )
+
+    sonde_ids = prep.get_circle_times_from_yaml()[0]
+    circle_sonde_ids = [ids for flight_ids in sonde_ids for ids in flight_ids]
+
+    return prep.gather_circles(
+        lv3_dataset,
+        prep.get_circle_gather_index(lv3_dataset.sonde_id.values, circle_sonde_ids),
+    )
+
+
+def get_xy_circles(case):
+    from joanne.Level_4 import ready_ds_for_regression as prep
+
+    circles = get_input(case, "circles").copy(deep=True)
+    prep.get_xy_coords_for_circles(circles)
+
+    return circles
+
+
+def get_regressed_circles(case):
+    from joanne.Level_4 import rgr_fn as rf
+
+    return rf.fit2d_for_parameters(
+        get_input(case, "xy_circles").copy(deep=True), list_of_parameters
+    )
+
+
+# functions that create the inputs of the benchmarks, each from the campaign and the
+# inputs before it
+input_functions = {
+    "sonde_paths": get_sonde_paths,
+    "status_ds": get_status_ds,
+    "lv2_files": get_lv2_files,
+    "lv2_datasets": get_lv2_datasets,
+    "interpolated": get_interpolated,
+    "interim_files": get_interim_files,
+    "circles": get_circles,
+    "xy_circles": get_xy_circles,
+    "regressed_circles": get_regressed_circles,
+}
+
+
+def get_input(case, name):
+    """
+    Input :
+        case : dict
+               from get_case()
+        name : string
+               one of input_functions
+    Output :
+        value : the input; it is created only once per case, or taken from the output of
+                a benchmark that was run before (see make_benchmark())
+    """
+    if name not in case["inputs"]:
+        case["inputs"][name] = input_functions[name](case)
+
+    return case["inputs"][name]
+
+
+# %% functions that run a step over all sondes, as the pipeline does
+
+
+def write_level_2_sondes(sonde_paths, status_ds):
+    from joanne.Level_2 import fn_2 as f2
+
+    save_directory = config.get_directory("level_2")
+    os.makedirs(save_directory, exist_ok=True)
+
+    lv2_files = [
+        f2.write_level_2_sonde("HALO", sonde_path, status_ds, save_directory)
+        for sonde_path in sonde_paths
+    ]
+
+    return [file_path for file_path in lv2_files if file_path is not None]
+
+
+def interpolate_sondes(lv2_files):
+    from joanne.Level_3 import fn_3 as f3
+
+    return [
+        f3.interpolate_for_level_3(file_path, pressure_levels=True)
+        for file_path in lv2_files
+    ]
+
+
+def interpolate_pressures(datasets, output_altitudes):
+    from joanne.Level_3 import fn_3 as f3
+
+    return [
+        f3.pressure_interpolation(ds.p.values, ds.alt.values, output_altitudes)
+        for ds in datasets
+    ]
+
+
+# %%
+
+
+def make_benchmark(name, function, prepare, count, output=None):
+    """
+    Input :
+        name : string
+        function : callable
+                   the timed function
+        prepare : callable
+                  called with the case before every run (untimed); returns the
+                  arguments of function
+        count : callable
+                called with the case; returns the number of items (sondes or circles)
+                processed by a run
+        output : string
+                 name of the input (see input_functions) that the output of function is,
+                 so that later benchmarks use it instead of creating it again
+    Output :
+        benchmark : dict
+    """
+    return {
+        "name": name,
+        "function": function,
+        "prepare": prepare,
+        "count": count,
+        "output": output,
+    }
+
+
+def prepare_status(case):
+    get_input(case, "sonde_paths")
+
+    # an existing status file would be returned as it is
+    for file_path in glob.glob(config.get_directory("qc") + "Status_of_sondes_*.nc"):
+        os.remove(file_path)
+
+    return ("HALO", config.get_directory("qc"))
+
+
+def prepare_assembly(case):
+    get_input(case, "interim_files")
+
+    return (get_input(case, "lv2_files"),)
+
+
+def count_sondes(case):
+    return len(get_input(case, "sonde_paths"))
+
+
+def count_lv2_sondes(case):
+    return len(get_input(case, "lv2_files"))
+
+
+def count_circles(case):
+    return len(get_input(case, "circles").circle)
+
+
+def get_benchmarks():
+    """
+    Output :
+        benchmarks : list
+                     all benchmarks, in the order of the processing, see make_benchmark()
+    """
+    from joanne.Level_2 import fn_2 as f2
+    from joanne.Level_3 import fn_3 as f3
+    from joanne.Level_4 import ready_ds_for_regression as prep
+    from joanne.Level_4 import rgr_fn as rf
+
+    return [
+        make_benchmark(
+            "get_status_ds_for_platform",
+            f2.get_status_ds_for_platform,
+            prepare_status,
+            count_sondes,
+            output="status_ds",
+        ),
+        make_benchmark(
+            "write_level_2_sonde",
+            write_level_2_sondes,
+            lambda case: (
+                get_input(case, "sonde_paths"),
+                get_input(case, "status_ds"),
+            ),
+            count_sondes,
+            output="lv2_files",
+        ),
+        make_benchmark(
+            "interpolate_for_level_3",
+            interpolate_sondes,
+            lambda case: (get_input(case, "lv2_files"),),
+            count_lv2_sondes,
+            output="interpolated",
+        ),
+        make_benchmark(
+            "pressure_interpolation",
+            interpolate_pressures,
+            lambda case: (
+                get_input(case, "lv2_datasets"),
+                np.arange(0, 10001, 10),
+            ),
+            count_lv2_sondes,
+        ),
+        make_benchmark(
+            "lv3_structure_from_lv2",
+            f3.lv3_structure_from_lv2,
+            prepare_assembly,
+            count_lv2_sondes,
+        ),
+        make_benchmark(
+            "get_xy_coords_for_circles",
+            prep.get_xy_coords_for_circles,
+            lambda case: (get_input(case, "circles").copy(deep=True),),
+            count_circles,
+        ),
+        make_benchmark(
+            "fit2d_xr",
+            rf.fit2d_xr,
+            lambda case: (
+                get_input(case, "xy_circles").dx,
+                get_input(case, "xy_circles").dy,
+                get_input(case, "xy_circles").u,
+                ["sounding"],
+            ),
+            count_circles,
+        ),
+        make_benchmark(
+            "get_circle_products",
+            rf.get_circle_products,
+            lambda case: (get_input(case, "regressed_circles").copy(deep=True),),
+            count_circles,
+        ),
+    ]
+
+
+def run_benchmark(benchmark, case, repeat=3, allocations=True):
+    """
+    Input :
+        benchmark : dict
+                    from make_benchmark()
+        case : dict
+               from get_case(); the settings of its campaign must be set
+        repeat : int
+                 number of timed runs
+        allocations : bool
+                      if True, the peak memory allocated by Python is measured in one
+                      more run, with tracemalloc (which would slow down the timed runs)
+    Output :
+        result : dict
+                 number of items, the fastest and median time of the runs, the
+                 throughput (items per second, of the fastest run), the peak memory
+                 allocated and the peak RSS
+
+    The runs are timed with joanne.instrument, whose records of the runs are removed
+    afterwards
+    """
+    n_items = benchmark["count"](case)
+    runs = []
+
+    for traced in [True] * allocations + [False] * repeat:
+        args = benchmark["prepare"](case)
+        n_records = len(instrument.records)
+
+        instrument.start(allocations=traced)
+        try:
+            with instrument.timed("benchmark:" + benchmark["name"], n_items=n_items):
+                output = benchmark["function"](*args)
+        finally:
+            instrument.stop()
+
+        runs.append(dict(instrument.records[-1], traced=traced))
+        del instrument.records[n_records:]
+
+    if benchmark["output"] is not None:
+        case["inputs"][benchmark["output"]] = output
+
+    seconds = [run["seconds"] for run in runs if not run["traced"]]
+    peak_allocated = [run["peak_allocated"] for run in runs if run["traced"]]
+    peak_rss = [run["peak_rss"] for run in runs if run["peak_rss"] is not None]
+
+    return {
+        "items": n_items,
+        "seconds": min(seconds),
+        "median_seconds": float(np.median(seconds)),
+        "items_per_second": n_items / min(seconds) if min(seconds) > 0 else None,
+        "peak_allocated": peak_allocated[0] if len(peak_allocated) > 0 else None,
+        "peak_rss": max(peak_rss) if len(peak_rss) > 0 else None,
+    }
+
+
+def run_benchmarks(
+    directory,
+    names=None,
+    sizes_to_run=["small"],
+    repeat=3,
+    allocations=True,
+    size_kwargs=None,
+):
+    """
+    Input :
+        directory : string
+                    directory of the benchmark campaigns, see get_case()
+        names : list
+                names of the benchmarks to run; default all
+        sizes_to_run : list
+                       names of sizes
+        repeat, allocations : see run_benchmark()
+        size_kwargs : dict
+                      campaign of every size, see get_case(); default sizes
+    Output :
+        results : dict
+                  result of every benchmark (see run_benchmark()) for every size,
+                  keyed by benchmark name and size
+    """
+    if size_kwargs is None:
+        size_kwargs = sizes
+
+    benchmarks = get_benchmarks()
+    if names is not None:
+        unknown = set(names) - set(b["name"] for b in benchmarks)
+        if len(unknown) > 0:
+            raise ValueError(f"unknown benchmarks: {sorted(unknown)}")
+        benchmarks = [b for b in benchmarks if b["name"] in names]
+
+    results = {benchmark["name"]: {} for benchmark in benchmarks}
+
+    for size in sizes_to_run:
+        case = get_case(directory, size, size_kwargs[size])
+        previous_settings = config.set_config(case["config_file"])
+
+        try:
+            for benchmark in benchmarks:
+                print(f"Benchmarking {benchmark['name']} ({size}) ...")
+                results[benchmark["name"]][size] = run_benchmark(
+                    benchmark, case, repeat=repeat, allocations=allocations
+                )
+        finally:
+            config.set_config(**previous_settings)
+
+    return results
+
+
+# %%
+
+
+def get_git_commit():
+    """
+    Output :
+        commit : string
+                 abbreviated hash of the checked-out commit of JOANNE; None if it is not
+                 a git repository
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_history_entry(results, label=None):
+    """
+    Input :
+        results : dict
+                  from run_benchmarks()
+        label : string
+                e.g. a description of the change
+    Output :
+        entry : dict
+                results with the time, JOANNE version, commit and machine of the run
+    """
+    return {
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "joanne_version": str(joanne.__version__),
+        "commit": get_git_commit(),
+        "label": label,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+
+def load_history(file_path):
+    """
+    Input :
+        file_path : string
+                    JSON lines file with one entry (see get_history_entry()) per run
+    Output :
+        history : list
+                  entries, oldest first; empty if the file does not exist
+    """
+    if not os.path.exists(file_path):
+        return []
+
+    with open(file_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_to_history(file_path, entry):
+    """
+    Input :
+        file_path : string
+                    see load_history()
+        entry : dict
+                from get_history_entry()
+    """
+    with open(file_path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def get_change(new, old):
+    if new is None or old is None or old == 0:
+        return None
+    return new / old - 1
+
+
+def get_baseline(history, n_runs=5):
+    """
+    Input :
+        history : list
+                  from load_history()
+        n_runs : int
+                 number of latest runs of every benchmark and size to take into account
+    Output :
+        baseline : dict
+                   for every benchmark and size, the median throughput and peak memory
+                   allocated of its n_runs latest runs in history, so that a single
+                   slow or fast run does not shift the baseline
+    """
+    runs = {}
+    for entry in history:
+        for name, by_size in entry["results"].items():
+            for size, result in by_size.items():
+                runs.setdefault(name, {}).setdefault(size, []).append(result)
+
+    def median(values):
+        values = [value for value in values if value is not None]
+        return float(np.median(values)) if len(values) > 0 else None
+
+    baseline = {}
+    for name, by_size in runs.items():
+        for size, results in by_size.items():
+            latest = results[-n_runs:]
+            baseline.setdefault(name, {})[size] = {
+                key: median([result[key] for result in latest])
+                for key in ["items_per_second", "peak_allocated"]
+            }
+
+    return baseline
+
+
+def compare_results(results, baseline, threshold=0.2):
+    """
+    Input :
+        results : dict
+                  from run_benchmarks()
+        baseline : dict
+                   results of earlier runs, see get_baseline()
+        threshold : float
+                    relative change beyond which a benchmark regressed
+    Output :
+        comparison : list
+                     for every benchmark and size, the throughput and peak memory
+                     allocated, their relative change from baseline (None if it is not
+                     in baseline), and whether it regressed, i.e. its throughput dropped
+                     or its memory grew by more than threshold
+    """
+    comparison = []
+
+    for name, by_size in results.items():
+        for size, result in by_size.items():
+            old = baseline.get(name, {}).get(size, {})
+
+            throughput_change = get_change(
+                result["items_per_second"], old.get("items_per_second")
+            )
+            memory_change = get_change(
+                result["peak_allocated"], old.get("peak_allocated")
+            )
+
+            comparison.append(
+                {
+                    "name": name,
+                    "size": size,
+                    "items_per_second": result["items_per_second"],
+                    "throughput_change": throughput_change,
+                    "peak_allocated": result["peak_allocated"],
+                    "memory_change": memory_change,
+                    "regressed": (
+                        throughput_change is not None and throughput_change < -threshold
+                    )
+                    or (memory_change is not None and memory_change > threshold),
+                }
+            )
+
+    return comparison
+
+
+def format_comparison(comparison):
+    """
+    Input :
+        comparison : list
+                     from compare_results()
+    Output :
+        table : string
+    """
+
+    def percent(change):
+        return "" if change is None else f"{100 * change:+.1f}%"
+
+    lines = [
+        f"{'benchmark':<28}{'size':<8}{'items/s':>12}{'change':>9}"
+        f"{'peak MB':>10}{'change':>9}"
+    ]
+    for row in comparison:
+        peak = row["peak_allocated"]
+        lines.append(
+            f"{row['name']:<28}{row['size']:<8}"
+            f"{row['items_per_second'] or float('nan'):>12.2f}"
+            f"{percent(row['throughput_change']):>9}"
+            f"{float('nan') if peak is None else peak / 10 ** 6:>10.1f}"
+            f"{percent(row['memory_change']):>9}"
+            + ("  REGRESSED" if row["regressed"] else "")
+        )
+
+    return "\n".join(lines)
+
+
+# %%
+
+parser = argparse.ArgumentParser(
+    description="This script benchmarks the hot paths of the JOANNE processing (QC, Level-2, Level-3 gridding and assembly, and the Level-4 regression) on synthetic campaigns of several sizes. The results are compared with the median of the latest runs in a history file; the script fails if a benchmark regressed by more than the threshold, and only runs without regressions are added to the history unless --accept is given."
+)
+parser.add_argument(
+    "--directory",
+    help="Directory of the synthetic campaigns and of the history; default joanne_benchmarks/ in the temporary directory of the system.",
+)
+parser.add_argument(
+    "--sizes",
+    nargs="+",
+    default=["small"],
+    choices=list(sizes),
+    help="Sizes of the campaign to benchmark.",
+)
+parser.add_argument("--only", nargs="+", help="Names of the benchmarks to run.")
+parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs.")
+parser.add_argument(
+    "--no-allocations",
+    action="store_true",
+    help="Do not measure the peak memory allocated (saves one run per benchmark).",
+)
+parser.add_argument(
+    "--history",
+    help="JSON lines file of the results of all runs; default benchmark_history.jsonl in the directory.",
+)
+parser.add_argument("--label", help="Label of this run in the history.")
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=0.2,
+    help="Relative drop of throughput or growth of peak memory, compared with the baseline from the history, beyond which a benchmark fails.",
+)
+parser.add_argument(
+    "--baseline-runs",
+    type=int,
+    default=5,
+    help="Number of latest runs in the history whose median is the baseline.",
+)
+parser.add_argument(
+    "--accept",
+    action="store_true",
+    help="Add this run to the history even if a benchmark regressed, e.g. after an expected slowdown.",
+)
+parser.add_argument(
+    "--no-save", action="store_true", help="Do not add this run to the history."
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    directory = args.directory or os.path.join(
+        tempfile.gettempdir(), "joanne_benchmarks", ""
+    )
+    history_path = args.history or os.path.join(directory, "benchmark_history.jsonl")
+
+    results = run_benchmarks(
+        directory,
+        names=args.only,
+        sizes_to_run=args.sizes,
+        repeat=args.repeat,
+        allocations=not args.no_allocations,
+    )
+
+    history = load_history(history_path)
+    baseline = get_baseline(history, n_runs=args.baseline_runs)
+    comparison = compare_results(results, baseline, threshold=args.threshold)
+    regressed = any(row["regressed"] for row in comparison)
+
+    print(format_comparison(comparison))
+
+    # a regressed run would otherwise become part of the next baseline
+    if not args.no_save and (args.accept or not regressed):
+        append_to_history(history_path, get_history_entry(results, label=args.label))
+
+    if regressed:
+        sys.exit(1)
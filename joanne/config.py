@@ -0,0 +1,214 @@
+# %% Module for the configuration of JOANNE: directories and performance settings
+import os
+
+import yaml
+
+# settings and their defaults; a YAML file (given directly or as $JOANNE_CONFIG) can set
+# any of them, and environment variables ($JOANNE_ + upper-case name) override both.
+# Relative directories are relative to the working directory
+default_settings = {
+    # root of the input data, with the Level_0 and Level_1 directories
+    "data_directory": ".",
+    # root of the products, with the QC, Level_2, Level_3 and Level_4 directories;
+    # default data_directory
+    "output_directory": None,
+    # root of the interim files and caches; default output_directory
+    "cache_directory": None,
+    # directory with the YAML files of the flight segmentation;
+    # default the flight_segments directory in data_directory
+    "yaml_directory": None,
+    # number of worker processes of the pipeline; None for os.cpu_count()
+    "workers": None,
+    # number of resamples regressed at once; None to derive it from memory_budget
+    "chunk_size": None,
+    # memory (in bytes, or e.g. '4GB') that the arrays of a batched computation may use
+    "memory_budget": 2 * 10 ** 9,
+    # compression of the written NC files, one of codec_profiles
+    "codec_profile": "default",
+    # number of datasets kept in the in-memory caches of a (worker) process
+    "cache_size": 4,
+    # dtype of the fields between the steps of Level-3 and Level-4, see joanne.precision
+    "working_dtype": "float64",
+}
+
+codec_profiles = {
+    "default": dict(zlib=True, complevel=4, fletcher32=True),
+    "fast": dict(zlib=True, complevel=1, shuffle=True, fletcher32=True),
+    "none": dict(zlib=False, fletcher32=False),
+}
+
+# %%
+
+
+def parse_size(size):
+    """
+    Input :
+        size : int, float or string
+               number of bytes, or a string such as '512MB' or '4GB'
+    Output :
+        size : int
+               number of bytes
+    """
+    if not isinstance(size, str):
+        return int(size)
+
+    units = {"KB": 10 ** 3, "MB": 10 ** 6, "GB": 10 ** 9, "TB": 10 ** 12, "B": 1}
+    size = size.strip().upper()
+    for unit, factor in units.items():
+        if size.endswith(unit):
+            return int(float(size[: -len(unit)]) * factor)
+
+    return int(float(size))
+
+
+def load_config(config_file=None, environ=os.environ):
+    """
+    Input :
+        config_file : string
+                      YAML file with settings; default $JOANNE_CONFIG, if set
+        environ : dict
+                  environment variables; $JOANNE_<SETTING> overrides the setting
+    Output :
+        settings : dict
+                   all settings, see default_settings
+    """
+    settings = dict(default_settings)
+
+    if config_file is None:
+        config_file = environ.get("JOANNE_CONFIG")
+
+    if config_file is not None:
+        with open(config_file) as f:
+            from_file = yaml.safe_load(f) or {}
+
+        unknown = set(from_file) - set(default_settings)
+        if len(unknown) > 0:
+            raise ValueError(f"unknown settings in {config_file}: {sorted(unknown)}")
+
+        settings.update(from_file)
+
+    for key in default_settings:
+        if "JOANNE_" + key.upper() in environ:
+            settings[key] = yaml.safe_load(environ["JOANNE_" + key.upper()])
+
+    return check_settings(settings)
+
+
+def check_settings(settings):
+    """
+    Input :
+        settings : dict
+    Output :
+        settings : dict
+                   with directories ending in a separator and memory_budget in bytes
+    """
+    if settings["codec_profile"] not in codec_profiles:
+        raise ValueError(
+            f"codec_profile must be one of {list(codec_profiles)}, "
+            f"not {settings['codec_profile']}"
+        )
+
+    if settings["working_dtype"] not in ["float32", "float64"]:
+        raise ValueError(
+            f"working_dtype must be float32 or float64, not {settings['working_dtype']}"
+        )
+
+    for key in ["data_directory", "output_directory", "cache_directory", "yaml_directory"]:
+        if settings[key] is not None:
+            settings[key] = os.path.join(str(settings[key]), "")
+
+    settings["memory_budget"] = parse_size(settings["memory_budget"])
+
+    return settings
+
+
+# settings of this process
+settings = load_config()
+
+
+def set_config(config_file=None, **kwargs):
+    """
+    Input :
+        config_file : string
+                      YAML file with settings, see load_config()
+        **kwargs : settings that override those from the file and environment
+    Output :
+        previous_settings : dict
+                            settings before this call, e.g. to restore them with
+                            set_config(**previous_settings)
+    """
+    unknown = set(kwargs) - set(default_settings)
+    if len(unknown) > 0:
+        raise ValueError(f"unknown settings: {sorted(unknown)}")
+
+    previous_settings = dict(settings)
+
+    new_settings = load_config(config_file) if config_file is not None else {}
+    new_settings = dict(previous_settings, **new_settings, **kwargs)
+    settings.update(check_settings(new_settings))
+
+    return previous_settings
+
+
+def get_directory(name):
+    """
+    Input :
+        name : string
+               'level_0', 'level_1', 'qc', 'logs', 'level_2', 'level_3', 'level_4',
+               'level_3_interim', 'level_4_interim', 'cache' or 'yaml'
+    Output :
+        directory : string
+                    path of the directory, ending in a separator
+    """
+    data = settings["data_directory"]
+    output = settings["output_directory"] or data
+    cache = settings["cache_directory"] or output
+
+    directories = {
+        "level_0": os.path.join(data, "Level_0", ""),
+        "level_1": os.path.join(data, "Level_1", ""),
+        "qc": os.path.join(output, "QC", ""),
+        "logs": os.path.join(output, "Level_2", "logs_and_stats", ""),
+        "level_2": os.path.join(output, "Level_2", ""),
+        "level_3": os.path.join(output, "Level_3", ""),
+        "level_4": os.path.join(output, "Level_4", ""),
+        "level_3_interim": os.path.join(cache, "Level_3", "Interim_files", ""),
+        "level_4_interim": os.path.join(cache, "Level_4", "Interim_files", ""),
+        "cache": os.path.join(cache, ""),
+        "yaml": settings["yaml_directory"] or os.path.join(data, "flight_segments", ""),
+    }
+
+    return directories[name]
+
+
+def get_compression():
+    """
+    Output :
+        compression : dict
+                      netCDF4 compression settings of the codec_profile, to be used in
+                      the encoding of every compressed variable
+    """
+    return dict(codec_profiles[settings["codec_profile"]])
+
+
+def get_chunk_size(bytes_per_item, chunk_size=None):
+    """
+    Input :
+        bytes_per_item : int
+                         memory used by the arrays of a single item of a batch
+        chunk_size : int
+                     if given, it is returned as it is
+    Output :
+        chunk_size : int
+                     the chunk_size setting, or else the number of items that fit into
+                     memory_budget (at least 1)
+    """
+    if chunk_size is not None:
+        return chunk_size
+    if settings["chunk_size"] is not None:
+        return settings["chunk_size"]
+
+    return max(1, int(settings["memory_budget"] // bytes_per_item))
+
+
+# %%
@@ -0,0 +1,255 @@
+# %% Module to time the processing stages and hot functions, and to write a run report
+import contextlib
+import datetime
+import functools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import joanne
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS is then not recorded
+    resource = None
+
+# timers only record while enabled, see start()
+enabled = False
+
+# one record per timed call: name, parent, seconds, n_items and memory figures
+records = []
+
+# timers that are running, innermost last
+_stack = []
+
+# %%
+
+
+def get_peak_rss():
+    """
+    Output :
+        peak_rss : int
+                   peak resident set size (in bytes) of this process so far; None if
+                   it is not available
+    """
+    if resource is None:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return int(peak_rss) if sys.platform == "darwin" else int(peak_rss) * 1024
+
+
+def start(allocations=False):
+    """
+    Input :
+        allocations : bool
+                      if True, the peak memory allocated by Python within every timer
+                      is recorded too, using tracemalloc (which slows down the run)
+    """
+    global enabled
+    enabled = True
+
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stop():
+    """
+    Stop recording; the records are kept until clear()
+    """
+    global enabled
+    enabled = False
+
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def clear():
+    """
+    Remove all records
+    """
+    del records[:]
+
+
+@contextlib.contextmanager
+def timed(name, n_items=1):
+    """
+    Input :
+        name : string
+               name of the timed stage or function
+        n_items : int
+                  number of items (sondes, circles, ...) processed, for the time per item
+
+    Context manager that records the wall-clock time of its block, the peak RSS of the
+    process after it and by how much the block raised it, and, while tracemalloc is
+    tracing, the peak memory allocated within the block (before Python 3.9, which has
+    no tracemalloc.reset_peak(), an upper bound: the peak since tracing started)
+    """
+    if not enabled:
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if len(_stack) > 0:
+            # keep the peak of the enclosing timer before it is reset
+            _stack[-1]["peak_traced"] = max(_stack[-1]["peak_traced"], peak)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+    else:
+        current = 0
+
+    timer = {"name": name, "start_traced": current, "peak_traced": current}
+    _stack.append(timer)
+    rss_before = get_peak_rss()
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        rss_after = get_peak_rss()
+        _stack.pop()
+
+        record = {
+            "name": name,
+            "parent": _stack[-1]["name"] if len(_stack) > 0 else None,
+            "seconds": seconds,
+            "n_items": int(n_items),
+            "peak_rss": rss_after,
+            "rss_increase": None if rss_after is None else rss_after - rss_before,
+            "peak_allocated": None,
+        }
+        if tracing and tracemalloc.is_tracing():
+            peak = max(timer["peak_traced"], tracemalloc.get_traced_memory()[1])
+            record["peak_allocated"] = peak - timer["start_traced"]
+            if len(_stack) > 0:
+                _stack[-1]["peak_traced"] = max(_stack[-1]["peak_traced"], peak)
+
+        records.append(record)
+
+
+def instrumented(name=None, count=None):
+    """
+    Input :
+        name : string
+               name of the timer; default the function's module and name
+        count : callable
+                called with the function's arguments, returns the number of items
+                processed by the call; default 1
+    Output :
+        decorator : callable
+                    decorator that runs the function within timed()
+    """
+
+    def decorator(function):
+        timer_name = name or f"{function.__module__}.{function.__name__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+
+            n_items = 1 if count is None else count(*args, **kwargs)
+            with timed(timer_name, n_items=n_items):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_along(dim):
+    """
+    Input :
+        dim : string
+              dimension, e.g. 'sonde_id' or 'circle'
+    Output :
+        count : callable
+                for instrumented(); the length of dim in the first argument (a dataset)
+                of the function, 1 if the dataset does not have dim
+    """
+
+    def count(dataset, *args, **kwargs):
+        return dataset.sizes.get(dim, 1)
+
+    return count
+
+
+def get_report(records=records):
+    """
+    Input :
+        records : list
+                  records from timed(); default all records of this process
+    Output :
+        report : dict
+                 for every timer, the number of calls and items, the total time, the
+                 percentiles of the time per item (e.g. per sonde or per circle) over
+                 all calls, and the largest peak RSS, RSS increase and allocation
+
+    For calls that process several items at once (e.g. all circles in a batched
+    regression), every item of a call is assigned the mean time per item of the call
+    """
+    timers = {}
+
+    for name in dict.fromkeys(record["name"] for record in records):
+        calls = [record for record in records if record["name"] == name]
+        seconds = np.array([record["seconds"] for record in calls])
+        n_items = np.array([record["n_items"] for record in calls])
+
+        per_item = np.repeat(seconds / np.maximum(n_items, 1), np.maximum(n_items, 1))
+
+        timers[name] = {
+            "parent": calls[0]["parent"],
+            "calls": len(calls),
+            "items": int(n_items.sum()),
+            "total_seconds": float(seconds.sum()),
+            "seconds_per_item": {
+                "mean": float(per_item.mean()),
+                "p50": float(np.percentile(per_item, 50)),
+                "p90": float(np.percentile(per_item, 90)),
+                "p99": float(np.percentile(per_item, 99)),
+                "max": float(per_item.max()),
+            },
+        }
+        for key in ["peak_rss", "rss_increase", "peak_allocated"]:
+            values = [record[key] for record in calls if record[key] is not None]
+            timers[name][key] = max(values) if len(values) > 0 else None
+
+    return {
+        "joanne_version": str(joanne.__version__),
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timers": timers,
+    }
+
+
+def write_report(file_path, records=records, **metadata):
+    """
+    Input :
+        file_path : string
+                    path of the JSON report
+        records : list
+                  see get_report()
+        **metadata : further JSON-serializable entries of the report, e.g. the settings
+    Output :
+        file_path : string
+    """
+    report = dict(get_report(records), **metadata)
+
+    with open(file_path, "w") as f:
+        json.dump(report, f, indent=1)
+
+    return file_path
+
+
+# %%
@@ -0,0 +1,776 @@
+# %% Module to run the JOANNE processing as a graph of tasks with explicit inputs and
+# outputs, re-running only the tasks whose inputs changed since their last run
+import concurrent.futures
+import fnmatch
+import glob
+import hashlib
+import importlib
+import json
+import os
+import time
+import tracemalloc
+
+import joanne
+from joanne import config, instrument
+
+# stages of the processing, in the order in which they depend on each other
+stages = ["qc", "level_2", "level_3", "level_3_assembly", "level_4"]
+
+# modules imported by every worker process when it starts, so that tasks do not pay
+# for importing them
+preload_modules = [
+    "xarray",
+    "netCDF4",
+    "metpy.calc",
+    "joanne.reader",
+    "joanne.Level_2.dicts",
+    "joanne.Level_2.fn_2",
+    "joanne.Level_3.dicts",
+    "joanne.Level_3.fn_3",
+    "joanne.Level_4.dicts",
+    "joanne.Level_4.rgr_fn",
+]
+
+# %%
+
+
+def make_task(name, stage, function, inputs=[], deps=[], **kwargs):
+    """
+    Input :
+        name : string
+               unique name of the task
+        stage : string
+                one of stages
+        function : callable
+                   module-level function called as function(inputs, **kwargs), returning
+                   the list of paths of the files it wrote
+        inputs : list
+                 paths of the files the task reads, besides the outputs of its deps
+        deps : list
+               names of the tasks whose outputs the task reads
+        **kwargs : keyword arguments of function
+    Output :
+        task : dict
+    """
+    return {
+        "name": name,
+        "stage": stage,
+        "function": function,
+        "inputs": list(inputs),
+        "deps": list(deps),
+        "kwargs": kwargs,
+    }
+
+
+def get_file_fingerprint(file_path, chunk_size=2 ** 20):
+    """
+    Input :
+        file_path : string
+    Output :
+        fingerprint : string
+                      SHA-1 hash of the file's contents; 'missing' if there is no file
+    """
+    if not os.path.exists(file_path):
+        return "missing"
+
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def get_task_inputs(task, state):
+    """
+    Input :
+        task : dict
+               see make_task()
+        state : dict
+                last run of every task, see load_state()
+    Output :
+        inputs : list
+                 the task's own inputs followed by the recorded outputs of its deps,
+                 in the order of deps
+    """
+    inputs = list(task["inputs"])
+    for dep in task["deps"]:
+        inputs += state.get(dep, {}).get("outputs", [])
+
+    return inputs
+
+
+def get_task_fingerprint(task, inputs):
+    """
+    Input :
+        task : dict
+               see make_task()
+        inputs : list
+                 from get_task_inputs()
+    Output :
+        fingerprint : string
+                      SHA-1 hash of the JOANNE version, the task's function and keyword
+                      arguments, and the paths and contents of all its inputs
+    """
+    fingerprint = hashlib.sha1()
+    fingerprint.update(str(joanne.__version__).encode())
+    fingerprint.update(
+        f"{task['function'].__module__}.{task['function'].__qualname__}".encode()
+    )
+    fingerprint.update(repr(sorted(task["kwargs"].items())).encode())
+
+    for file_path in inputs:
+        fingerprint.update(f"{file_path}={get_file_fingerprint(file_path)};".encode())
+
+    return fingerprint.hexdigest()
+
+
+def load_state(state_path):
+    """
+    Input :
+        state_path : string
+                     path of the JSON file with the state of the pipeline
+    Output :
+        state : dict
+                for every task that ran, the fingerprint of its inputs at that time and
+                its outputs, keyed by task name; empty if there is no state file
+    """
+    if not os.path.exists(state_path):
+        return {}
+
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_state(state, state_path):
+    """
+    Input :
+        state : dict
+                see load_state()
+        state_path : string
+    Output :
+        state_path : string
+
+    The state file is replaced atomically, so an interrupted run leaves a valid state
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_path + ".tmp", state_path)
+
+    return state_path
+
+
+def get_execution_order(tasks):
+    """
+    Input :
+        tasks : list
+                tasks from make_task()
+    Output :
+        order : list
+                task names, every task after all of its deps
+    """
+    by_name = {task["name"]: task for task in tasks}
+    if len(by_name) < len(tasks):
+        raise ValueError("task names are not unique")
+
+    n_pending = {}
+    dependents = {name: [] for name in by_name}
+    for task in tasks:
+        for dep in task["deps"]:
+            if dep not in by_name:
+                raise ValueError(f"task {task['name']} depends on unknown task {dep}")
+            dependents[dep].append(task["name"])
+        n_pending[task["name"]] = len(task["deps"])
+
+    order = [task["name"] for task in tasks if n_pending[task["name"]] == 0]
+    for name in order:
+        for dependent in dependents[name]:
+            n_pending[dependent] -= 1
+            if n_pending[dependent] == 0:
+                order.append(dependent)
+
+    if len(order) < len(tasks):
+        raise ValueError("tasks have circular dependencies")
+
+    return order
+
+
+def select_tasks(tasks, only=None, until=None):
+    """
+    Input :
+        tasks : list
+                tasks from make_task()
+        only : list
+               stage names or task name patterns (e.g. 'level_2:HALO*'); only matching
+               tasks are selected
+        until : string
+                stage name; only tasks of this and earlier stages are selected
+    Output :
+        selected : set
+                   names of the selected tasks
+
+    Tasks that are not selected are not run; their last recorded outputs are used as
+    inputs of the selected tasks
+    """
+    if until is not None and until not in stages:
+        raise ValueError(f"until must be one of {stages}, not {until}")
+
+    selected = set()
+    for task in tasks:
+        if until is not None and stages.index(task["stage"]) > stages.index(until):
+            continue
+        if only is not None and not any(
+            task["stage"] == pattern or fnmatch.fnmatchcase(task["name"], pattern)
+            for pattern in only
+        ):
+            continue
+        selected.add(task["name"])
+
+    return selected
+
+
+def is_up_to_date(name, fingerprint, state):
+    """
+    Input :
+        name : string
+               task name
+        fingerprint : string
+                      current fingerprint of the task, see get_task_fingerprint()
+        state : dict
+                see load_state()
+    Output :
+        reason : string
+                 'up to date', or why the task has to run
+    """
+    if name not in state:
+        return "new"
+    if state[name]["fingerprint"] != fingerprint:
+        return "inputs changed"
+    if not all(os.path.exists(file_path) for file_path in state[name]["outputs"]):
+        return "outputs missing"
+
+    return "up to date"
+
+
+def plan_tasks(tasks, state, selected=None):
+    """
+    Input :
+        tasks : list
+                tasks from make_task()
+        state : dict
+                see load_state()
+        selected : set
+                   names of the tasks to consider, see select_tasks(); default all
+    Output :
+        plan : list
+               (name, reason) of the selected tasks in execution order; reason is
+               'up to date' for tasks that will not run
+
+    A task downstream of a task that will run is planned with reason 'upstream'; it is
+    checked again when its deps have finished, and skipped if its inputs turn out to be
+    unchanged
+    """
+    by_name = {task["name"]: task for task in tasks}
+    if selected is None:
+        selected = set(by_name)
+
+    plan = []
+    to_run = set()
+
+    for name in get_execution_order(tasks):
+        if name not in selected:
+            continue
+        task = by_name[name]
+
+        if any(dep in to_run for dep in task["deps"]):
+            reason = "upstream"
+        else:
+            fingerprint = get_task_fingerprint(task, get_task_inputs(task, state))
+            reason = is_up_to_date(name, fingerprint, state)
+
+        if reason != "up to date":
+            to_run.add(name)
+        plan.append((name, reason))
+
+    return plan
+
+
+def format_plan(plan, tasks):
+    """
+    Input :
+        plan : list
+               from plan_tasks()
+        tasks : list
+                tasks from make_task()
+    Output :
+        text : string
+               number of tasks to run per stage, followed by every task to run
+    """
+    stage_of = {task["name"]: task["stage"] for task in tasks}
+
+    lines = []
+    for stage in stages:
+        reasons = [reason for name, reason in plan if stage_of[name] == stage]
+        if len(reasons) > 0:
+            n_run = sum(reason != "up to date" for reason in reasons)
+            lines.append(f"{stage:<20}{n_run:>6} of {len(reasons):>6} tasks to run")
+
+    for name, reason in plan:
+        if reason != "up to date":
+            lines.append(f"  run {name} ({reason})")
+
+    return "\n".join(lines)
+
+
+def preload(modules, settings=None, instrumentation=None):
+    """
+    Input :
+        modules : list
+                  names of the modules to import
+        settings : dict
+                   settings of joanne.config to use in the worker, e.g. those of the
+                   process that started it
+        instrumentation : dict
+                          keyword arguments of instrument.start(), if the worker is to
+                          record timers
+
+    Initializer of the worker processes; modules that cannot be imported are left to
+    the tasks that need them
+    """
+    if settings is not None:
+        config.set_config(**settings)
+
+    if instrumentation is not None:
+        instrument.start(**instrumentation)
+
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+def get_worker_pool(workers=None, modules=preload_modules, mp_context=None):
+    """
+    Input :
+        workers : int
+                  number of worker processes; default the workers setting of
+                  joanne.config, or else os.cpu_count()
+        modules : list
+                  modules imported by every worker when it starts, see preload()
+        mp_context : multiprocessing context
+                     default the platform's default start method
+    Output :
+        pool : concurrent.futures.ProcessPoolExecutor
+
+    The workers live as long as the pool, so a pool passed to run_tasks() serves the
+    tasks of all stages, and can be reused for several runs. The workers use the
+    settings of joanne.config of this process at the time the pool is created, and
+    record timers if joanne.instrument is enabled in this process at that time
+    """
+    if workers is None:
+        workers = config.settings["workers"]
+
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=preload,
+        initargs=(
+            modules,
+            dict(config.settings),
+            dict(allocations=tracemalloc.is_tracing()) if instrument.enabled else None,
+        ),
+    )
+
+
+def execute_task(task, inputs):
+    """
+    Input :
+        task : dict
+               see make_task()
+        inputs : list
+                 from get_task_inputs()
+    Output :
+        outputs : list
+                  paths of the files written by the task
+        records : list
+                  records of the timers run by the task, see joanne.instrument; the
+                  whole task is timed as 'stage:' + its stage
+    """
+    start = len(instrument.records)
+
+    with instrument.timed("stage:" + task["stage"]):
+        outputs = list(task["function"](inputs, **task["kwargs"]))
+
+    # the records are handed to the process that runs the pipeline
+    records = instrument.records[start:]
+    del instrument.records[start:]
+
+    return outputs, records
+
+
+def run_tasks(
+    tasks,
+    state_path,
+    only=None,
+    until=None,
+    workers=None,
+    dry_run=False,
+    save_interval=5,
+    pool=None,
+):
+    """
+    Input :
+        tasks : list
+                tasks from make_task()
+        state_path : string
+                     JSON file with the state of the pipeline, see load_state()
+        only, until : see select_tasks()
+        workers : int
+                  number of worker processes, see get_worker_pool(); 1 runs all tasks
+                  in this process. Not used if pool is given
+        dry_run : bool
+                  if True, only the plan is printed and returned
+        save_interval : float
+                        seconds between saves of the state while tasks are running
+        pool : concurrent.futures.Executor
+               pool to run the tasks on, e.g. from get_worker_pool(); it is not shut
+               down at the end. By default a pool of workers is started for this run
+    Output :
+        plan : list
+               (name, reason) of every selected task, see plan_tasks(); after a run,
+               reason is 'ran', 'up to date', 'failed' or 'not run' (a dep failed)
+
+    Independent tasks run in parallel as soon as all of their deps have finished. If a
+    task fails, its dependents are not run, the other tasks are, and a RuntimeError
+    naming the failed tasks is raised at the end
+    """
+    by_name = {task["name"]: task for task in tasks}
+    state = load_state(state_path)
+
+    if workers is None:
+        workers = config.settings["workers"]
+
+    plan = plan_tasks(tasks, state, select_tasks(tasks, only=only, until=until))
+    print(format_plan(plan, tasks))
+
+    if dry_run:
+        return plan
+
+    result = dict(plan)
+    pending = {name for name, reason in plan if reason != "up to date"}
+    running = {}
+    failed = {}
+
+    def get_ready():
+        # tasks whose deps have all finished are checked again, and returned if stale
+        ready = []
+        for name in sorted(pending - {name for name, _ in running.values()}):
+            task = by_name[name]
+            if any(dep in pending for dep in task["deps"]):
+                continue
+
+            if any(result.get(dep) in ["failed", "not run"] for dep in task["deps"]):
+                result[name] = "not run"
+                pending.discard(name)
+                continue
+
+            inputs = get_task_inputs(task, state)
+            fingerprint = get_task_fingerprint(task, inputs)
+            if is_up_to_date(name, fingerprint, state) == "up to date":
+                result[name] = "up to date"
+                pending.discard(name)
+                continue
+
+            ready.append((name, inputs, fingerprint))
+
+        return ready
+
+    def finish(name, fingerprint, get_outputs):
+        pending.discard(name)
+        try:
+            outputs, records = get_outputs()
+            state[name] = {"fingerprint": fingerprint, "outputs": outputs}
+            instrument.records.extend(records)
+            result[name] = "ran"
+        except Exception as error:
+            state.pop(name, None)
+            failed[name] = error
+            result[name] = "failed"
+
+    try:
+        if workers == 1 and pool is None:
+            while pending:
+                for name, inputs, fingerprint in get_ready():
+                    finish(
+                        name, fingerprint, lambda: execute_task(by_name[name], inputs)
+                    )
+
+        elif len(pending) > 0:
+            own_pool = pool is None
+            if own_pool:
+                pool = get_worker_pool(workers)
+
+            try:
+                last_save = time.time()
+                while pending:
+                    for name, inputs, fingerprint in get_ready():
+                        future = pool.submit(execute_task, by_name[name], inputs)
+                        running[future] = (name, fingerprint)
+
+                    if len(running) == 0:
+                        continue
+
+                    done, _ = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        name, fingerprint = running.pop(future)
+                        finish(name, fingerprint, future.result)
+
+                    if time.time() - last_save > save_interval:
+                        save_state(state, state_path)
+                        last_save = time.time()
+            finally:
+                # cancel what has not started yet; shutdown(cancel_futures=True)
+                # would do the same but needs Python 3.9
+                for future in running:
+                    future.cancel()
+                if own_pool:
+                    pool.shutdown(wait=True)
+    finally:
+        save_state(state, state_path)
+
+    if len(failed) > 0:
+        raise RuntimeError(
+            "tasks failed: "
+            + ", ".join(f"{name} ({error!r})" for name, error in failed.items())
+        )
+
+    return [(name, result[name]) for name, _ in plan]
+
+
+# %% Tasks of the JOANNE processing
+
+
+def run_qc_for_platform(inputs, Platform, save_directory):
+    """
+    QC of all sondes of a platform; writes the status file of the platform
+    """
+    from joanne.Level_2 import fn_2 as f2
+
+    status_path = (
+        f"{save_directory}Status_of_sondes_{Platform}_v{joanne.__version__}.nc"
+    )
+
+    # an existing status file would be returned as it is
+    if os.path.exists(status_path):
+        os.remove(status_path)
+
+    f2.get_status_ds_for_platform(Platform, save_dir=save_directory)
+
+    return [status_path]
+
+
+def run_level_2_for_sonde(inputs, Platform, save_directory):
+    """
+    Level-2 file of a sonde, from its Level-1 file and the status file of its platform;
+    no file is written for sondes that are not GOOD
+    """
+    from joanne.Level_2 import fn_2 as f2
+
+    sonde_path, status_path = inputs
+    os.makedirs(save_directory, exist_ok=True)
+
+    file_path = f2.write_level_2_sonde(
+        Platform,
+        sonde_path,
+        load_status_file(status_path),
+        save_directory=save_directory,
+    )
+
+    return [] if file_path is None else [file_path]
+
+
+# status files read by this (worker) process, keyed by path and modification time
+status_files = {}
+
+
+def load_status_file(status_path):
+    """
+    Status file of a platform, read once per worker process; at most the cache_size
+    setting of joanne.config files are kept
+    """
+    import xarray as xr
+
+    key = (status_path, os.path.getmtime(status_path))
+
+    if key not in status_files:
+        with xr.open_dataset(status_path) as status_ds:
+            status_ds = status_ds.load()
+
+        if config.settings["cache_size"] < 1:
+            return status_ds
+
+        while len(status_files) >= config.settings["cache_size"]:
+            status_files.pop(next(iter(status_files)))
+        status_files[key] = status_ds
+
+    return status_files[key]
+
+
+def run_level_3_for_sonde(inputs):
+    """
+    Gridded (interim) files of a sonde on height and pressure levels, from its Level-2 file
+    """
+    from joanne.Level_3 import fn_3 as f3
+
+    interim_paths = []
+    for file_path in inputs:
+        interim_paths += f3.grid_to_interim_files(file_path, pressure_levels=True)
+
+    return interim_paths
+
+
+def assemble_level_3(inputs, save_directory):
+    """
+    Level-3 files on height and pressure levels, from the Level-2 files and the interim
+    files of all sondes
+    """
+    from joanne import reader
+    from joanne.Level_3 import fn_3 as f3
+
+    lv2_files = [
+        file_path for file_path in inputs if "_Level_2_" in os.path.basename(file_path)
+    ]
+    os.makedirs(save_directory, exist_ok=True)
+
+    lv3_dataset, lv3_p_dataset = f3.lv3_structure_from_lv2(
+        lv2_files, pressure_levels=True
+    )
+
+    file_path = (
+        save_directory
+        + "EUREC4A_JOANNE_Dropsonde-RD41_Level_3_v"
+        + str(joanne.__version__)
+        + ".nc"
+    )
+    p_file_path = f3.get_lv3_p_file_path(file_path)
+
+    f3.write_lv3_file(
+        f3.get_lv3_to_save_dataset(lv3_dataset),
+        file_path,
+        lv2_fingerprints=f3.get_lv2_fingerprints(lv2_files),
+    )
+    f3.write_lv3_file(f3.get_lv3_p_to_save_dataset(lv3_p_dataset), p_file_path)
+
+    return [
+        file_path,
+        reader.sonde_index_path(file_path),
+        p_file_path,
+        reader.sonde_index_path(p_file_path),
+    ]
+
+
+def run_level_4(inputs, save_directory):
+    """
+    Level-4 file from the Level-3 file among the inputs; only circles that changed are
+    recomputed, see Level_4.make_level_4()
+    """
+    from joanne.Level_4 import Level_4
+
+    lv3_file_path = [
+        file_path
+        for file_path in inputs
+        if "_Level_3_v" in os.path.basename(file_path)
+        and not file_path.endswith("_sonde_index.nc")
+    ][0]
+    os.makedirs(save_directory, exist_ok=True)
+
+    return [Level_4.make_level_4(lv3_file_path, save_directory)]
+
+
+def get_joanne_tasks(platforms=["HALO", "P3"]):
+    """
+    Input :
+        platforms : list
+    Output :
+        tasks : list
+                QC per platform, Level-2 and Level-3 gridding per sonde, the Level-3
+                assembly and Level-4, see make_task(); with the directories of
+                joanne.config
+    """
+    tasks = []
+    level_2_names = []
+    level_3_names = []
+
+    for Platform in platforms:
+        sonde_paths = sorted(
+            glob.glob(f"{config.get_directory('level_1')}{Platform}/*QC.nc")
+        )
+        a_paths = sorted(
+            glob.glob(f"{config.get_directory('level_0')}{Platform}/All_A_files/*")
+        )
+
+        tasks.append(
+            make_task(
+                f"qc:{Platform}",
+                "qc",
+                run_qc_for_platform,
+                inputs=sonde_paths + a_paths,
+                Platform=Platform,
+                save_directory=config.get_directory("qc"),
+            )
+        )
+
+        for sonde_path in sonde_paths:
+            sonde = f"{Platform}_{sonde_path[-20:-5]}"
+
+            tasks.append(
+                make_task(
+                    f"level_2:{sonde}",
+                    "level_2",
+                    run_level_2_for_sonde,
+                    inputs=[sonde_path],
+                    deps=[f"qc:{Platform}"],
+                    Platform=Platform,
+                    save_directory=config.get_directory("level_2"),
+                )
+            )
+            tasks.append(
+                make_task(
+                    f"level_3:{sonde}",
+                    "level_3",
+                    run_level_3_for_sonde,
+                    deps=[f"level_2:{sonde}"],
+                )
+            )
+            level_2_names.append(f"level_2:{sonde}")
+            level_3_names.append(f"level_3:{sonde}")
+
+    tasks.append(
+        make_task(
+            "level_3_assembly",
+            "level_3_assembly",
+            assemble_level_3,
+            deps=level_2_names + level_3_names,
+            save_directory=config.get_directory("level_3"),
+        )
+    )
+    tasks.append(
+        make_task(
+            "level_4",
+            "level_4",
+            run_level_4,
+            inputs=sorted(glob.glob(config.get_directory("yaml") + "*.yaml")),
+            deps=["level_3_assembly"],
+            save_directory=config.get_directory("level_4"),
+        )
+    )
+
+    return tasks
+
+
+# %%
@@ -0,0 +1,171 @@
+# %% Module for the numeric precision policy of the gridded and regressed fields
+import copy
+
+import numpy as np
+import xarray as xr
+
+from joanne import config
+
+# the fields are kept between the processing steps of Level-3 and Level-4 in the
+# working_dtype setting of joanne.config; "float64" (default) or "float32", the dtype
+# in which they are stored anyway. Being a setting, it is passed on to the pipeline's
+# worker processes. Sums, binned means, normal equations and the W integration are
+# always accumulated in float64
+
+# %%
+
+
+def get_working_dtype():
+    """
+    Output :
+        dtype : string
+                'float32' or 'float64', the working_dtype setting of joanne.config
+    """
+    return config.settings["working_dtype"]
+
+
+def set_working_dtype(dtype):
+    """
+    Input :
+        dtype : string
+                'float32' or 'float64'
+    Output :
+        previous_dtype : string
+                         working dtype before this call
+    """
+    return config.set_config(working_dtype=np.dtype(dtype).name)["working_dtype"]
+
+
+def as_dtype(data, dtype):
+    """
+    Input :
+        data : numpy array, xarray DataArray or xarray dataset
+        dtype : string
+                floating point dtype
+    Output :
+        data : same type as input
+               floating point values (of the data variables, for a dataset) cast to
+               dtype; other values, and coordinates, are returned unchanged
+    """
+    if isinstance(data, xr.Dataset):
+        return data.assign(
+            {
+                var: data[var].astype(dtype)
+                for var in data.data_vars
+                if data[var].dtype.kind == "f" and data[var].dtype != dtype
+            }
+        )
+
+    if data.dtype.kind == "f" and data.dtype != dtype:
+        return data.astype(dtype)
+
+    return data
+
+
+def as_working_dtype(data):
+    """
+    Input :
+        data : numpy array, xarray DataArray or xarray dataset
+    Output :
+        data : same type as input
+               floating point values cast to the working dtype, see as_dtype()
+    """
+    return as_dtype(data, get_working_dtype())
+
+
+def get_precision_report(test, reference, variables=None):
+    """
+    Input :
+        test, reference : xarray datasets
+                          the same product computed at two precisions
+        variables : list
+                    variables to compare; default all floating point data variables
+                    in both datasets
+    Output :
+        report : xarray dataset
+                 along 'variable', the maximum and RMS absolute difference, the
+                 maximum difference relative to the largest absolute reference value,
+                 and the number of values that are NaN in only one of the datasets
+    """
+    if variables is None:
+        variables = [
+            var
+            for var in reference.data_vars
+            if var in test and reference[var].dtype.kind == "f"
+        ]
+
+    stats = {"max_abs_diff": [], "rms_diff": [], "max_rel_diff": [], "nan_mismatch": []}
+
+    for var in variables:
+        t = np.asarray(test[var].values, dtype="float64")
+        r = np.asarray(reference[var].values, dtype="float64")
+
+        both = ~(np.isnan(t) | np.isnan(r))
+        diff = np.abs(t[both] - r[both])
+        scale = np.abs(r[both]).max() if both.any() else np.nan
+
+        stats["max_abs_diff"].append(diff.max() if both.any() else np.nan)
+        stats["rms_diff"].append(np.sqrt((diff ** 2).mean()) if both.any() else np.nan)
+        stats["max_rel_diff"].append(
+            diff.max() / scale if both.any() and scale > 0 else np.nan
+        )
+        stats["nan_mismatch"].append(int((np.isnan(t) != np.isnan(r)).sum()))
+
+    return xr.Dataset(
+        {key: (["variable"], values) for key, values in stats.items()},
+        coords={"variable": list(variables)},
+    )
+
+
+def format_precision_report(report):
+    """
+    Input :
+        report : xarray dataset
+                 from get_precision_report()
+    Output :
+        text : string
+               the report as a table, one line per variable
+    """
+    lines = [
+        f"{'variable':<16}{'max_abs_diff':>14}{'rms_diff':>14}"
+        f"{'max_rel_diff':>14}{'nan_mismatch':>14}"
+    ]
+    for row in range(len(report.variable)):
+        lines.append(
+            f"{str(report.variable.values[row]):<16}"
+            f"{report.max_abs_diff.values[row]:>14.3e}"
+            f"{report.rms_diff.values[row]:>14.3e}"
+            f"{report.max_rel_diff.values[row]:>14.3e}"
+            f"{report.nan_mismatch.values[row]:>14d}"
+        )
+
+    return "\n".join(lines)
+
+
+def validate_working_dtype(function, *args, dtype="float32", variables=None, **kwargs):
+    """
+    Input :
+        function : callable
+                   processing step that returns an xarray dataset, e.g.
+                   rgr_fn.fit2d_for_parameters
+        *args, **kwargs : arguments of function; they are copied for every run, so
+                          functions that modify their input can be validated too
+        dtype : string
+                working dtype to be validated against float64
+        variables : list
+                    see get_precision_report()
+    Output :
+        report : xarray dataset
+                 differences of the output with working dtype 'dtype' from the output
+                 with float64, see get_precision_report()
+    """
+    outputs = []
+
+    for run_dtype in ["float64", dtype]:
+        previous_dtype = set_working_dtype(run_dtype)
+        try:
+            outputs.append(function(*copy.deepcopy(args), **copy.deepcopy(kwargs)))
+        finally:
+            set_working_dtype(previous_dtype)
+
+    return get_precision_report(outputs[1], outputs[0], variables=variables)
@@ -0,0 +1,236 @@
+# %% Module to read selected sondes from the Level-3 product
+import os.path
+
+import numpy as np
+import xarray as xr
+
+# %%
+
+
+def sonde_index_path(lv3_file_path):
+    """
+    Input :
+        lv3_file_path : string
+                        path to the Level-3 NC file
+    Output :
+        index_file_path : string
+                          path to the sidecar sonde index stored with the Level-3 file
+    """
+    return os.path.splitext(lv3_file_path)[0] + "_sonde_index.nc"
+
+
+def build_sonde_index(lv3_dataset, lv2_fingerprints=None):
+    """
+    Input :
+        lv3_dataset : xarray dataset
+                      Level-3 dataset (opened lazily or in memory) with 'sonde_id' dimension
+        lv2_fingerprints : dict
+                           fingerprints of the Level-2 files the sondes were gridded from,
+                           keyed by sonde_id; stored in the index if provided
+    Output :
+        index : xarray dataset
+                dataset along 'sonde_id' mapping each sonde to its row offset in the
+                Level-3 file, along with its platform, launch time, flight date and
+                launch position (aircraft position when the sonde was launched)
+
+    Only the one-dimensional variables of the Level-3 dataset are read, so building
+    the index from an opened file does not load any of the gridded profiles.
+    """
+    launch_time = lv3_dataset.launch_time.values.astype("datetime64[ns]")
+
+    index = xr.Dataset(
+        {
+            "row": (["sonde_id"], np.arange(len(lv3_dataset.sonde_id), dtype="int32")),
+            "platform_id": (["sonde_id"], lv3_dataset.platform_id.values),
+            "launch_time": (["sonde_id"], launch_time),
+            "flight_date": (
+                ["sonde_id"],
+                launch_time.astype("datetime64[D]").astype("datetime64[ns]"),
+            ),
+            "launch_lat": (["sonde_id"], lv3_dataset.flight_lat.values),
+            "launch_lon": (["sonde_id"], lv3_dataset.flight_lon.values),
+        },
+        coords={"sonde_id": lv3_dataset.sonde_id.values},
+    )
+
+    index.row.attrs["description"] = "row offset of sonde along sonde_id in Level-3 file"
+    index.flight_date.attrs["description"] = "UTC date of dropsonde launch"
+
+    if lv2_fingerprints is not None:
+        index["lv2_fingerprint"] = (
+            ["sonde_id"],
+            np.array([lv2_fingerprints.get(s, "") for s in index.sonde_id.values]),
+        )
+        index.lv2_fingerprint.attrs["description"] = "SHA-1 hash of Level-2 file"
+
+    index.attrs["lv3_creation_time"] = lv3_dataset.attrs.get("creation_time", "")
+
+    return index
+
+
+def write_sonde_index(lv3_dataset, lv3_file_path, lv2_fingerprints=None):
+    """
+    Input :
+        lv3_dataset : xarray dataset
+                      Level-3 dataset that was written to lv3_file_path
+        lv3_file_path : string
+                        path to the Level-3 NC file
+        lv2_fingerprints : dict
+                           see build_sonde_index()
+    Output :
+        index_file_path : string
+                          path to the sidecar sonde index that was written
+    """
+    index = build_sonde_index(lv3_dataset, lv2_fingerprints=lv2_fingerprints)
+    index.attrs["lv3_file"] = os.path.basename(lv3_file_path)
+
+    encoding = {
+        "launch_time": {"units": "seconds since 2020-01-01", "dtype": "int32"},
+        "flight_date": {"units": "days since 2020-01-01", "dtype": "int16"},
+    }
+
+    index_file_path = sonde_index_path(lv3_file_path)
+    index.to_netcdf(index_file_path, mode="w", format="NETCDF4", encoding=encoding)
+
+    return index_file_path
+
+
+def get_sonde_index(lv3_file_path):
+    """
+    Input :
+        lv3_file_path : string
+                        path to the Level-3 NC file
+    Output :
+        index : xarray dataset
+                sonde index of the Level-3 file
+
+    The sidecar index is used if it exists and was written for the same Level-3 file
+    (checked via the 'creation_time' global attribute), otherwise the index is built
+    from the one-dimensional variables of the Level-3 file.
+    """
+    index_file_path = sonde_index_path(lv3_file_path)
+
+    with xr.open_dataset(lv3_file_path) as lv3_dataset:
+        creation_time = lv3_dataset.attrs.get("creation_time", "")
+
+        if os.path.exists(index_file_path):
+            with xr.open_dataset(index_file_path) as index:
+                if index.attrs.get("lv3_creation_time") == creation_time:
+                    return index.load()
+
+        return build_sonde_index(lv3_dataset).load()
+
+
+def query_sonde_index(
+    index,
+    sonde_ids=None,
+    platform_id=None,
+    flight_date=None,
+    time_range=None,
+    lat_range=None,
+    lon_range=None,
+):
+    """
+    Input :
+        index : xarray dataset
+                sonde index of a Level-3 file, see get_sonde_index()
+        sonde_ids : list of strings
+                    sondes to select; the returned rows follow this order
+        platform_id : string
+                      'HALO' or 'P3'
+        flight_date : string or np.datetime64
+                      UTC date of launch, e.g. '2020-02-05'
+        time_range : tuple
+                     (start, end) of launch_time, both inclusive
+        lat_range, lon_range : tuple
+                               (min, max) of launch position, both inclusive
+    Output :
+        rows : numpy array
+               row offsets of the selected sondes in the Level-3 file
+    """
+    if sonde_ids is not None:
+        index = index.sel(sonde_id=list(sonde_ids))
+
+    selected = np.full(len(index.sonde_id), True)
+
+    if platform_id is not None:
+        selected &= index.platform_id.values == platform_id
+    if flight_date is not None:
+        selected &= index.flight_date.values == np.datetime64(flight_date, "D")
+    if time_range is not None:
+        start, end = (np.datetime64(t, "ns") for t in time_range)
+        selected &= (index.launch_time.values >= start) & (
+            index.launch_time.values <= end
+        )
+    if lat_range is not None:
+        selected &= (index.launch_lat.values >= lat_range[0]) & (
+            index.launch_lat.values <= lat_range[1]
+        )
+    if lon_range is not None:
+        selected &= (index.launch_lon.values >= lon_range[0]) & (
+            index.launch_lon.values <= lon_range[1]
+        )
+
+    return index.row.values[selected]
+
+
+def read_rows(lv3_file_path, rows):
+    """
+    Input :
+        lv3_file_path : string
+                        path to the Level-3 NC file
+        rows : array of int
+               row offsets along 'sonde_id' to be read
+    Output :
+        dataset : xarray dataset
+                  in-memory Level-3 dataset with only the given rows, in the given order
+
+    Rows are read as runs of consecutive rows, so that only the hyperslabs of the
+    requested sondes are read from disk, and then put back in the requested order.
+    Since Level-3 is sorted by launch_time, the sondes of a circle are mostly a single run.
+    """
+    rows = np.asarray(rows, dtype="int64")
+    sorted_rows, order = np.unique(rows, return_inverse=True)
+
+    runs = np.split(sorted_rows, np.where(np.diff(sorted_rows) != 1)[0] + 1)
+
+    with xr.open_dataset(lv3_file_path) as lv3_dataset:
+        dataset = xr.concat(
+            [
+                lv3_dataset.isel(sonde_id=slice(run[0], run[-1] + 1)).load()
+                for run in runs
+                if len(run) > 0
+            ]
+            or [lv3_dataset.isel(sonde_id=slice(0, 0)).load()],
+            dim="sonde_id",
+            data_vars="minimal",
+            coords="minimal",
+            compat="override",
+        )
+
+    return dataset.isel(sonde_id=order.ravel())
+
+
+def open_level_3(lv3_file_path, index=None, **query):
+    """
+    Input :
+        lv3_file_path : string
+                        path to the Level-3 NC file
+        index : xarray dataset
+                sonde index of the file; read with get_sonde_index() if not provided
+        **query : keyword arguments of query_sonde_index(), e.g. sonde_ids,
+                  platform_id, flight_date, time_range, lat_range, lon_range
+    Output :
+        dataset : xarray dataset
+                  Level-3 dataset with only the selected sondes
+
+    Function to load only the requested sondes from the Level-3 file, e.g. for a circle
+
+    >>> open_level_3(lv3_file_path, sonde_ids=["HALO-0205_s01", "HALO-0205_s02"])
+    """
+    if index is None:
+        index = get_sonde_index(lv3_file_path)
+
+    rows = query_sonde_index(index, **query)
+
+    return read_rows(lv3_file_path, rows)
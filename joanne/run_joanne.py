@@ -1,67 +1,73 @@
-import os
-import joanne
-import glob
-from pylab import size
-import joanne.Level_2.QC as qc
-
-
-data_directory = "/Users/geet/Documents/JOANNE/Data/"
-save_directory = "/Users/geet/Documents/JOANNE/Data/QC/"
-qc_dir = os.path.join(data_directory, "QC")
-
-jo_version = joanne.__version__
-
-halo_status_file = sorted(glob.glob(f"{qc_dir}*HALO*{jo_version}.nc"))
-p3_status_file = sorted(glob.glob(f"{qc_dir}*P3*{jo_version}.nc"))
-
-if (len(halo_status_file) >= 1) and (len(p3_status_file) >= 1):
-    print("QC Status files of the current version found for both P3 and HALO")
-else:
-    print(
-        "QC Status files of the current version not found for both P3 and HALO. Therefore, running QC..."
-    )
-
-    qc.run_qc(
-        data_directory=data_directory, save_directory=save_directory,
-    )
-
-
-l2_files = sorted(glob.glob(f"{data_directory}Level_2/*{jo_version}.nc"))
-
-no_of_l2_files = size(l2_files)
-
-if no_of_l2_files > 1000:
-    print(
-        f"{no_of_l2_files} Level-2 files found with the current JOANNE version. Therefore not running Level-2 script again."
-    )
-else:
-    print("Starting Level-2")
-    import joanne.Level_2.Level_2
-
-    print("Level-2 finished")
-
-
-l3_files = sorted(glob.glob(f"{data_directory}Level_3/*{jo_version}.nc"))
-
-if size(l3_files) > 0:
-    print(
-        "Level-3 file found with the current JOANNE version. Therefore not running Level-3 script again."
-    )
-else:
-    print("Starting Level-3")
-    import joanne.Level_3.Level_3
-
-    print("Level-3 finished")
-
-
-l4_files = sorted(glob.glob(f"{data_directory}Level_4/*{jo_version}.nc"))
-
-if size(l4_files) > 0:
-    print(
-        "Level-4 file found with the current JOANNE version. Therefore not running Level-4 script again."
-    )
-else:
-    print("Starting Level-4")
-    import joanne.Level_4.Level_4
-
-    print("Level-4 finished")
+import argparse
+
+from joanne import config, instrument, pipeline
+
+parser = argparse.ArgumentParser(
+    description="This script runs the JOANNE processing (QC, Level-2, Level-3 and Level-4) as a graph of tasks. A task is only run if its inputs changed since its last run, as recorded in a state file in the cache directory. Independent tasks run in parallel."
+)
+
+parser.add_argument(
+    "--config",
+    help="YAML file with the directories and performance settings (see joanne.config); by default $JOANNE_CONFIG, if set.",
+)
+
+parser.add_argument(
+    "--only",
+    nargs="+",
+    help=f"Stages ({', '.join(pipeline.stages)}) or task name patterns (e.g. 'level_2:HALO*') to run; other tasks are not run, and their last outputs are used.",
+)
+parser.add_argument(
+    "--until",
+    choices=pipeline.stages,
+    help="Last stage to run; later stages are not run.",
+)
+parser.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="Only print the tasks that would run.",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of worker processes; by default the workers setting of the config, or else the number of CPUs. With 1, all tasks run in this process.",
+)
+parser.add_argument(
+    "--working-dtype",
+    choices=["float32", "float64"],
+    help="Dtype in which the fields are kept between the steps of Level-3 and Level-4 (see joanne.precision); by default the working_dtype setting of the config, or else float64.",
+)
+parser.add_argument(
+    "--report",
+    help="JSON file to which the timings and memory use of every stage and hot function are written, with percentiles per sonde and per circle.",
+)
+parser.add_argument(
+    "--allocations",
+    action="store_true",
+    help="Also record the peak memory allocated by Python in the report (slower).",
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.config is not None:
+        config.set_config(args.config)
+    if args.working_dtype is not None:
+        config.set_config(working_dtype=args.working_dtype)
+
+    if args.report is not None:
+        instrument.start(allocations=args.allocations)
+
+    try:
+        with instrument.timed("run_joanne"):
+            pipeline.run_tasks(
+                pipeline.get_joanne_tasks(),
+                config.get_directory("cache") + "joanne_pipeline_state.json",
+                only=args.only,
+                until=args.until,
+                workers=args.workers,
+                dry_run=args.dry_run,
+            )
+    finally:
+        if args.report is not None:
+            instrument.write_report(args.report, settings=config.settings)
@@ -0,0 +1,198 @@
+# %% Module to read the flight segments (flight phase separation YAML files) as a catalogue
+import glob
+import os.path
+
+import numpy as np
+import xarray as xr
+import yaml
+
+# the C loader is much faster, but is only available if PyYAML was built with libyaml
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# %%
+
+
+def get_platform_from_file_name(file_path):
+    """
+    Input :
+        file_path : string
+                    path to a flight segments YAML file
+    Output :
+        platform : string
+                   'HALO', 'P3' or '' if neither is in the file name
+    """
+    if "HALO" in file_path:
+        return "HALO"
+    elif "P3" in file_path:
+        return "P3"
+    else:
+        return ""
+
+
+def build_segment_catalogue(list_of_files):
+    """
+    Input :
+        list_of_files : list
+                        paths to flight segments YAML files
+    Output :
+        catalogue : xarray dataset
+                    columnar table of all segments of all flights, with dimensions
+                    'flight' (one per file), 'segment' and 'good_sonde'
+
+    Every segment has its segment_id, kinds (comma-separated), start, end, platform and
+    flight_row (row of its flight along 'flight'). The GOOD sonde_ids of all segments are stored one after
+    the other along 'good_sonde'; those of a segment are at
+    good_sonde_id[good_offset : good_offset + n_good]
+    """
+    flight_date = []
+    segments = []
+    good_sonde_id = []
+
+    for flight, file_path in enumerate(list_of_files):
+        with open(file_path) as source:
+            flightinfo = yaml.load(source, Loader=Loader)
+
+        flight_date.append(np.datetime64(flightinfo["date"], "ns"))
+
+        for c in flightinfo["segments"]:
+            good = c["dropsondes"]["GOOD"] if c.get("dropsondes") else []
+            segments.append(
+                (
+                    c["segment_id"],
+                    ",".join(c["kinds"]),
+                    np.datetime64(c["start"], "ns"),
+                    np.datetime64(c["end"], "ns"),
+                    flight,
+                    len(good_sonde_id),
+                    len(good),
+                )
+            )
+            good_sonde_id.extend(good)
+
+    segment_id, kinds, start, end, flight, good_offset, n_good = (
+        zip(*segments) if len(segments) > 0 else [[]] * 7
+    )
+    flight = np.array(flight, dtype="int32")
+
+    platform = [get_platform_from_file_name(f) for f in list_of_files]
+
+    catalogue = xr.Dataset(
+        {
+            "file": (
+                ["flight"],
+                np.array([os.path.basename(f) for f in list_of_files]),
+            ),
+            "mtime": (
+                ["flight"],
+                np.array([os.path.getmtime(f) for f in list_of_files]),
+            ),
+            "flight_date": (["flight"], np.array(flight_date, dtype="datetime64[ns]")),
+            "flight_platform": (["flight"], np.array(platform)),
+            "segment_id": (["segment"], np.array(segment_id, dtype=str)),
+            "kinds": (["segment"], np.array(kinds, dtype=str)),
+            "start": (["segment"], np.array(start, dtype="datetime64[ns]")),
+            "end": (["segment"], np.array(end, dtype="datetime64[ns]")),
+            "flight_row": (["segment"], flight),
+            "platform": (["segment"], np.array(platform, dtype=str)[flight]),
+            "good_offset": (["segment"], np.array(good_offset, dtype="int32")),
+            "n_good": (["segment"], np.array(n_good, dtype="int32")),
+            "good_sonde_id": (["good_sonde"], np.array(good_sonde_id, dtype=str)),
+        }
+    )
+
+    catalogue.kinds.attrs["description"] = "comma-separated kinds of segment"
+    catalogue.mtime.attrs["description"] = "modification time of YAML file"
+
+    return catalogue
+
+
+def get_segment_catalogue(yaml_directory, cache_path=None):
+    """
+    Input :
+        yaml_directory : string
+                         directory with the flight segments YAML files
+        cache_path : string
+                     path of the NC file in which the catalogue is cached;
+                     default is 'segment_catalogue.nc' in yaml_directory
+    Output :
+        catalogue : xarray dataset
+                    see build_segment_catalogue()
+
+    The YAML files are parsed only if the cached catalogue is missing or if any file
+    was added, removed or modified (checked by its modification time) since
+    """
+    if cache_path is None:
+        cache_path = os.path.join(yaml_directory, "segment_catalogue.nc")
+
+    list_of_files = sorted(glob.glob(os.path.join(yaml_directory, "*.yaml")))
+
+    if os.path.exists(cache_path):
+        with xr.open_dataset(cache_path) as cached:
+            if list(cached.file.values) == [
+                os.path.basename(f) for f in list_of_files
+            ] and np.array_equal(
+                cached.mtime.values, [os.path.getmtime(f) for f in list_of_files]
+            ):
+                return cached.load()
+
+    catalogue = build_segment_catalogue(list_of_files)
+
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    catalogue.to_netcdf(cache_path, mode="w", format="NETCDF4")
+
+    return catalogue
+
+
+def query_segments(
+    catalogue, kind=None, platform=None, time_range=None, min_good_sondes=None
+):
+    """
+    Input :
+        catalogue : xarray dataset
+                    from get_segment_catalogue()
+        kind : string
+               kind of segment, e.g. 'circle' or 'straight_leg'
+        platform : string
+                   'HALO' or 'P3'
+        time_range : tuple
+                     (start, end); segments overlapping this time range are selected
+        min_good_sondes : int
+                          minimum number of GOOD sondes in the segment
+    Output :
+        rows : numpy array
+               rows of the selected segments along 'segment', in catalogue order
+    """
+    selected = np.full(len(catalogue.segment_id), True)
+
+    if kind is not None:
+        selected &= np.array([kind in k.split(",") for k in catalogue.kinds.values])
+    if platform is not None:
+        selected &= catalogue.platform.values == platform
+    if time_range is not None:
+        start, end = (np.datetime64(t, "ns") for t in time_range)
+        selected &= (catalogue.start.values <= end) & (catalogue.end.values >= start)
+    if min_good_sondes is not None:
+        selected &= catalogue.n_good.values >= min_good_sondes
+
+    return np.flatnonzero(selected)
+
+
+def get_good_sonde_ids(catalogue, rows):
+    """
+    Input :
+        catalogue : xarray dataset
+                    from get_segment_catalogue()
+        rows : array of int
+               rows along 'segment', e.g. from query_segments()
+    Output :
+        sonde_ids : list of lists
+                    GOOD sonde_ids of every segment in rows
+    """
+    good_sonde_id = catalogue.good_sonde_id.values
+    good_offset = catalogue.good_offset.values
+    n_good = catalogue.n_good.values
+
+    return [
+        list(good_sonde_id[good_offset[row] : good_offset[row] + n_good[row]])
+        for row in rows
+    ]
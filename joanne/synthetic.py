@@ -0,0 +1,669 @@
+# %% Module to generate a synthetic dropsonde campaign (Level-1 files, A files and flight segments)
+import argparse
+import concurrent.futures
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+
+from joanne import config
+
+# number of flights per platform and circles per flight at 1x, 10x and 100x the size of
+# the EUREC4A campaign (~1700 sondes at 1x)
+campaign_scales = {
+    1: {"n_flights": 12, "n_circles": 6},
+    10: {"n_flights": 60, "n_circles": 12},
+    100: {"n_flights": 300, "n_circles": 24},
+}
+
+# failure modes of sondes, their default probability and the qc_flag that the Level-2
+# QC is expected to give them
+failure_modes = {
+    # launch not detected: reference_time at midnight, 'Launch Obs Done?' = 0 in the
+    # A file and the signal lost at ~350 hPa
+    "no_launch_detect": {"rate": 0.02, "qc_flag": "BAD"},
+    # no A file for the sonde
+    "missing_a_file": {"rate": 0.01, "qc_flag": "UGLY"},
+    # signal lost between 200 m and 1500 m above the surface
+    "no_surface": {"rate": 0.02, "qc_flag": "UGLY"},
+    # PTU measurements at only ~1/5 of the time records
+    "sparse_ptu": {"rate": 0.02, "qc_flag": "UGLY"},
+    # no winds (u_wind, v_wind, wspd, wdir)
+    "no_winds": {"rate": 0.01, "qc_flag": "UGLY"},
+}
+
+platform_settings = {
+    "HALO": {"flight_altitude": 10200, "centre": (13.3, -57.72), "radius": 1.0},
+    "P3": {"flight_altitude": 7400, "centre": (13.9, -56.5), "radius": 0.7},
+}
+
+# the sonde_ids of these days have hard-coded exceptions in Level-2, so no flights are
+# generated on them
+skipped_dates = [datetime.date(2020, 2, 9), datetime.date(2020, 2, 11)]
+
+time_step = 0.25  # seconds between time records (4 Hz)
+
+# %%
+
+
+def get_flight_dates(n_flights, first_date=datetime.date(2020, 1, 19)):
+    """
+    Input :
+        n_flights : int
+        first_date : datetime.date
+    Output :
+        flight_dates : list
+                       one date per flight, on consecutive days from first_date (skipping
+                       skipped_dates), all within the year of first_date
+    """
+    flight_dates = []
+    date = first_date
+
+    while len(flight_dates) < n_flights:
+        if date.year != first_date.year:
+            raise ValueError(
+                f"{n_flights} flights do not fit into {first_date.year} after {first_date}"
+            )
+        if date not in skipped_dates:
+            flight_dates.append(date)
+        date += datetime.timedelta(days=1)
+
+    return flight_dates
+
+
+def get_launch_plan(
+    date, n_circles, sondes_per_circle=12, n_straight_leg=2, sonde_interval=240
+):
+    """
+    Input :
+        date : datetime.date
+               date of the flight
+        n_circles : int
+        sondes_per_circle : int
+        n_straight_leg : int
+                         number of sondes on a straight leg after the circles
+        sonde_interval : int
+                         seconds between launches
+    Output :
+        launches : list
+                   (launch_time, segment number, position in segment) of every sonde
+        segments : list
+                   (kind, start, end) of every segment
+
+    The flight starts at 01:00 UTC with n_circles circles, one after the other, and
+    ends with the straight leg
+    """
+    interval = np.timedelta64(sonde_interval, "s")
+    margin = np.timedelta64(60, "s")
+    launch_time = np.datetime64(date) + np.timedelta64(1, "h")
+
+    launches = []
+    segments = []
+
+    kinds = ["circle"] * n_circles + ["straight_leg"] * (n_straight_leg > 0)
+    for n, kind in enumerate(kinds):
+        n_sondes = sondes_per_circle if kind == "circle" else n_straight_leg
+        start = launch_time - margin
+        for k in range(n_sondes):
+            launches.append((launch_time, n, k))
+            launch_time = launch_time + interval
+        segments.append((kind, start, launch_time - interval + margin))
+        launch_time = launch_time + interval
+
+    if launch_time + np.timedelta64(1, "h") > np.datetime64(date) + np.timedelta64(
+        1, "D"
+    ):
+        raise ValueError(
+            "The flight does not fit into a day, reduce n_circles or sonde_interval"
+        )
+
+    return launches, segments
+
+
+def get_fall_heights(flight_altitude):
+    """
+    Input :
+        flight_altitude : float
+                          launch altitude (m)
+    Output :
+        z : numpy array
+            altitude (m) of the sonde every time_step from launch to the surface
+
+    The fall speed is 11 m/s at the surface and increases as exp(z / 16 km), i.e.
+    inversely with the square root of density
+    """
+    scale = 16000.0
+    fall_time = scale / 11 * (1 - np.exp(-flight_altitude / scale))
+    t = np.arange(0, fall_time, time_step)
+
+    return -scale * np.log(np.exp(-flight_altitude / scale) + 11 * t / scale)
+
+
+def get_gaps(rng, n, fraction, mean_length=20):
+    """
+    Input :
+        rng : numpy Generator
+        n : int
+            number of time records
+        fraction : float
+                   approximate fraction of records in gaps
+        mean_length : float
+                      mean length of a gap in records
+    Output :
+        gaps : numpy array
+               boolean, True for records in a gap
+    """
+    gaps = np.zeros(n, dtype=bool)
+    n_gaps = rng.poisson(fraction * n / mean_length)
+
+    for start, length in zip(
+        rng.integers(0, n, n_gaps), rng.geometric(1 / mean_length, n_gaps)
+    ):
+        gaps[start : start + length] = True
+
+    return gaps
+
+
+def make_sonde(
+    rng,
+    launch_time,
+    launch_lat,
+    launch_lon,
+    centre,
+    flight_altitude,
+    serial,
+    failure=None,
+    nan_fraction=0.02,
+):
+    """
+    Input :
+        rng : numpy Generator
+        launch_time : numpy datetime64
+        launch_lat, launch_lon : float
+                                 launch position (deg)
+        centre : tuple
+                 (lat, lon) of the circle, around which there is a constant divergence
+                 and vorticity of the wind
+        flight_altitude : float
+                          (m)
+        serial : string
+                 sonde serial ID
+        failure : string
+                  one of failure_modes or None
+        nan_fraction : float
+                       fraction of records lost in random gaps (above 500 m), separately
+                       for PTU and GPS
+    Output :
+        sonde : xarray dataset
+                like an ASPEN-processed QC file: profiles of tdry, pres, rh, alt, gpsalt,
+                u_wind, v_wind, wspd, wdir, lat and lon along time (4 Hz; PTU and
+                gpsalt at 2 Hz, latest record first), with launch_time and
+                reference_time
+    """
+    z = get_fall_heights(flight_altitude + rng.normal(0, 50))
+    n = len(z)
+    time = launch_time + (np.arange(n) * time_step * 1e9).astype("timedelta64[ns]")
+
+    # thermodynamics: constant lapse rate and a moist layer below ~2 km
+    t_srf = rng.normal(26.5, 0.3)
+    tdry = t_srf - 0.0065 * z + rng.normal(0, 0.1, n)
+    p_srf = np.clip(rng.normal(1013, 1.5), 1005, 1018)
+    pres = p_srf * (1 - 0.0065 * z / (t_srf + 273.15)) ** 5.256
+    rh = 20 + 60 / (1 + np.exp((z - 2200) / 300)) + rng.normal(0, 1, n)
+    rh = np.clip(rh, 0, 100)
+
+    # winds: easterly trades, drifting the sonde, with a linear field around the centre
+    u = -10 + 1.5e-3 * z + rng.normal(0, 0.5, n)
+    v = -1.5 + 0.3e-3 * z + rng.normal(0, 0.5, n)
+    lat = launch_lat + np.cumsum(v) * time_step / 110540
+    lon = launch_lon + np.cumsum(u) * time_step / (
+        111320 * np.cos(np.deg2rad(launch_lat))
+    )
+    x = (lon - centre[1]) * 111320 * np.cos(np.deg2rad(centre[0]))
+    y = (lat - centre[0]) * 110540
+    div = -3e-5 * np.exp(-z / 1500) + 1e-5
+    vor = 2e-5
+    u = u + div / 2 * x - vor / 2 * y
+    v = v + div / 2 * y + vor / 2 * x
+
+    alt = z + rng.normal(0, 1, n)
+    gpsalt = z + rng.normal(0, 2, n)
+
+    # PTU and gpsalt at every other record, and random gaps above 500 m
+    ptu_nan = np.arange(n) % 2 == 1
+    ptu_nan |= get_gaps(rng, n, nan_fraction) & (z > 500)
+    gps_nan = get_gaps(rng, n, nan_fraction) & (z > 500)
+
+    if failure == "sparse_ptu":
+        ptu_nan |= rng.random(n) < 0.6
+    wind_nan = np.ones(n, dtype=bool) if failure == "no_winds" else gps_nan
+
+    for var, nan in [
+        (tdry, ptu_nan),
+        (pres, ptu_nan),
+        (rh, ptu_nan),
+        (alt, ptu_nan),
+        (gpsalt, ptu_nan | gps_nan),
+        (lat, gps_nan),
+        (lon, gps_nan),
+        (u, wind_nan),
+        (v, wind_nan),
+    ]:
+        var[nan] = np.nan
+
+    keep = slice(None)
+    if failure == "no_launch_detect":
+        # the signal is lost at ~350 hPa, but after at least 30 s
+        keep = slice(max(int(30 / time_step), int(np.sum(z > 8000))))
+    elif failure == "no_surface":
+        keep = z > rng.uniform(200, 1500)
+
+    sonde = xr.Dataset(
+        {
+            "tdry": ("time", tdry, {"long_name": "Temperature", "units": "degC"}),
+            "pres": ("time", pres, {"long_name": "Pressure", "units": "hPa"}),
+            "rh": ("time", rh, {"long_name": "Relative Humidity", "units": "%"}),
+            "alt": ("time", alt, {"long_name": "Geopotential Altitude", "units": "m"}),
+            "gpsalt": ("time", gpsalt, {"long_name": "GPS Altitude", "units": "m"}),
+            "u_wind": ("time", u, {"long_name": "U Wind Component", "units": "m/s"}),
+            "v_wind": ("time", v, {"long_name": "V Wind Component", "units": "m/s"}),
+            "wspd": ("time", np.sqrt(u ** 2 + v ** 2), {"units": "m/s"}),
+            "wdir": (
+                "time",
+                np.mod(270 - np.rad2deg(np.arctan2(v, u)), 360),
+                {"units": "degrees"},
+            ),
+            "lat": ("time", lat, {"long_name": "Latitude", "units": "degrees_north"}),
+            "lon": ("time", lon, {"long_name": "Longitude", "units": "degrees_east"}),
+        },
+        coords={"time": time},
+    ).isel(time=keep)
+
+    # ASPEN writes the records in reverse chronological order, from the surface up
+    sonde = sonde.isel(time=slice(None, None, -1))
+
+    sonde["launch_time"] = launch_time.astype("datetime64[ns]")
+    sonde["reference_time"] = (
+        launch_time.astype("datetime64[D]").astype("datetime64[ns]")
+        if failure == "no_launch_detect"
+        else launch_time.astype("datetime64[ns]")
+    )
+
+    sonde.attrs = {
+        "AspenVersion": "BatchAspen v3.4.3",
+        "ProcessingTime": "synthetic",
+        "SondeId": serial,
+        # the serial is at [21:30] of the description, see fn_2.check_launch_detect()
+        "SoundingDescription": f"AVAPS RD41 sonde ID: {serial}, synthetic",
+    }
+
+    return sonde
+
+
+def write_a_file(
+    file_path,
+    launch_time,
+    serial,
+    lat,
+    lon,
+    flight_altitude,
+    heading,
+    launch_detected=True,
+):
+    """
+    Input :
+        file_path : string
+        launch_time : numpy datetime64
+        serial : string
+        lat, lon : float
+                   aircraft position (deg)
+        flight_altitude : float
+                          (m)
+        heading : float
+                  (deg)
+        launch_detected : bool
+    Output :
+        file_path : string
+
+    Writes an AVAPS A file with the lines read by fn_2.get_ld_flag_from_a_files() (the
+    launch detection flag at column 25) and dicts.get_flight_attrs()
+    """
+    time = pd.Timestamp(launch_time)
+    lines = [
+        f"AVAPS-T04 COM4 Sonde ID/Type/Rev = {serial}, RD41, 1",
+        f"AVAPS-T04 COM4 START Time: {time:%Y-%m-%d %H:%M:%S}",
+        f"{'Launch Obs Done?':<23}= {int(launch_detected)}",
+        f"True Heading (deg)     = {heading:.1f}",
+        f"True Air Speed (m/s)   = {230.0:.1f}",
+        f"Ground Track (deg)     = {heading:.1f}",
+        f"Ground Speed (m/s)     = {225.0:.1f}",
+        f"Longitude (deg)        = {lon:.5f}",
+        f"Latitude (deg)         = {lat:.5f}",
+        f"MSL Altitude (m)       = {flight_altitude:.1f}",
+        f"Geopotential Altitude (m) = {flight_altitude - 30:.1f}",
+    ]
+
+    with open(file_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    return file_path
+
+
+def get_failures(rng, n, failure_rates):
+    """
+    Input :
+        rng : numpy Generator
+        n : int
+            number of sondes
+        failure_rates : dict
+                        probability of every failure mode
+    Output :
+        failures : list
+                   failure mode (or None) of every sonde
+    """
+    modes = list(failure_rates)
+    rates = np.array([failure_rates[mode] for mode in modes], dtype=float)
+    if rates.sum() > 1:
+        raise ValueError("The failure rates add up to more than 1")
+
+    drawn = rng.choice(len(modes) + 1, size=n, p=np.append(rates, 1 - rates.sum()))
+
+    return [modes[d] if d < len(modes) else None for d in drawn]
+
+
+def write_flight(
+    directory,
+    yaml_directory,
+    Platform,
+    date,
+    n_circles,
+    sondes_per_circle=12,
+    n_straight_leg=2,
+    sonde_interval=240,
+    failure_rates=None,
+    nan_fraction=0.02,
+    seed=None,
+):
+    """
+    Input :
+        directory : string
+                    data directory; the files are written to Level_1/<Platform>/ and
+                    Level_0/<Platform>/All_A_files/ in it
+        yaml_directory : string
+                         directory of the flight segments YAML file
+        Platform : string
+                   'HALO' or 'P3'
+        date : datetime.date
+        see get_launch_plan() for n_circles, sondes_per_circle, n_straight_leg and
+        sonde_interval, make_sonde() for nan_fraction and write_campaign() for
+        failure_rates
+        seed : int or sequence of int
+               seed of the random numbers of the flight
+    Output :
+        sondes : pandas DataFrame
+                 sonde_id, platform, launch_time, segment_id, failure mode and
+                 expected qc_flag of every sonde of the flight
+    """
+    if failure_rates is None:
+        failure_rates = {mode: failure_modes[mode]["rate"] for mode in failure_modes}
+
+    rng = np.random.default_rng(seed)
+    settings = platform_settings[Platform]
+
+    level_1 = os.path.join(directory, "Level_1", Platform, "")
+    a_dir = os.path.join(directory, "Level_0", Platform, "All_A_files", "")
+    for d in [level_1, a_dir, yaml_directory]:
+        os.makedirs(d, exist_ok=True)
+
+    launches, segments = get_launch_plan(
+        date, n_circles, sondes_per_circle, n_straight_leg, sonde_interval
+    )
+    failures = get_failures(rng, len(launches), failure_rates)
+    flight_id = f"{Platform}-{date:%m%d}"
+
+    segment_ids = [
+        f"{flight_id}_{'c' if kind == 'circle' else 'sl'}{n + 1}"
+        for n, (kind, start, end) in enumerate(segments)
+    ]
+    centres = [
+        (
+            settings["centre"][0] + rng.normal(0, 0.2),
+            settings["centre"][1] + rng.normal(0, 0.2),
+        )
+        for segment in segments
+    ]
+
+    comp = config.get_compression()
+    rows = []
+
+    for i, ((launch_time, n, k), failure) in enumerate(zip(launches, failures)):
+        kind = segments[n][0]
+        if kind == "circle":
+            angle = 2 * np.pi * k / sondes_per_circle
+            lat = centres[n][0] + settings["radius"] * np.cos(angle)
+            lon = centres[n][1] + settings["radius"] * np.sin(angle)
+            heading = np.mod(np.rad2deg(angle) + 90, 360)
+        else:
+            lat = centres[n][0]
+            lon = centres[n][1] + 0.5 * k
+            heading = 90.0
+
+        serial = f"2{date:%m%d}{i:04d}"
+        sonde = make_sonde(
+            rng,
+            launch_time,
+            lat,
+            lon,
+            centres[n],
+            settings["flight_altitude"],
+            serial,
+            failure=failure,
+            nan_fraction=nan_fraction,
+        )
+
+        file_time = pd.Timestamp(launch_time).strftime("%Y%m%d_%H%M%S")
+        encoding = {var: comp for var in sonde.data_vars if sonde[var].ndim == 1}
+        encoding["time"] = {"units": "seconds since 2020-01-01", "dtype": "float"}
+        sonde.to_netcdf(f"{level_1}D{file_time}QC.nc", encoding=encoding)
+
+        if failure != "missing_a_file":
+            write_a_file(
+                f"{a_dir}A{file_time}.1",
+                launch_time,
+                serial,
+                lat,
+                lon,
+                settings["flight_altitude"],
+                heading,
+                launch_detected=failure != "no_launch_detect",
+            )
+
+        rows.append(
+            {
+                "sonde_id": f"{flight_id}_s{i + 1:02d}",
+                "platform": Platform,
+                "launch_time": launch_time,
+                "segment_id": segment_ids[n],
+                "failure": failure or "",
+                "qc_flag": failure_modes[failure]["qc_flag"] if failure else "GOOD",
+            }
+        )
+
+    sondes = pd.DataFrame(rows)
+
+    flight_segments = {
+        "name": f"synthetic flight {flight_id}",
+        "mission": "EUREC4A",
+        "platform": Platform,
+        "flight_id": flight_id,
+        "date": date,
+        "segments": [],
+    }
+    for segment_id, (kind, start, end) in zip(segment_ids, segments):
+        in_segment = sondes[sondes.segment_id == segment_id]
+        flight_segments["segments"].append(
+            {
+                "kinds": [kind],
+                "segment_id": segment_id,
+                "start": pd.Timestamp(start).to_pydatetime(),
+                "end": pd.Timestamp(end).to_pydatetime(),
+                "dropsondes": {
+                    flag: list(in_segment.sonde_id[in_segment.qc_flag == flag])
+                    for flag in ["GOOD", "BAD", "UGLY"]
+                },
+            }
+        )
+
+    with open(
+        os.path.join(
+            yaml_directory, f"EUREC4A_{Platform}_Flight-Segments_{date:%Y%m%d}.yaml"
+        ),
+        "w",
+    ) as f:
+        yaml.safe_dump(flight_segments, f, sort_keys=False)
+
+    return sondes
+
+
+def write_campaign(
+    directory,
+    scale=1,
+    platforms=["HALO", "P3"],
+    n_flights=None,
+    n_circles=None,
+    sondes_per_circle=12,
+    n_straight_leg=2,
+    sonde_interval=240,
+    failure_rates=None,
+    nan_fraction=0.02,
+    seed=0,
+    workers=1,
+):
+    """
+    Input :
+        directory : string
+                    data directory of the campaign
+        scale : int
+                1, 10 or 100; size of the campaign relative to EUREC4A, see
+                campaign_scales
+        platforms : list
+        n_flights : int
+                    flights per platform; default from scale
+        n_circles : int
+                    circles per flight; default from scale
+        sondes_per_circle, n_straight_leg, sonde_interval : see get_launch_plan()
+        failure_rates : dict
+                        probability of every failure mode of failure_modes for every sonde;
+                        default the rates in failure_modes, {} for no failures
+        nan_fraction : float
+                       see make_sonde()
+        seed : int
+        workers : int
+                  number of processes writing flights in parallel; the campaign does not
+                  depend on it
+    Output :
+        sondes : pandas DataFrame
+                 sonde_id, platform, launch_time, segment_id, failure mode and the
+                 qc_flag that the Level-2 QC is expected to give, of every sonde
+
+    Writes Level-1 files (D*QC.nc) and A files of all sondes, one flight segments YAML
+    file per flight in <directory>/flight_segments/, and a configuration file
+    <directory>/joanne_config.yaml to process the campaign, e.g. with
+    run_joanne.py --config <directory>/joanne_config.yaml
+    """
+    if scale not in campaign_scales:
+        raise ValueError(
+            f"scale must be one of {list(campaign_scales)}, not {scale}; "
+            "use n_flights and n_circles for other sizes"
+        )
+    n_flights = n_flights or campaign_scales[scale]["n_flights"]
+    n_circles = n_circles or campaign_scales[scale]["n_circles"]
+
+    directory = os.path.join(os.path.abspath(directory), "")
+    yaml_directory = os.path.join(directory, "flight_segments", "")
+
+    kwargs = dict(
+        n_circles=n_circles,
+        sondes_per_circle=sondes_per_circle,
+        n_straight_leg=n_straight_leg,
+        sonde_interval=sonde_interval,
+        failure_rates=failure_rates,
+        nan_fraction=nan_fraction,
+    )
+    flights = [
+        (Platform, date, [seed, p, f])
+        for p, Platform in enumerate(platforms)
+        for f, date in enumerate(get_flight_dates(n_flights))
+    ]
+
+    if workers == 1:
+        sondes = [
+            write_flight(directory, yaml_directory, Platform, date, seed=s, **kwargs)
+            for Platform, date, s in flights
+        ]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = [
+                pool.submit(
+                    write_flight,
+                    directory,
+                    yaml_directory,
+                    Platform,
+                    date,
+                    seed=s,
+                    **kwargs,
+                )
+                for Platform, date, s in flights
+            ]
+            sondes = [future.result() for future in futures]
+
+    with open(directory + "joanne_config.yaml", "w") as f:
+        yaml.safe_dump(
+            {"data_directory": directory, "yaml_directory": yaml_directory}, f
+        )
+
+    return pd.concat(sondes, ignore_index=True)
+
+
+# %%
+
+parser = argparse.ArgumentParser(
+    description="This script writes a synthetic dropsonde campaign (Level-1 files, A files and flight segments YAML files) that can be processed with run_joanne.py --config <directory>/joanne_config.yaml, e.g. for benchmarks."
+)
+parser.add_argument("directory", help="Data directory of the campaign.")
+parser.add_argument(
+    "--scale",
+    type=int,
+    default=1,
+    choices=list(campaign_scales),
+    help="Size of the campaign relative to EUREC4A.",
+)
+parser.add_argument("--flights", type=int, help="Flights per platform.")
+parser.add_argument("--circles", type=int, help="Circles per flight.")
+parser.add_argument(
+    "--no-failures", action="store_true", help="Generate only GOOD sondes."
+)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument(
+    "--workers", type=int, default=1, help="Number of processes writing flights."
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    sondes = write_campaign(
+        args.directory,
+        scale=args.scale,
+        n_flights=args.flights,
+        n_circles=args.circles,
+        failure_rates={} if args.no_failures else None,
+        seed=args.seed,
+        workers=args.workers,
+    )
+    print(
+        f"{len(sondes)} sondes written to {args.directory}:",
+        sondes.qc_flag.value_counts().to_dict(),
+    )
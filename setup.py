@@ -25,7 +25,6 @@ setuptools.setup(
         "xarray>=0.15.0",
         "netCDF4>=1.5.0",
         "MetPy>=0.12.1",
-        "scikit-learn>=0.22.0",
         "PyYAML>=5.3.0",
     ],
 )
@@ -0,0 +1,83 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+yaml = pytest.importorskip("yaml")
+
+from joanne import benchmark, config
+
+
+def make_result(items_per_second, peak_allocated):
+    return {"items_per_second": items_per_second, "peak_allocated": peak_allocated}
+
+
+def test_compare_results_and_history(tmp_path):
+    baseline = {
+        "fit2d_xr": {"small": make_result(100, 10 ** 6)},
+        "get_circle_products": {"small": make_result(10, 10 ** 6)},
+    }
+    results = {
+        "fit2d_xr": {"small": make_result(70, 10 ** 6), "medium": make_result(9, 1)},
+        "get_circle_products": {"small": make_result(11, 1.1 * 10 ** 6)},
+    }
+
+    comparison = benchmark.compare_results(results, baseline, threshold=0.2)
+
+    assert [(row["name"], row["size"], row["regressed"]) for row in comparison] == [
+        ("fit2d_xr", "small", True),
+        ("fit2d_xr", "medium", False),
+        ("get_circle_products", "small", False),
+    ]
+    assert comparison[0]["throughput_change"] == pytest.approx(-0.3)
+    assert comparison[1]["throughput_change"] is None
+    assert "REGRESSED" in benchmark.format_comparison(comparison)
+
+    history_path = str(tmp_path / "history.jsonl")
+    assert benchmark.load_history(history_path) == []
+    for r in [baseline, results]:
+        benchmark.append_to_history(history_path, benchmark.get_history_entry(r))
+
+    history = benchmark.load_history(history_path)
+    assert [entry["results"] for entry in history] == [baseline, results]
+
+    # the baseline is the median of the latest runs, so one slow run does not move it
+    slow = {"fit2d_xr": {"small": make_result(10, None)}}
+    history = [{"results": r} for r in [baseline, results, slow, baseline]]
+    assert benchmark.get_baseline(history)["fit2d_xr"] == {
+        "small": {"items_per_second": 85, "peak_allocated": 10 ** 6},
+        "medium": {"items_per_second": 9, "peak_allocated": 1},
+    }
+    assert benchmark.get_baseline(history, n_runs=2)["fit2d_xr"]["small"] == {
+        "items_per_second": 55,
+        "peak_allocated": 10 ** 6,
+    }
+
+
+def test_run_benchmarks(tmp_path):
+    previous_settings = dict(config.settings)
+    size_kwargs = {
+        "tiny": {
+            "n_circles": 1,
+            "sondes_per_circle": 6,
+            "n_straight_leg": 0,
+            "failure_rates": {},
+        }
+    }
+
+    results = benchmark.run_benchmarks(
+        str(tmp_path),
+        names=["get_status_ds_for_platform", "pressure_interpolation"],
+        sizes_to_run=["tiny"],
+        repeat=2,
+        size_kwargs=size_kwargs,
+    )
+
+    assert config.settings == previous_settings
+    for name in ["get_status_ds_for_platform", "pressure_interpolation"]:
+        result = results[name]["tiny"]
+        assert result["items"] == 6
+        assert result["seconds"] <= result["median_seconds"]
+        assert result["peak_allocated"] > 0
+
+    with pytest.raises(ValueError, match="fit2d"):
+        benchmark.run_benchmarks(str(tmp_path), names=["fit2d"])
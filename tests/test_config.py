@@ -0,0 +1,110 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+yaml = pytest.importorskip("yaml")
+
+from joanne import config, pipeline
+
+
+@pytest.fixture
+def settings():
+    previous_settings = dict(config.settings)
+    yield config.settings
+    config.settings.clear()
+    config.settings.update(previous_settings)
+
+
+def test_load_config(tmp_path):
+    config_file = tmp_path / "campaign.yaml"
+    config_file.write_text(
+        "data_directory: /scratch/joanne\nworkers: 8\nmemory_budget: 512MB\n"
+    )
+    environ = {"JOANNE_CONFIG": str(config_file), "JOANNE_WORKERS": "4"}
+
+    settings = config.load_config(environ=environ)
+
+    assert settings["data_directory"] == "/scratch/joanne/"
+    assert settings["workers"] == 4
+    assert settings["memory_budget"] == 512 * 10 ** 6
+    assert settings["codec_profile"] == "default"
+
+    config_file.write_text("data_dir: /scratch/joanne\n")
+    with pytest.raises(ValueError, match="data_dir"):
+        config.load_config(str(config_file), environ={})
+    with pytest.raises(ValueError, match="codec_profile"):
+        config.load_config(environ={"JOANNE_CODEC_PROFILE": "lz4"})
+
+
+def test_directories(settings, tmp_path):
+    config.set_config(
+        data_directory="/scratch/data",
+        output_directory=str(tmp_path),
+        codec_profile="fast",
+        memory_budget="1KB",
+    )
+
+    assert config.get_directory("level_1") == "/scratch/data/Level_1/"
+    assert config.get_directory("level_3") == os.path.join(str(tmp_path), "Level_3", "")
+    assert config.get_directory("level_3_interim").startswith(str(tmp_path))
+    assert config.get_compression()["complevel"] == 1
+    assert config.get_chunk_size(300) == 3
+    assert config.get_chunk_size(300, chunk_size=7) == 7
+
+    config.set_config(cache_directory="/tmp/cache", chunk_size=5)
+    assert (
+        config.get_directory("level_3_interim") == "/tmp/cache/Level_3/Interim_files/"
+    )
+    assert config.get_chunk_size(300) == 5
+
+
+def test_default_directories(settings, tmp_path):
+    settings.update(config.load_config(environ={}))
+
+    # no absolute default paths: directories are relative to the working directory
+    assert config.get_directory("level_1") == os.path.join(".", "Level_1", "")
+    assert config.get_directory("yaml") == os.path.join(".", "flight_segments", "")
+
+    config.set_config(data_directory=str(tmp_path))
+    assert config.get_directory("yaml") == os.path.join(
+        str(tmp_path), "flight_segments", ""
+    )
+
+    # the cache directory ends in a separator like all other directories
+    settings["cache_directory"] = str(tmp_path / "cache")
+    assert config.get_directory("cache") == os.path.join(str(tmp_path), "cache", "")
+
+    state_path = config.get_directory("cache") + "joanne_pipeline_state.json"
+    pipeline.save_state({"a": {}}, state_path)
+    assert pipeline.load_state(state_path) == {"a": {}}
+
+
+def test_pipeline_tasks_from_config(settings, tmp_path):
+    (tmp_path / "Level_1" / "HALO").mkdir(parents=True)
+    (tmp_path / "Level_1" / "HALO" / "D20200202_123456QC.nc").write_text("")
+    config.set_config(data_directory=str(tmp_path))
+
+    tasks = {task["name"]: task for task in pipeline.get_joanne_tasks(["HALO"])}
+
+    assert tasks["level_2:HALO_20200202_123456"]["inputs"] == [
+        str(tmp_path / "Level_1" / "HALO" / "D20200202_123456QC.nc")
+    ]
+    assert tasks["level_4"]["kwargs"]["save_directory"] == os.path.join(
+        str(tmp_path), "Level_4", ""
+    )
+
+
+def test_get_lv3_filename(settings, tmp_path):
+    prep = pytest.importorskip("joanne.Level_4.ready_ds_for_regression")
+    (tmp_path / "Level_3").mkdir()
+    for v in ["0.9.1", "0.10.0", "0.10.0+2.g1234"]:
+        (
+            tmp_path / "Level_3" / f"EUREC4A_JOANNE_Dropsonde-RD41_Level_3_v{v}.nc"
+        ).write_text("")
+    config.set_config(data_directory=str(tmp_path))
+
+    assert prep.get_lv3_filename().endswith("Level_3_v0.10.0+2.g1234.nc")
+
+    with pytest.raises(FileNotFoundError):
+        prep.get_lv3_filename(str(tmp_path) + "/")
@@ -0,0 +1,271 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+f3 = pytest.importorskip("joanne.Level_3.fn_3")
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_fill_gaps_same_as_interpolate_na(dtype):
+    rng = np.random.default_rng(42)
+    alt = np.arange(0, 1000, 10)
+    values = rng.normal(size=(50, len(alt))).astype(dtype)
+    values[rng.random(values.shape) < 0.4] = np.nan
+    values[10:20] = values[0]  # profiles sharing a pattern of NaNs
+
+    expected = (
+        xr.DataArray(values, dims=("sonde_id", "alt"), coords={"alt": alt})
+        .interpolate_na("alt", max_gap=f3.max_gap_fill, use_coordinate=True)
+        .values
+    )
+    filled = f3.fill_gaps(values, alt, f3.max_gap_fill)
+
+    assert filled.dtype == expected.dtype
+    np.testing.assert_array_equal(filled, expected)
+
+
+def test_bin_time_exact():
+    start = np.datetime64("2020-02-05T10:00:00.000000001")
+    time = start + np.arange(6) * np.timedelta64(250, "ms")
+    alt = np.array([2.0, 4.0, 6.0, 12.0, 14.0, 40.0])
+
+    seconds = f3.bin_time(time, alt, np.array([-5, 5, 15, 25, 35]))
+
+    assert np.isnan(seconds[2:]).all()
+    np.testing.assert_array_equal(
+        f3.datetime_from_seconds(seconds[:2]),
+        [time[0] + np.timedelta64(125, "ms"), time[3]],
+    )
+
+
+def make_profile(n=2000, seed=0):
+    """Level-2-like sounding along 'alt', from ready_to_interpolate()"""
+    rng = np.random.default_rng(seed)
+    alt = np.linspace(5, 9995, n)
+    time = np.datetime64("2020-02-05T10:00:00") + (
+        (alt.max() - alt) / 10 * 1e9
+    ).astype("timedelta64[ns]")
+    p = 101500 * np.exp(-alt / 8000)
+
+    return xr.Dataset(
+        {
+            "p": ("alt", p),
+            "ta": ("alt", 300 - 0.0065 * alt + rng.normal(scale=0.1, size=n)),
+            "u": ("alt", 5 + rng.normal(size=n)),
+            "time": ("alt", time),
+        },
+        coords={
+            "alt": alt,
+            "lat": ("alt", 13.3 + rng.normal(scale=1e-3, size=n)),
+            "lon": ("alt", -57.7 + rng.normal(scale=1e-3, size=n)),
+        },
+    )
+
+
+def test_bin_means_in_float64():
+    profile = make_profile()
+    as_float32 = profile.assign(
+        {var: profile[var].astype("float32") for var in ["p", "ta", "u"]}
+    )
+    as_float64 = as_float32.assign(
+        {var: as_float32[var].astype("float64") for var in ["p", "ta", "u"]}
+    )
+
+    # float32 input is binned as exactly as the same values in float64
+    binned = f3.interp_along_height(as_float32)
+    expected = f3.interp_along_height(as_float64)
+
+    for var in ["p", "ta", "u", "lat", "lon"]:
+        np.testing.assert_array_equal(binned[var], expected[var])
+
+
+def test_pressure_bins_centred_in_log_p():
+    grid, bins = f3.pressure_grid, f3.pressure_bins
+
+    # the edges between levels are their geometric means, the outer edges are half a
+    # level spacing in log(p) beyond the outer levels
+    assert len(bins) == len(grid) + 1
+    np.testing.assert_allclose(bins[1:-1], np.sqrt(grid[:-1] * grid[1:]), rtol=1e-12)
+    np.testing.assert_allclose(np.log(bins[[0, 1]]).mean(), np.log(grid[0]))
+    np.testing.assert_allclose(np.log(bins[[-2, -1]]).mean(), np.log(grid[-1]))
+
+
+def test_interp_along_pressure_known_profile():
+    profile = make_profile(n=20000)
+
+    binned = f3.interp_along_pressure(profile)
+
+    assert binned.ta.dims == ("p",)
+    np.testing.assert_array_equal(binned.p, f3.pressure_grid)
+
+    # the profile is linear in log(p) and evenly sampled in alt, so with bins centred
+    # in log(p), the mean altitude of every bin is that of its pressure level
+    expected_alt = -8000 * np.log(f3.pressure_grid / 101500)
+    within = (expected_alt > 10) & (expected_alt < 9990)
+    np.testing.assert_allclose(binned.alt[within], expected_alt[within], atol=1)
+    np.testing.assert_allclose(
+        binned.ta[within], 300 - 0.0065 * expected_alt[within], atol=0.1
+    )
+    assert np.isnan(binned.ta[expected_alt > 10000]).all()
+    assert (np.diff(binned.interpolated_time[within]) > np.timedelta64(0)).all()
+
+
+def test_lv3_structure_on_pressure_levels(tmp_path):
+    pytest.importorskip("yaml")
+    from joanne import config
+    from test_synthetic import write_level_2_campaign
+
+    previous_settings = config.set_config()
+    try:
+        _, lv2_files = write_level_2_campaign(
+            str(tmp_path),
+            failure_rates={},
+            n_flights=1,
+            n_circles=1,
+            sondes_per_circle=2,
+            n_straight_leg=0,
+        )
+        dataset, p_dataset = f3.lv3_structure_from_lv2(lv2_files, pressure_levels=True)
+        # without pressure levels, from the interim files of the same gridding pass
+        height_only = f3.lv3_structure_from_lv2(lv2_files)
+    finally:
+        config.set_config(**previous_settings)
+
+    assert height_only.identical(dataset)
+    np.testing.assert_array_equal(p_dataset.sonde_id, dataset.sonde_id)
+    assert p_dataset.alt.dims == ("sonde_id", "p")
+    np.testing.assert_array_equal(p_dataset.p, f3.pressure_grid)
+
+    # the altitude of every pressure level is that of the gridded profile
+    for sonde in range(len(dataset.sonde_id)):
+        p, alt = dataset.p[sonde].values, dataset.alt.values
+        alt, p = alt[~np.isnan(p)], p[~np.isnan(p)]
+        expected = np.interp(f3.pressure_grid, p[::-1], alt[::-1])
+
+        on_levels = p_dataset.alt[sonde].values
+        valid = (
+            ~np.isnan(on_levels)
+            & (f3.pressure_grid < p.max())
+            & (f3.pressure_grid > p.min())
+        )
+        assert valid.sum() > 500
+        np.testing.assert_allclose(on_levels[valid], expected[valid], atol=10)
+
+
+def write_full_lv3(lv2_files, file_path):
+    """Level-3 of lv2_files from their interim files, as the normal build writes it"""
+    f3.write_lv3_file(
+        f3.get_lv3_to_save_dataset(f3.lv3_structure_from_lv2(lv2_files)),
+        file_path,
+        lv2_fingerprints=f3.get_lv2_fingerprints(lv2_files),
+    )
+    return file_path
+
+
+def assert_same_lv3(file_path, expected_file_path):
+    from joanne import reader
+
+    with xr.open_dataset(file_path) as lv3, xr.open_dataset(expected_file_path) as ref:
+        for ds in [lv3, ref]:
+            del ds.attrs["creation_time"]
+        xr.testing.assert_identical(lv3, ref)
+
+    index, ref_index = [
+        reader.get_sonde_index(f) for f in [file_path, expected_file_path]
+    ]
+    for var in ["sonde_id", "row", "launch_time", "lv2_fingerprint"]:
+        np.testing.assert_array_equal(index[var], ref_index[var])
+
+
+def test_append_to_level_3_same_as_rebuild(tmp_path):
+    pytest.importorskip("yaml")
+    from joanne import config
+    from test_synthetic import write_level_2_campaign
+
+    previous_settings = config.set_config()
+    try:
+        sondes, lv2_files = write_level_2_campaign(
+            str(tmp_path / "campaign"),
+            failure_rates={},
+            n_flights=1,
+            n_circles=1,
+            sondes_per_circle=3,
+            n_straight_leg=0,
+        )
+        lv3_path = write_full_lv3(
+            [lv2_files[0], lv2_files[2]], str(tmp_path / "lv3.nc")
+        )
+
+        # insert: the middle sonde goes between the two sondes already in the file
+        new_sondes = f3.append_to_level_3(lv3_path, lv2_files)
+        assert new_sondes == [sondes.sonde_id[1]]
+        assert_same_lv3(lv3_path, write_full_lv3(lv2_files, str(tmp_path / "ref.nc")))
+
+        # replace: a changed Level-2 file replaces the sonde's row
+        with xr.open_dataset(lv2_files[1]) as lv2:
+            lv2 = lv2.load()
+        lv2["ta"] = lv2.ta + 1
+        lv2.to_netcdf(lv2_files[1])
+        f3.grid_to_interim_files(lv2_files[1])
+
+        assert f3.append_to_level_3(lv3_path, lv2_files) == [sondes.sonde_id[1]]
+        assert_same_lv3(
+            lv3_path, write_full_lv3(lv2_files, str(tmp_path / "ref_changed.nc"))
+        )
+
+        # no-op: nothing changed, so the file is not touched
+        modified = os.path.getmtime(lv3_path)
+        assert f3.append_to_level_3(lv3_path, lv2_files) == []
+        assert os.path.getmtime(lv3_path) == modified
+    finally:
+        config.set_config(**previous_settings)
+
+
+def test_append_to_level_3_also_on_pressure_levels(tmp_path):
+    pytest.importorskip("yaml")
+    from joanne import config
+    from test_synthetic import write_level_2_campaign
+
+    def write_lv3_files(lv2_files, directory):
+        os.makedirs(directory)
+        lv3, lv3_p = f3.lv3_structure_from_lv2(lv2_files, pressure_levels=True)
+        file_path = os.path.join(directory, "RD41_Level_3_v1.nc")
+        f3.write_lv3_file(
+            f3.get_lv3_to_save_dataset(lv3),
+            file_path,
+            lv2_fingerprints=f3.get_lv2_fingerprints(lv2_files),
+        )
+        f3.write_lv3_file(
+            f3.get_lv3_p_to_save_dataset(lv3_p), f3.get_lv3_p_file_path(file_path)
+        )
+        return file_path
+
+    previous_settings = config.set_config()
+    try:
+        sondes, lv2_files = write_level_2_campaign(
+            str(tmp_path / "campaign"),
+            failure_rates={},
+            n_flights=1,
+            n_circles=1,
+            sondes_per_circle=3,
+            n_straight_leg=0,
+        )
+        lv3_path = write_lv3_files(lv2_files[:2], str(tmp_path / "lv3"))
+
+        # files are selected by the sonde_id in them, whatever their order
+        new_sondes = f3.append_to_level_3(lv3_path, lv2_files[::-1])
+        assert new_sondes == [sondes.sonde_id[2]]
+
+        ref_path = write_lv3_files(lv2_files, str(tmp_path / "ref"))
+        assert_same_lv3(lv3_path, ref_path)
+
+        p_path, ref_p_path = [f3.get_lv3_p_file_path(f) for f in [lv3_path, ref_path]]
+        assert p_path != lv3_path
+        with xr.open_dataset(p_path) as lv3_p, xr.open_dataset(ref_p_path) as ref:
+            for ds in [lv3_p, ref]:
+                del ds.attrs["creation_time"]
+            xr.testing.assert_identical(lv3_p, ref)
+    finally:
+        config.set_config(**previous_settings)
@@ -0,0 +1,101 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+yaml = pytest.importorskip("yaml")
+
+from joanne.Level_4 import incremental as inc
+
+
+def make_circles(n_circle=3, n_sounding=13, n_alt=5):
+    rng = np.random.default_rng(0)
+    dims = ("circle", "sounding", "alt")
+    sonde_id = np.array(
+        [
+            [f"HALO-0205_c{c}_s{s:02d}" for s in range(n_sounding)]
+            for c in range(n_circle)
+        ],
+        dtype=object,
+    )
+    sonde_id[0, 10:] = np.nan
+    return xr.Dataset(
+        {
+            "u": (dims, rng.normal(size=(n_circle, n_sounding, n_alt))),
+            "segment_id": (["circle"], [f"HALO-0205_c{c}" for c in range(n_circle)]),
+        },
+        coords={"sonde_id": (("circle", "sounding"), sonde_id)},
+    )
+
+
+def make_lv4(circles, fingerprints):
+    return xr.Dataset(
+        {
+            "D": (("circle", "alt"), circles.u.mean("sounding").values),
+            "segment_id": (["circle"], circles.segment_id.values),
+            "circle_fingerprint": (["circle"], fingerprints),
+        },
+        coords={"circle": np.arange(len(fingerprints))},
+    )
+
+
+def test_fingerprints_change_only_for_changed_circles():
+    circles = make_circles()
+    fingerprints = inc.get_circle_fingerprints(circles)
+
+    assert len(set(fingerprints)) == 3
+    np.testing.assert_array_equal(fingerprints, inc.get_circle_fingerprints(circles))
+
+    circles.u[1, 4, 2] = 0.0
+    changed = inc.get_circle_fingerprints(circles) != fingerprints
+    np.testing.assert_array_equal(changed, [False, True, False])
+
+    assert (inc.get_circle_fingerprints(circles, ["u"]) != fingerprints).all()
+
+
+def test_fingerprints_change_with_regression_settings():
+    from joanne import precision
+
+    circles = make_circles()
+    parameters = ["u", "v", "q", "ta", "p"]
+    fingerprints = inc.get_circle_fingerprints(circles)
+
+    for kwargs in [
+        {"method": "huber"},
+        {"method": "huber", "tuning": 2.0},
+        {"min_points": 7},
+    ]:
+        other = inc.get_circle_fingerprints(circles, parameters, **kwargs)
+        assert (other != fingerprints).all(), kwargs
+
+    previous_dtype = precision.set_working_dtype("float32")
+    try:
+        assert (inc.get_circle_fingerprints(circles) != fingerprints).all()
+    finally:
+        precision.set_working_dtype(previous_dtype)
+
+
+def test_splice_level_4():
+    circles = make_circles()
+    old_fingerprints = inc.get_circle_fingerprints(circles)
+    old_lv4 = make_lv4(circles, old_fingerprints)
+
+    # circle 1 changes, circle 0 is dropped and a new circle is added at the end
+    circles = xr.concat(
+        [circles.isel(circle=[1, 2]), make_circles(4).isel(circle=[3])], "circle"
+    )
+    circles.u[0] = circles.u[0] + 1
+    fingerprints = inc.get_circle_fingerprints(circles)
+
+    changed = inc.get_changed_circles(fingerprints, old_lv4)
+    np.testing.assert_array_equal(changed, [True, False, True])
+
+    new_lv4 = make_lv4(
+        circles.isel(circle=np.flatnonzero(changed)), fingerprints[changed]
+    )
+    lv4 = inc.splice_level_4(new_lv4, old_lv4, fingerprints, changed)
+
+    np.testing.assert_array_equal(lv4.circle_fingerprint, fingerprints)
+    np.testing.assert_array_equal(lv4.D, circles.u.mean("sounding"))
+    np.testing.assert_array_equal(lv4.D[1], old_lv4.D[2])
+    assert list(lv4.circle.values) == [0, 1, 2]
+    assert inc.get_changed_circles(fingerprints).all()
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from joanne import instrument
+
+
+@pytest.fixture
+def recording():
+    instrument.clear()
+    instrument.start()
+    yield instrument.records
+    instrument.stop()
+    instrument.clear()
+
+
+@instrument.instrumented(count=lambda n: n)
+def allocate(n):
+    return np.ones((n, 10 ** 5)).sum()
+
+
+def test_timed_and_instrumented(recording):
+    instrument.start(allocations=True)
+
+    with instrument.timed("stage", n_items=3):
+        for n in [1, 2, 10]:
+            allocate(n)
+
+    assert [record["name"] for record in recording] == [f"{__name__}.allocate"] * 3 + [
+        "stage"
+    ]
+    assert recording[0]["parent"] == "stage"
+    assert recording[2]["peak_allocated"] >= 10 * 8 * 10 ** 5
+    # the peak of the inner timer counts for the outer one too
+    assert recording[3]["peak_allocated"] >= recording[2]["peak_allocated"]
+
+    report = instrument.get_report()
+    timer = report["timers"][f"{__name__}.allocate"]
+    assert (timer["calls"], timer["items"]) == (3, 13)
+    per_item = [r["seconds"] / r["n_items"] for r in recording[:3]]
+    assert timer["seconds_per_item"]["max"] == pytest.approx(max(per_item))
+    assert report["timers"]["stage"]["parent"] is None
+
+
+def test_disabled():
+    instrument.clear()
+    allocate(1)
+    with instrument.timed("stage"):
+        pass
+
+    assert instrument.records == []
+
+
+def test_write_report(recording, tmp_path):
+    rf = pytest.importorskip("joanne.Level_4.rgr_fn")
+    from test_rgr_fn import make_circles
+
+    rf.fit2d_for_parameters(make_circles(n_circle=5), ["u", "v"])
+
+    file_path = instrument.write_report(str(tmp_path / "report.json"), run="test")
+    with open(file_path) as f:
+        report = json.load(f)
+
+    assert report["run"] == "test"
+    assert report["timers"]["joanne.Level_4.rgr_fn.fit2d_for_parameters"]["items"] == 5
+
+
+def test_pipeline_records(recording, tmp_path):
+    from joanne import pipeline
+    from test_pipeline import make_tasks
+
+    pipeline.run_tasks(make_tasks(tmp_path), str(tmp_path / "state.json"), workers=1)
+
+    report = instrument.get_report()
+    assert report["timers"]["stage:level_2"]["calls"] == 2
+    assert report["timers"]["stage:level_3_assembly"]["calls"] == 1
@@ -0,0 +1,174 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+yaml = pytest.importorskip("yaml")
+
+from joanne import pipeline
+
+
+def concatenate(inputs, output):
+    with open(output, "w") as f:
+        for file_path in inputs:
+            with open(file_path) as g:
+                f.write(g.read())
+    with open(output + ".count", "a") as f:
+        f.write("x")
+    return [output]
+
+
+def first_line(inputs, output):
+    with open(inputs[0]) as f:
+        line = f.readline()
+    with open(output, "w") as f:
+        f.write(line)
+    with open(output + ".count", "a") as f:
+        f.write("x")
+    return [output]
+
+
+def fail(inputs):
+    raise ValueError("broken")
+
+
+def n_runs(output):
+    with open(output + ".count") as f:
+        return len(f.read())
+
+
+def make_tasks(tmp_path):
+    for name in ["a", "b"]:
+        (tmp_path / f"{name}.txt").write_text(f"{name}1\n{name}2\n")
+
+    return [
+        pipeline.make_task(
+            "level_2:a",
+            "level_2",
+            first_line,
+            inputs=[str(tmp_path / "a.txt")],
+            output=str(tmp_path / "a.l2"),
+        ),
+        pipeline.make_task(
+            "level_2:b",
+            "level_2",
+            first_line,
+            inputs=[str(tmp_path / "b.txt")],
+            output=str(tmp_path / "b.l2"),
+        ),
+        pipeline.make_task(
+            "level_3_assembly",
+            "level_3_assembly",
+            concatenate,
+            deps=["level_2:a", "level_2:b"],
+            output=str(tmp_path / "l3"),
+        ),
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_run_tasks(tmp_path, workers):
+    tasks = make_tasks(tmp_path)
+    state_path = str(tmp_path / "state.json")
+    kwargs = dict(workers=1)
+    if workers > 1:
+        kwargs = dict(pool=pipeline.get_worker_pool(workers, modules=[]))
+
+    plan = pipeline.run_tasks(tasks, state_path, dry_run=True)
+    assert [reason for _, reason in plan] == ["new", "new", "upstream"]
+    assert not os.path.exists(tmp_path / "l3")
+
+    pipeline.run_tasks(tasks, state_path, **kwargs)
+    assert (tmp_path / "l3").read_text() == "a1\nb1\n"
+
+    plan = pipeline.run_tasks(tasks, state_path, **kwargs)
+    assert all(reason == "up to date" for _, reason in plan)
+
+    # the Level-2 output of 'a' does not change, so the assembly is not run again
+    (tmp_path / "a.txt").write_text("a1\na3\n")
+    plan = pipeline.run_tasks(tasks, state_path, **kwargs)
+    assert dict(plan) == {
+        "level_2:a": "ran",
+        "level_2:b": "up to date",
+        "level_3_assembly": "up to date",
+    }
+
+    (tmp_path / "b.txt").write_text("b3\n")
+    os.remove(tmp_path / "a.l2")
+    plan = pipeline.run_tasks(tasks, state_path, **kwargs)
+    assert all(reason == "ran" for _, reason in plan)
+    assert (tmp_path / "l3").read_text() == "a1\nb3\n"
+    assert n_runs(str(tmp_path / "l3")) == 2
+
+    if workers > 1:
+        kwargs["pool"].shutdown()
+
+
+def test_select_tasks(tmp_path):
+    tasks = make_tasks(tmp_path)
+
+    assert pipeline.select_tasks(tasks, until="level_2") == {"level_2:a", "level_2:b"}
+    assert pipeline.select_tasks(tasks, only=["level_2:b", "level_3_assembly"]) == {
+        "level_2:b",
+        "level_3_assembly",
+    }
+    assert pipeline.select_tasks(tasks, only=["level_2:*"], until="qc") == set()
+
+    with pytest.raises(ValueError):
+        pipeline.select_tasks(tasks, until="level_5")
+
+
+def test_failed_task(tmp_path):
+    tasks = make_tasks(tmp_path)
+    tasks[1] = pipeline.make_task("level_2:b", "level_2", fail)
+    state_path = str(tmp_path / "state.json")
+
+    with pytest.raises(RuntimeError, match="level_2:b"):
+        pipeline.run_tasks(tasks, state_path, workers=1)
+
+    state = pipeline.load_state(state_path)
+    assert list(state) == ["level_2:a"]
+    assert not os.path.exists(tmp_path / "l3")
+
+
+def test_execution_order():
+    tasks = [
+        pipeline.make_task("c", "level_4", fail, deps=["b"]),
+        pipeline.make_task("b", "level_3", fail, deps=["a"]),
+        pipeline.make_task("a", "level_2", fail),
+    ]
+
+    assert pipeline.get_execution_order(tasks) == ["a", "b", "c"]
+
+    tasks[2]["deps"] = ["c"]
+    with pytest.raises(ValueError, match="circular"):
+        pipeline.get_execution_order(tasks)
+
+
+def get_imported(names):
+    import sys
+
+    return [name for name in names if name in sys.modules]
+
+
+def test_worker_pool(tmp_path):
+    multiprocessing = pytest.importorskip("multiprocessing")
+    modules = ["json", "joanne.segments"]
+
+    with pipeline.get_worker_pool(
+        1,
+        modules=modules + ["not_a_module"],
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        assert pool.submit(get_imported, modules).result() == modules
+
+        # the same warm workers serve several runs
+        tasks = make_tasks(tmp_path)
+        state_path = str(tmp_path / "state.json")
+        pipeline.run_tasks(tasks, state_path, pool=pool)
+        (tmp_path / "b.txt").write_text("b3\n")
+        plan = pipeline.run_tasks(tasks, state_path, pool=pool)
+
+    assert dict(plan)["level_3_assembly"] == "ran"
+    assert (tmp_path / "l3").read_text() == "a1\nb3\n"
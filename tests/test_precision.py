@@ -0,0 +1,121 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+yaml = pytest.importorskip("yaml")
+precision = pytest.importorskip("joanne.precision")
+rf = pytest.importorskip("joanne.Level_4.rgr_fn")
+
+from test_rgr_fn import make_circles
+
+
+def test_as_working_dtype():
+    ds = xr.Dataset(
+        {"u": ("alt", np.ones(3)), "n": ("alt", np.arange(3))},
+        coords={"alt": np.arange(3.0)},
+    )
+
+    previous_dtype = precision.set_working_dtype("float32")
+    try:
+        cast = precision.as_working_dtype(ds)
+    finally:
+        precision.set_working_dtype(previous_dtype)
+
+    assert cast.u.dtype == "float32"
+    assert cast.n.dtype == ds.n.dtype
+    assert cast.alt.dtype == "float64"
+    assert precision.as_working_dtype(ds.u.values).dtype == "float64"
+
+    with pytest.raises(ValueError):
+        precision.set_working_dtype("float16")
+
+
+def test_float32_regression_report():
+    report = precision.validate_working_dtype(
+        rf.fit2d_for_parameters, make_circles(), ["u", "v"]
+    )
+
+    assert "dudx" in report.variable
+    assert (report.nan_mismatch == 0).all()
+    assert float(report.max_rel_diff.max()) < 1e-5
+    assert precision.get_working_dtype() == "float64"
+    assert len(precision.format_precision_report(report).splitlines()) == len(
+        report.variable
+    ) + 1
+
+
+def test_float32_circle_products():
+    pytest.importorskip("metpy")
+    ds = rf.fit2d_for_parameters(make_circles(n_alt=100), ["u", "v"])
+    rf.get_div_and_vor(ds)
+    for var in ["q", "ta", "p"]:
+        ds[var + "_sounding"] = ds.u_sounding * 0 + {"q": 0.01, "ta": 300, "p": 1e5}[var]
+
+    def get_products(circles):
+        rf.get_density_vertical_velocity_and_omega(circles)
+        return circles
+
+    report = precision.validate_working_dtype(
+        get_products, ds, variables=["W", "omega", "density"]
+    )
+
+    assert (report.nan_mismatch == 0).all()
+    assert float(report.max_rel_diff.max()) < 1e-5
+
+
+def get_working_dtype_of_worker():
+    return precision.as_working_dtype(np.ones(3)).dtype.name
+
+
+def test_working_dtype_in_config_and_workers():
+    multiprocessing = pytest.importorskip("multiprocessing")
+    from joanne import config, pipeline
+
+    previous_dtype = precision.set_working_dtype("float32")
+    try:
+        assert config.settings["working_dtype"] == "float32"
+
+        # workers take the working dtype from the settings of this process
+        with pipeline.get_worker_pool(
+            1, modules=[], mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            assert pool.submit(get_working_dtype_of_worker).result() == "float32"
+    finally:
+        precision.set_working_dtype(previous_dtype)
+
+    with pytest.raises(ValueError, match="working_dtype"):
+        config.set_config(working_dtype="float16")
+
+
+def test_float32_intermediate_arrays():
+    from test_fn_3 import make_profile
+
+    f3 = pytest.importorskip("joanne.Level_3.fn_3")
+    ds = make_circles()
+    dims = ("circle", "alt", "sounding")
+    x, y, u = [ds[var].transpose(*dims).values for var in ["dx", "dy", "u"]]
+    valid = ~np.isnan(u)
+    starts, stops = np.array([0, 2]), np.array([8, 13])
+
+    previous_dtype = precision.set_working_dtype("float32")
+    try:
+        moments = rf.fit2d_moments(x, y, valid)
+        results = rf.fit2d_solve(moments, u, std_err=True)
+        window = rf.window_moments(x, y, valid, starts, stops)
+        binned = f3.interp_along_height(make_profile())
+        pressure_binned = f3.interp_along_pressure(make_profile())
+    finally:
+        precision.set_working_dtype(previous_dtype)
+
+    # the arrays of the points are in float32, only the sums are in float64
+    for key in ["w", "x_anom", "y_anom", "wx_anom", "wy_anom"]:
+        assert moments[key].dtype == "float32", key
+    for key in ["sw", "x_mean", "inv_xx", "inv_xy"]:
+        assert moments[key].dtype == "float64", key
+    assert all(result.dtype == "float64" for result in results)
+    assert window["x_ref"].dtype == window["y_ref"].dtype == "float32"
+    assert window["inv_xx"].dtype == "float64"
+
+    for var in ["p", "ta", "u", "lat", "lon"]:
+        assert binned[var].dtype == "float32", var
+    assert pressure_binned.ta.dtype == pressure_binned.alt.dtype == "float32"
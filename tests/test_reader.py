@@ -0,0 +1,48 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+
+from joanne import reader
+
+
+def make_lv3_file(path, n=20, n_alt=50, sonde_id=None):
+    if sonde_id is None:
+        sonde_id = [f"HALO-02{5 + i // 10:02d}_s{i % 10 + 1:02d}" for i in range(n)]
+    n = len(sonde_id)
+    launch_time = np.datetime64("2020-02-05T10:00") + np.arange(n) * np.timedelta64(
+        4, "h"
+    )
+    ds = xr.Dataset(
+        {
+            "ta": (["sonde_id", "alt"], np.random.rand(n, n_alt).astype("float32")),
+            "launch_time": (["sonde_id"], launch_time),
+            "platform_id": (["sonde_id"], np.array(["HALO"] * (n - 5) + ["P3"] * 5)),
+            "flight_lat": (["sonde_id"], np.linspace(12, 14, n)),
+            "flight_lon": (["sonde_id"], np.linspace(-58, -56, n)),
+        },
+        coords={"sonde_id": sonde_id, "alt": np.arange(0, n_alt * 10, 10)},
+        attrs={"creation_time": "2020-01-01 00:00:00 UTC"},
+    )
+    ds.to_netcdf(path)
+    return ds
+
+
+def test_open_level_3_reads_requested_sondes_in_order(tmp_path):
+    path = str(tmp_path / "lv3.nc")
+    ds = make_lv3_file(path)
+    reader.write_sonde_index(ds, path)
+
+    sonde_ids = ["HALO-0206_s03", "HALO-0205_s02"]
+    subset = reader.open_level_3(path, sonde_ids=sonde_ids)
+
+    assert list(subset.sonde_id.values) == sonde_ids
+    np.testing.assert_array_equal(subset.ta.values, ds.ta.sel(sonde_id=sonde_ids))
+
+
+def test_query_sonde_index_filters(tmp_path):
+    index = reader.build_sonde_index(make_lv3_file(str(tmp_path / "lv3.nc")))
+
+    assert list(reader.query_sonde_index(index, platform_id="P3")) == [15, 16, 17, 18, 19]
+    assert list(reader.query_sonde_index(index, flight_date="2020-02-05")) == [0, 1, 2, 3]
+    assert list(reader.query_sonde_index(index, lat_range=(12.0, 12.2))) == [0, 1]
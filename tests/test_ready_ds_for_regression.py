@@ -0,0 +1,145 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+yaml = pytest.importorskip("yaml")
+prep = pytest.importorskip("joanne.Level_4.ready_ds_for_regression")
+
+
+def make_circle_points(n_circle=3, n_alt=4, n_sounding=12, noise=0, seed=0):
+    """points on circles of known centre and radius, in m as get_xy_coords_for_circles()"""
+    rng = np.random.default_rng(seed)
+    xc = -6.2e6 + rng.normal(0, 1e5, (n_circle, n_alt))
+    yc = 1.47e6 + rng.normal(0, 1e5, (n_circle, n_alt))
+    r = rng.uniform(8e4, 1.2e5, (n_circle, n_alt))
+
+    angle = np.linspace(0, 2 * np.pi, n_sounding, endpoint=False)
+    angle = angle + rng.normal(0, 0.1, (n_circle, n_alt, n_sounding))
+    x = xc[..., np.newaxis] + r[..., np.newaxis] * np.cos(angle)
+    y = yc[..., np.newaxis] + r[..., np.newaxis] * np.sin(angle)
+    x = x + rng.normal(0, noise, x.shape)
+    y = y + rng.normal(0, noise, y.shape)
+
+    return x, y, xc, yc, r
+
+
+def test_fit_circles_known_circles():
+    x, y, xc, yc, r = make_circle_points()
+    x[0, 0, :3] = np.nan
+    x[1, 0, 4:] = np.nan  # fewer than min_points
+
+    for refine in [True, False]:
+        fit = prep.fit_circles(x, y, refine=refine)
+
+        for fitted, expected in zip(fit, [xc, yc, r]):
+            assert np.isnan(fitted[1, 0])
+            fitted[1, 0] = expected[1, 0]
+            np.testing.assert_allclose(fitted, expected, rtol=0, atol=1e-3)
+
+
+def test_fit_circles_same_as_least_squares_circle():
+    cf = pytest.importorskip("circle_fit")
+
+    x, y, _, _, _ = make_circle_points(noise=2000)
+    x[0, 1, ::3] = np.nan
+
+    fit = prep.fit_circles(x, y)
+
+    # the fitter this replaced, one circle at a time
+    for c in range(x.shape[0]):
+        for a in range(x.shape[1]):
+            valid = ~np.isnan(x[c, a])
+            expected = cf.least_squares_circle(
+                list(zip(x[c, a, valid], y[c, a, valid]))
+            )
+            np.testing.assert_allclose(
+                [f[c, a] for f in fit], expected[:3], rtol=0, atol=1e-2
+            )
+
+
+def get_circles_by_loop(ds_lv3, circle_sonde_ids):
+    """circles as the per-circle loop that gather_circles() replaced built them"""
+    circles = []
+    for sonde_ids in circle_sonde_ids:
+        circle = ds_lv3.sel(sonde_id=sonde_ids)
+        circle = circle.pad(sonde_id=(0, 13 - len(sonde_ids)), mode="constant")
+        circle["sounding"] = (["sonde_id"], np.arange(0, 13, 1, dtype="int"))
+        circles.append(circle.swap_dims({"sonde_id": "sounding"}))
+    return circles
+
+
+def test_gather_circles_same_as_loop(tmp_path):
+    from test_reader import make_lv3_file
+
+    ds_lv3 = make_lv3_file(str(tmp_path / "lv3.nc"))
+    ids = ds_lv3.sonde_id.values
+    circle_sonde_ids = [list(ids[[3, 1, 2, 0, 4, 5]]), list(ids[7:20]), [ids[19]]]
+
+    gather_index = prep.get_circle_gather_index(ids, circle_sonde_ids)
+    circles = prep.gather_circles(ds_lv3, gather_index)
+
+    np.testing.assert_array_equal(gather_index[0], [3, 1, 2, 0, 4, 5] + [-1] * 7)
+    np.testing.assert_array_equal(gather_index[1], np.arange(7, 20))
+    assert circles.ta.dims == ("circle", "sounding", "alt")
+    np.testing.assert_array_equal(circles.sounding, np.arange(13))
+
+    for c, circle in enumerate(get_circles_by_loop(ds_lv3, circle_sonde_ids)):
+        n = len(circle_sonde_ids[c])
+        for var in ["ta", "launch_time", "flight_lat"]:
+            np.testing.assert_array_equal(circles[var][c], circle[var])
+        assert list(circles.sonde_id[c, :n].values) == circle_sonde_ids[c]
+        assert circles.sonde_id[c, n:].isnull().all()
+
+
+def test_get_circles_reads_circle_sondes(tmp_path, monkeypatch):
+    from joanne import config, reader
+    from test_reader import make_lv3_file
+    from test_segments import write_flight
+
+    (tmp_path / "yaml").mkdir()
+    write_flight(
+        tmp_path / "yaml",
+        "HALO",
+        5,
+        [["circle"], ["straight_leg"], ["circle"]],
+        [7, 3, 12],
+    )
+    circle_sonde_ids = [
+        [f"HALO-0205_s0{j:02d}" for j in range(7)],
+        [f"HALO-0205_s2{j:02d}" for j in range(12)],
+    ]
+    straight_leg = [f"HALO-0205_s1{j:02d}" for j in range(3)]
+
+    lv3_path = str(tmp_path / "lv3.nc")
+    ds_lv3 = make_lv3_file(
+        lv3_path, sonde_id=circle_sonde_ids[0] + straight_leg + circle_sonde_ids[1]
+    )
+    reader.write_sonde_index(ds_lv3, lv3_path)
+
+    requested = []
+    open_level_3 = reader.open_level_3
+
+    def spy(lv3_file_path, sonde_ids=None, **kwargs):
+        requested.extend(sonde_ids)
+        return open_level_3(lv3_file_path, sonde_ids=sonde_ids, **kwargs)
+
+    monkeypatch.setattr(reader, "open_level_3", spy)
+
+    previous_settings = config.set_config(cache_directory=str(tmp_path))
+    try:
+        circles = prep.get_circles(
+            lv3_filename=lv3_path, yaml_directory=str(tmp_path / "yaml")
+        )
+    finally:
+        config.set_config(**previous_settings)
+
+    # only the sondes of the circles are read from Level-3
+    assert sorted(requested) == sorted(circle_sonde_ids[0] + circle_sonde_ids[1])
+    assert list(circles.segment_id.values) == ["HALO-0205_0", "HALO-0205_2"]
+    assert circles.segment_start.values[1] == np.datetime64("2020-02-05T12:00")
+
+    for c, circle in enumerate(get_circles_by_loop(ds_lv3, circle_sonde_ids)):
+        n = len(circle_sonde_ids[c])
+        for var in ["ta", "launch_time", "platform_id"]:
+            np.testing.assert_array_equal(circles[var][c, :n], circle[var][:n])
+        assert circles.ta[c, n:].isnull().all()
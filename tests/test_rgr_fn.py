@@ -0,0 +1,226 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+rf = pytest.importorskip("joanne.Level_4.rgr_fn")
+
+
+def make_circles(n_circle=4, n_sounding=13, n_alt=30, seed=0):
+    rng = np.random.default_rng(seed)
+    angle = rng.uniform(0, 2 * np.pi, (n_circle, n_sounding, 1))
+    dx = 1e5 * np.cos(angle) * np.ones(n_alt)
+    dy = 1e5 * np.sin(angle) * np.ones(n_alt)
+    u = 5 + 2e-5 * dx - 1e-5 * dy + rng.normal(0, 0.5, dx.shape)
+    u[rng.random(u.shape) < 0.2] = np.nan
+    dims = ("circle", "sounding", "alt")
+    return xr.Dataset(
+        {"dx": (dims, dx), "dy": (dims, dy), "u": (dims, u), "v": (dims, -u)}
+    )
+
+
+def test_fit2d_same_as_lstsq():
+    ds = make_circles()
+    x, y, u = [np.moveaxis(ds[var].values, 1, -1) for var in ["dx", "dy", "u"]]
+
+    intercept, dudx, dudy = rf.fit2d(x, y, u)
+
+    for c, k in [(0, 0), (1, 5), (3, 29)]:
+        valid = ~np.isnan(u[c, k])
+        if valid.sum() < 6:
+            assert np.isnan(dudx[c, k])
+            continue
+        a = np.stack([np.ones(valid.sum()), x[c, k][valid], y[c, k][valid]], axis=-1)
+        expected = np.linalg.lstsq(a, u[c, k][valid], rcond=None)[0]
+        np.testing.assert_allclose(
+            [intercept[c, k], dudx[c, k], dudy[c, k]], expected, rtol=1e-10
+        )
+
+
+def test_fit2d_under_constrained_and_collinear():
+    x = np.array([[1.0, 2, 3, 4, 5, 6, 7], [1, 2, 3, 4, 5, 6, 7]])
+    y = np.array([[1.0, 5, 2, 7, 3, 1, 4], [1, 2, 3, 4, 5, 6, 7]])
+    u = np.array([[1.0, 2, np.nan, np.nan, 3, 4, 5], [1, 2, 3, 4, 5, 6, 7]])
+
+    intercept, dudx, dudy = rf.fit2d(x, y, u)
+
+    assert np.isnan([intercept, dudx, dudy]).all()
+
+
+def test_fit2d_for_parameters():
+    ds = rf.fit2d_for_parameters(make_circles(), ["u", "v"])
+
+    assert ds.u.dims == ("circle", "alt")
+    assert ds.u_sounding.dims == ("circle", "sounding", "alt")
+    np.testing.assert_allclose(ds.dvdx, -ds.dudx)
+
+
+def test_fit2d_xr_deprecated_output_core_dims():
+    ds = make_circles()
+
+    intercept, dudx, dudy = rf.fit2d_xr(ds.dx, ds.dy, ds.u, ["sounding"])
+    assert dudx.dims == ("circle", "alt")
+
+    with pytest.warns(DeprecationWarning):
+        *results, u = rf.fit2d_xr(ds.dx, ds.dy, ds.u, ["sounding"], ["sounding"])
+
+    for result, expected in zip(results, [intercept, dudx, dudy]):
+        xr.testing.assert_identical(result, expected)
+    xr.testing.assert_equal(u, ds.u.transpose("circle", "alt", "sounding"))
+
+
+def test_run_regression():
+    circle = make_circles(n_circle=1).isel(circle=0)
+    circle.u[:, 3] = np.nan
+    circle.u[:7, 3] = 1.0  # only 7 sondes at this level, i.e. regressed
+    circle.u[:6, 4] = 1.0  # only 6 sondes at this level, i.e. not regressed
+    circle.u[6:, 4] = np.nan
+    circle["v"] = circle.u * 2 + circle.dx * 1e-5
+    for var in ["q", "ta", "p"]:
+        circle[var] = circle.u
+
+    mean, m, c, Ns = rf.run_regression(circle, "v")
+
+    expected = rf.fit2d(circle.dx.values.T, circle.dy.values.T, circle.v.values.T)
+    regressed = Ns > 0
+    np.testing.assert_allclose(mean[regressed], expected[0][regressed])
+    np.testing.assert_allclose(m[regressed], expected[1][regressed])
+    np.testing.assert_allclose(c[regressed], expected[2][regressed])
+    assert Ns[3] == 7
+    assert Ns[4] == 0
+    assert ((Ns == 0) == np.isnan(m)).all()
+
+
+def test_vertical_velocity_skips_missing_divergence():
+    pytest.importorskip("metpy")
+    dims = ("circle", "sounding", "alt")
+    ds = xr.Dataset(
+        {
+            "q_sounding": (dims, np.full((1, 3, 5), 0.01)),
+            "p_sounding": (dims, np.full((1, 3, 5), 1e5)),
+            "ta_sounding": (dims, np.full((1, 3, 5), 300.0)),
+            "D": (("circle", "alt"), [[np.nan, 1e-4, np.nan, np.nan, 2e-4]]),
+        }
+    )
+
+    rf.get_density_vertical_velocity_and_omega(ds)
+
+    np.testing.assert_allclose(ds.W[0], [0, -1e-3, np.nan, np.nan, -7e-3])
+    assert np.isnan(ds.omega[0, 0])
+    np.testing.assert_allclose(ds.omega[0, 1], ds.mean_density[0, 1] * 9.81e-3)
+
+
+def test_get_advection():
+    ds = rf.fit2d_for_parameters(make_circles(), ["u", "v"])
+
+    rf.get_advection(ds, ["u", "v"])
+
+    np.testing.assert_allclose(
+        ds.h_adv_v, -(ds.u * ds.dvdx) - (ds.v * ds.dvdy), equal_nan=True
+    )
+    assert ds.h_adv_u.dims == ("circle", "alt")
+
+
+def test_fit2d_weighted_same_as_lstsq():
+    ds = make_circles(n_circle=1)
+    x, y, u = [np.moveaxis(ds[var].values, 1, -1)[0, 0] for var in ["dx", "dy", "u"]]
+    valid = ~np.isnan(u)
+    weights = np.linspace(0.1, 1, len(u))
+
+    moments = rf.fit2d_moments(x, y, valid, weights=weights)
+    result = rf.fit2d_solve(moments, u)
+
+    sqrt_w = np.sqrt(weights[valid])
+    a = np.stack([np.ones(valid.sum()), x[valid], y[valid]], axis=-1)
+    expected = np.linalg.lstsq(a * sqrt_w[:, None], u[valid] * sqrt_w, rcond=None)[0]
+    np.testing.assert_allclose(result, expected, rtol=1e-10)
+
+
+@pytest.mark.parametrize("method", ["huber", "tukey"])
+def test_fit2d_robust_downweights_outlier(method):
+    ds = make_circles()
+    ds.u[:, 0, :] = ds.u[:, 0, :] + 20
+    ds["v"] = -ds.u
+
+    ds = rf.fit2d_for_parameters(ds, ["u", "v"], method=method)
+
+    assert ds.u_weight.dims == ("circle", "alt", "sounding")
+    outlier = ds.u_weight.isel(sounding=0)
+    outlier = outlier.where(ds.u_sounding.isel(sounding=0).notnull())
+    assert float(outlier.median()) < 0.1
+    assert float(abs(ds.dudx - 2e-5).median()) < 3e-6
+    np.testing.assert_allclose(ds.dvdx, -ds.dudx)
+
+
+def test_fit2d_robust_with_zero_mad():
+    # most points lie exactly on the plane, so the MAD of the residuals becomes 0
+    x, y = np.meshgrid(np.arange(4.0), np.arange(3.0))
+    x, y = x.ravel(), y.ravel()
+    u = 1 + 2 * x + 3 * y
+    u[0] += 1e-3
+    u[-1] += 5
+
+    intercept, dudx, dudy, weights = rf.fit2d_robust(x, y, u, method="huber")
+
+    # the small residual keeps its full weight, only the outlier is downweighted
+    assert weights[0] == 1
+    assert weights[-1] < 0.1
+    np.testing.assert_allclose([intercept, dudx, dudy], [1, 2, 3], atol=1e-2)
+
+
+def test_get_resample_weights():
+    present = np.array([[True] * 10 + [False] * 3, [True] * 13])
+
+    boot = rf.get_resample_weights(present, 50, rng=np.random.default_rng(0))
+    jack = rf.get_resample_weights(present, 50, method="jackknife")
+
+    assert boot.shape == (50, 2, 13)
+    np.testing.assert_array_equal(boot.sum(axis=-1), [[10, 13]] * 50)
+    assert (boot[:, 0, 10:] == 0).all()
+    assert jack.shape == (13, 2, 13)
+    assert np.isnan(jack[10:, 0]).all()
+    np.testing.assert_array_equal(jack[3, 1], np.arange(13) != 3)
+
+
+def test_resample_circle_products():
+    ds = rf.fit2d_for_parameters(make_circles(), ["u", "v"])
+
+    samples = rf.resample_circle_products(ds, n_resamples=10, chunk_size=3)
+
+    assert samples.D.dims == ("resample", "circle", "alt")
+    assert samples.identical(
+        rf.resample_circle_products(ds, n_resamples=10, chunk_size=10)
+    )
+
+    # a bootstrap resample is the fit to the drawn soundings, duplicates included
+    weights = rf.get_resample_weights(
+        np.full((4, 13), True), 10, rng=np.random.default_rng(0)
+    )
+    drawn = np.repeat(np.arange(13), weights[2, 1].astype(int))
+    circle = ds.isel(circle=1, alt=5, sounding=drawn)
+    _, dudx, _ = rf.fit2d(circle.dx.values, circle.dy.values, circle.u_sounding.values)
+    _, _, dvdy = rf.fit2d(circle.dx.values, circle.dy.values, circle.v_sounding.values)
+    np.testing.assert_allclose(samples.D[2, 1, 5], dudx + dvdy, rtol=1e-6)
+
+    std_err = rf.get_resample_std_err(
+        rf.resample_circle_products(ds, method="jackknife")
+    )
+    assert std_err.vor.dims == ("circle", "alt")
+    assert float(std_err.vor.median()) > 0
+
+
+def test_fit2d_std_err_same_as_lstsq():
+    ds = rf.fit2d_for_parameters(make_circles(), ["u"])
+    x, y, u = [
+        np.moveaxis(ds[var].values, 1, -1)[2, 7] for var in ["dx", "dy", "u_sounding"]
+    ]
+    valid = ~np.isnan(u)
+
+    a = np.stack([np.ones(valid.sum()), x[valid], y[valid]], axis=-1)
+    _, rss, _, _ = np.linalg.lstsq(a, u[valid], rcond=None)
+    cov = rss[0] / (valid.sum() - 3) * np.linalg.inv(a.T @ a)
+
+    np.testing.assert_allclose(
+        [ds.se_u[2, 7], ds.se_dudx[2, 7], ds.se_dudy[2, 7]],
+        np.sqrt(np.diag(cov)),
+        rtol=1e-8,
+    )
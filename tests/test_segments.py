@@ -0,0 +1,68 @@
+import datetime
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+yaml = pytest.importorskip("yaml")
+
+from joanne import segments
+
+
+def write_flight(directory, platform, day, kinds, n_good):
+    segs = [
+        {
+            "kinds": k,
+            "segment_id": f"{platform}-02{day:02d}_{i}",
+            "start": datetime.datetime(2020, 2, day, 10 + i),
+            "end": datetime.datetime(2020, 2, day, 10 + i, 50),
+            "dropsondes": {
+                "GOOD": [f"{platform}-02{day:02d}_s{i}{j:02d}" for j in range(n)],
+                "BAD": [],
+            },
+        }
+        for i, (k, n) in enumerate(zip(kinds, n_good))
+    ]
+    path = os.path.join(
+        directory, f"EUREC4A_{platform}_Flight-Segments_202002{day:02d}.yaml"
+    )
+    with open(path, "w") as f:
+        yaml.safe_dump({"date": datetime.date(2020, 2, day), "segments": segs}, f)
+    return path
+
+
+def test_catalogue_query_and_cache(tmp_path):
+    write_flight(
+        tmp_path, "HALO", 5, [["circle"], ["straight_leg"], ["circle"]], [7, 2, 3]
+    )
+    write_flight(tmp_path, "P3", 9, [["straight_leg", "circle"]], [10])
+
+    catalogue = segments.get_segment_catalogue(str(tmp_path))
+
+    assert os.path.exists(tmp_path / "segment_catalogue.nc")
+    np.testing.assert_array_equal(catalogue.flight_platform, ["HALO", "P3"])
+
+    rows = segments.query_segments(catalogue, kind="circle", min_good_sondes=6)
+    assert list(catalogue.segment_id.values[rows]) == ["HALO-0205_0", "P3-0209_0"]
+    assert segments.get_good_sonde_ids(catalogue, rows)[1][-1] == "P3-0209_s009"
+
+    rows = segments.query_segments(
+        catalogue, time_range=("2020-02-05T10:55", "2020-02-05T11:10")
+    )
+    assert list(catalogue.segment_id.values[rows]) == ["HALO-0205_1"]
+
+    # cached catalogue is used until a YAML file is added or modified
+    assert segments.get_segment_catalogue(str(tmp_path)).identical(catalogue)
+    write_flight(tmp_path, "HALO", 11, [["circle"]], [8])
+    assert len(segments.get_segment_catalogue(str(tmp_path)).flight) == 3
+
+
+def test_catalogue_cache_in_new_directory(tmp_path):
+    write_flight(tmp_path, "HALO", 5, [["circle"]], [7])
+    cache_path = str(tmp_path / "cache" / "segment_catalogue.nc")
+
+    catalogue = segments.get_segment_catalogue(str(tmp_path), cache_path=cache_path)
+
+    assert os.path.exists(cache_path)
+    assert len(catalogue.segment_id) == 1
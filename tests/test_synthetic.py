@@ -0,0 +1,149 @@
+import datetime
+import glob
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+yaml = pytest.importorskip("yaml")
+
+from joanne import config, segments, synthetic
+
+
+@pytest.fixture
+def settings():
+    previous_settings = dict(config.settings)
+    yield config.settings
+    config.settings.clear()
+    config.settings.update(previous_settings)
+
+
+def test_launch_plan():
+    launches, segs = synthetic.get_launch_plan(
+        synthetic.get_flight_dates(1)[0], n_circles=2, sondes_per_circle=6
+    )
+
+    assert len(launches) == 2 * 6 + 2
+    assert [kind for kind, start, end in segs] == ["circle", "circle", "straight_leg"]
+    assert segs[0][1] < launches[0][0] < segs[0][2]
+    assert len(synthetic.get_flight_dates(300)) == 300
+    assert datetime.date(2020, 2, 11) not in synthetic.get_flight_dates(300)
+
+    with pytest.raises(ValueError, match="fit into a day"):
+        synthetic.get_launch_plan(synthetic.get_flight_dates(1)[0], n_circles=100)
+
+
+def test_campaign_passes_qc(settings, tmp_path):
+    f2 = pytest.importorskip("joanne.Level_2.fn_2")
+
+    rates = {mode: 1 / 8 for mode in synthetic.failure_modes}
+    sondes = synthetic.write_campaign(
+        str(tmp_path), platforms=["HALO"], n_flights=1, n_circles=1, failure_rates=rates
+    )
+    config.set_config(str(tmp_path / "joanne_config.yaml"))
+    assert set(sondes.qc_flag) == {"GOOD", "UGLY", "BAD"}
+
+    assert len(glob.glob(config.get_directory("level_1") + "HALO/D*QC.nc")) == 14
+    sonde = xr.open_dataset(glob.glob(config.get_directory("level_1") + "HALO/*")[0])
+    assert sonde.pres.max() > 1000
+    # PTU at every other record, with the latest (surface) record first as in ASPEN
+    assert np.isnan(sonde.tdry[-2::-2]).all()
+    assert sonde.time[0] > sonde.time[-1]
+
+    # the QC flags of Level-2 are those the sondes were generated for
+    status_ds = f2.get_status_ds_for_platform("HALO", config.get_directory("qc"))
+    np.testing.assert_array_equal(status_ds.sonde_id, sondes.sonde_id)
+    np.testing.assert_array_equal(status_ds.qc_flag, sondes.qc_flag)
+
+    catalogue = segments.get_segment_catalogue(config.get_directory("yaml"))
+    rows = segments.query_segments(catalogue, kind="circle")
+    assert list(segments.get_good_sonde_ids(catalogue, rows)[0]) == list(
+        sondes.sonde_id[
+            (sondes.qc_flag == "GOOD") & (sondes.segment_id.str[-2:] == "c1")
+        ]
+    )
+
+
+def write_level_2_campaign(directory, failure_rates=None, **kwargs):
+    """writes a HALO-only synthetic campaign and the Level-2 files of its sondes"""
+    f2 = pytest.importorskip("joanne.Level_2.fn_2")
+
+    sondes = synthetic.write_campaign(
+        directory, platforms=["HALO"], failure_rates=failure_rates, **kwargs
+    )
+    config.set_config(os.path.join(directory, "joanne_config.yaml"))
+    os.makedirs(config.get_directory("level_2"), exist_ok=True)
+
+    status_ds = f2.get_status_ds_for_platform("HALO", config.get_directory("qc"))
+    lv2_files = [
+        f2.write_level_2_sonde("HALO", sonde_path, status_ds)
+        for sonde_path in sorted(
+            glob.glob(config.get_directory("level_1") + "HALO/D*QC.nc")
+        )
+    ]
+    return sondes, lv2_files
+
+
+def test_level_2_skips_sondes_without_a_file(settings, tmp_path):
+    rates = {"missing_a_file": 1 / 4, "no_surface": 1 / 4}
+    sondes, lv2_files = write_level_2_campaign(
+        str(tmp_path), failure_rates=rates, n_flights=1, n_circles=1
+    )
+    assert "missing_a_file" in set(sondes.failure)
+
+    # sondes that are not GOOD are skipped before their A file is looked up
+    written = [path is not None for path in lv2_files]
+    assert written == list(sondes.qc_flag == "GOOD")
+    for path in lv2_files:
+        if path is not None:
+            with xr.open_dataset(path) as lv2:
+                assert str(lv2.sonde_id.values) in set(sondes.sonde_id)
+
+
+def test_pipeline_on_campaign_with_failures(settings, tmp_path):
+    pytest.importorskip("joanne.Level_4.ready_ds_for_regression")
+    from joanne import pipeline, reader
+
+    rates = {mode: 0.06 for mode in synthetic.failure_modes}
+    sondes = synthetic.write_campaign(
+        str(tmp_path),
+        platforms=["HALO"],
+        n_flights=1,
+        n_circles=1,
+        sondes_per_circle=10,
+        n_straight_leg=0,
+        failure_rates=rates,
+        seed=4,
+    )
+    config.set_config(str(tmp_path / "joanne_config.yaml"))
+    good = list(sondes.sonde_id[sondes.qc_flag == "GOOD"])
+    assert {"missing_a_file", "no_surface"} <= set(sondes.failure)
+    assert len(good) >= 6
+
+    plan = pipeline.run_tasks(
+        pipeline.get_joanne_tasks(["HALO"]),
+        str(tmp_path / "state.json"),
+        workers=2,
+    )
+
+    assert {result for _, result in plan} == {"ran"}
+    assert len(glob.glob(config.get_directory("level_2") + "*.nc")) == len(good)
+
+    lv3_path = glob.glob(config.get_directory("level_3") + "*Level_3_v*.nc")
+    lv3_path = [path for path in lv3_path if not path.endswith("_sonde_index.nc")]
+    assert list(reader.get_sonde_index(lv3_path[0]).sonde_id.values) == good
+
+    with xr.open_dataset(
+        glob.glob(config.get_directory("level_4") + "*Level_4*.nc")[0]
+    ) as lv4:
+        assert len(lv4.circle) == 1
+        assert np.isfinite(lv4.D).any()
+
+    # Level-4 is made from the Level-3 file among the inputs, into save_directory
+    save_directory = str(tmp_path / "other_level_4")
+    inputs = [str(tmp_path / "flight.yaml")] + lv3_path
+    lv4_path = pipeline.run_level_4(inputs, save_directory)
+    assert os.path.dirname(lv4_path[0]) == save_directory
+    with xr.open_dataset(lv4_path[0]) as lv4:
+        assert len(lv4.circle) == 1
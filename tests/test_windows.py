@@ -0,0 +1,87 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+xr = pytest.importorskip("xarray")
+rf = pytest.importorskip("joanne.Level_4.rgr_fn")
+
+from joanne.Level_4 import windows
+
+
+def make_lv3(n_halo=24, n_p3=12, n_alt=20, seed=0):
+    rng = np.random.default_rng(seed)
+    n = n_halo + n_p3
+    angle = np.arange(n) * 2 * np.pi / 12
+    lat = 13.3 + 0.9 * np.sin(angle)[:, None] + np.zeros((n, n_alt))
+    lon = -57.7 + 0.9 * np.cos(angle)[:, None] + rng.normal(0, 0.01, (n, n_alt))
+    x, y = windows.get_xy_coords(lat, lon)
+    u = 5 + 2e-5 * x - 1e-5 * y + rng.normal(0, 0.3, x.shape)
+    u[rng.random(u.shape) < 0.1] = np.nan
+    launch_time = np.datetime64("2020-02-05T10:00") + np.arange(n) * np.timedelta64(
+        5, "m"
+    )
+    dims = ["sonde_id", "alt"]
+    return xr.Dataset(
+        {
+            "lat": (dims, lat),
+            "lon": (dims, lon),
+            "u": (dims, u),
+            "v": (dims, -u),
+            "launch_time": (["sonde_id"], launch_time),
+            "platform_id": (["sonde_id"], np.array(["HALO"] * n_halo + ["P3"] * n_p3)),
+            "flight_lat": (["sonde_id"], lat[:, 0]),
+            "flight_lon": (["sonde_id"], lon[:, 0]),
+        },
+        coords={"sonde_id": [f"s{i:02d}" for i in range(n)], "alt": np.arange(n_alt)},
+    )
+
+
+def test_sliding_windows_same_as_fit2d():
+    ds = make_lv3()
+
+    result = windows.regress_sliding_windows(ds, n_sondes=10, list_of_parameters=["u"])
+
+    # windows do not cross from the HALO to the P3 flight
+    assert len(result.window) == (24 - 9) + (12 - 9)
+    assert list(result.first_sonde_id[15:]) == ["s24", "s25", "s26"]
+
+    x, y = windows.get_xy_coords(ds.lat.values, ds.lon.values)
+    u = ds.u.values
+    _, dudx, dudy = rf.fit2d(x[3:13].T, y[3:13].T, u[3:13].T)
+    np.testing.assert_allclose(result.dudx[3], dudx, rtol=1e-8)
+    np.testing.assert_allclose(result.dudy[3], dudy, rtol=1e-8)
+
+
+def test_sonde_groups():
+    ds = make_lv3()
+    groups = [["s00", "s03", "s05", "s07", "s09", "s11", "s02"], ["s12", "s13"]]
+
+    result = windows.regress_sonde_groups(ds, groups, list_of_parameters=["u", "v"])
+
+    rows = [0, 3, 5, 7, 9, 11, 2]
+    x, y = windows.get_xy_coords(ds.lat.values[rows], ds.lon.values[rows])
+    _, dudx, _ = rf.fit2d(x.T, y.T, ds.u.values[rows].T)
+    np.testing.assert_allclose(result.dudx[0], dudx, rtol=1e-8)
+    np.testing.assert_allclose(result.D, result.dudx + result.dvdy)
+    # too few sondes in the second group
+    assert result.u[1].isnull().all()
+    assert list(result.n_sondes) == [7, 2]
+
+
+def test_window_means_skip_missing_values():
+    ds = make_lv3()
+    ds["flight_lat"][2] = np.nan
+
+    result = windows.regress_sliding_windows(ds, n_sondes=10, list_of_parameters=["u"])
+
+    # only the 3 windows that contain s02 miss it, none of them is NaN
+    assert result.window_lat.notnull().all()
+    with_s02 = [0, 1, 2]
+    np.testing.assert_allclose(
+        result.window_lat[with_s02],
+        [np.nanmean(ds.flight_lat.values[i : i + 10]) for i in with_s02],
+    )
+    np.testing.assert_allclose(
+        result.window_lat[3:15],
+        [ds.flight_lat.values[i : i + 10].mean() for i in range(3, 15)],
+    )
+    assert result.window_time[5] == ds.launch_time[5:15].mean()